@@ -0,0 +1,109 @@
+"""
+Benchmark gradient checkpointing. For each configuration, we report
+the peak memory allocated while computing the gradient of a deep
+recurrent computation, and the time it takes, for:
+
+* A loop whose cell is called normally, and through ``checkpoint``.
+* An unrolled chain of cells, with and without ``memory_budget``.
+
+$ python benchmarks/bench_checkpoint.py
+"""
+
+import sys
+import time
+import tracemalloc
+import numpy
+from myia.front import compile
+from myia.parse import parse_function
+from myia.transform import a_normal, Grad
+from myia.impl.impl_interp import exp, checkpoint
+
+
+def cell(s):
+    h, w = s
+    a = h * w
+    b = exp(-a)
+    c = 1 / (1 + b)
+    return c * h + a
+
+
+def rnn(h, w, n):
+    i = 0
+    while i < n:
+        h = cell((h, w))
+        i = i + 1
+    return h
+
+
+def rnn_checkpoint(h, w, n):
+    i = 0
+    while i < n:
+        h = checkpoint(cell, (h, w))
+        i = i + 1
+    return h
+
+
+def chain(h, w):
+    h = cell((h, w))
+    h = cell((h, w))
+    h = cell((h, w))
+    h = cell((h, w))
+    h = cell((h, w))
+    h = cell((h, w))
+    h = cell((h, w))
+    h = cell((h, w))
+    h = cell((h, w))
+    h = cell((h, w))
+    h = cell((h, w))
+    h = cell((h, w))
+    h = cell((h, w))
+    h = cell((h, w))
+    h = cell((h, w))
+    h = cell((h, w))
+    return h
+
+
+# The backpropagator of a loop is a chain of closures as deep as the
+# number of iterations, which is exported recursively.
+sys.setrecursionlimit(100000)
+
+rng = numpy.random.RandomState(1234)
+size = 1000
+h0, w0 = rng.rand(size) * 0.1, rng.rand(size) * 0.1
+
+benchmarks = [
+    ('rnn', rnn, None, (h0, w0, 32)),
+    ('rnn/checkpoint', rnn_checkpoint, None, (h0, w0, 32)),
+    ('chain', chain, None, (h0, w0)),
+    ('chain/budget=8', chain, 8, (h0, w0)),
+    ('chain/budget=4', chain, 4, (h0, w0)),
+]
+
+
+def measure(gfn, args, repeat):
+    # Warm up (compiles every function reachable at runtime)
+    gfn(*args)[1](numpy.ones(size))
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        _, bprop = gfn(*args)
+        bprop(numpy.ones(size))
+        del bprop
+    t = (time.perf_counter() - t0) / repeat
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, t
+
+
+def run(repeat=3):
+    print(f'{"function":20}{"peak (MB)":>12}{"time (ms)":>12}')
+    for name, fn, budget, args in benchmarks:
+        lbda = parse_function(fn)
+        glbda = Grad(lbda.ref, a_normal(lbda),
+                     memory_budget=budget).transform()
+        peak, t = measure(compile(glbda), args, repeat)
+        print(f'{name:20}{peak / 2**20:>12.1f}{t * 1000:>12.1f}')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,60 @@
+"""
+Benchmark the dataflow analysis (see ``myia.inference.dfa``) on
+generated programs with many functions. Each program is a chain of
+nested functions that call the previous ones and pass closures
+around. For each size, we report the number of lambdas, the time to
+reach the fixpoint and the number of worklist iterations.
+
+$ python benchmarks/bench_dfa.py
+"""
+
+import sys
+import time
+from myia.parse import parse_source
+from myia.inference.dfa import DFA, ValueTrack, NeedsTrack
+from myia.stx import LambdaNode, python_universe
+from myia.symbols import builtins
+
+
+def make_program(n):
+    lines = ['def main(x, y):',
+             '    def f0(x, y):',
+             '        return x + y']
+    for i in range(1, n):
+        lines += [f'    def f{i}(x, y):',
+                  f'        if x < {i}:',
+                  f'            return f{i - 1}(x, y)',
+                  f'        else:',
+                  f'            return f{i // 2}(y, x)']
+    lines.append(f'    return f{n - 1}(x, y)')
+    return '\n'.join(lines)
+
+
+def count_lambdas(dfa):
+    return sum(isinstance(node, LambdaNode) for node in dfa.flow_events)
+
+
+def measure(n):
+    lbda = parse_source(f'<bench_dfa:{n}>', 1, make_program(n))
+    t0 = time.perf_counter()
+    dfa = DFA([ValueTrack, lambda dfa: NeedsTrack(dfa, [builtins.shape])],
+              python_universe)
+    dfa.visit(lbda)
+    dfa.propagate(lbda.body, 'needs', builtins.shape)
+    t = time.perf_counter() - t0
+    return count_lambdas(dfa), t, dfa.stats()['iterations']
+
+
+def run(sizes=(100, 300, 1000)):
+    print(f'{"size":>8}{"lambdas":>10}{"time (ms)":>12}{"iterations":>12}')
+    for n in sizes:
+        lambdas, t, iterations = measure(n)
+        print(f'{n:>8}{lambdas:>10}{t * 1000:>12.1f}{iterations:>12}')
+
+
+# The parser and the analysis recurse through the nested functions.
+sys.setrecursionlimit(100000)
+
+
+if __name__ == '__main__':
+    run()
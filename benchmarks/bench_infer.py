@@ -0,0 +1,199 @@
+"""
+Benchmark the abstract evaluation of branchy code. Each ``if`` on an
+unknown condition forks the abstract VM, so the number of paths
+through a function grows exponentially with the number of branches
+it goes through. For each function, we report the time it takes to
+infer the shape of its output and the results.
+
+The ``countdown`` loop runs a million times on known values, so its
+inference relies on widening (see ``myia.inference.avm.Widening``).
+The ``processes`` rows explore the branches in several processes
+(see ``myia.inference.avm.AVM.eval_parallel``). Forking costs a few
+milliseconds, so it only pays off when the branches do enough work,
+like the four loops of ``loops4``. Its time should drop with the
+number of processes, up to 4, on a machine with as many cores.
+
+$ python benchmarks/bench_infer.py
+"""
+
+import os
+import time
+from myia.parse import parse_function
+from myia.inference.avm import abstract_evaluate, AbstractValue, ANY, \
+    DepthWidening, IntervalWidening, JoinWidening, Budget
+from myia.symbols import builtins
+
+
+def branches4(c, x, y):
+    if c < 0:
+        x = x + y
+    else:
+        x = y + x
+    if c < 1:
+        x = x + y
+    else:
+        x = y + x
+    if c < 2:
+        x = x + y
+    else:
+        x = y + x
+    if c < 3:
+        x = x + y
+    else:
+        x = y + x
+    return x
+
+
+def branches8(c, x, y):
+    x = branches4(c, x, y)
+    if c < 4:
+        x = x + y
+    else:
+        x = y + x
+    if c < 5:
+        x = x + y
+    else:
+        x = y + x
+    if c < 6:
+        x = x + y
+    else:
+        x = y + x
+    if c < 7:
+        x = x + y
+    else:
+        x = y + x
+    return x
+
+
+def step(c, x, y):
+    if c < 0:
+        return x @ y
+    else:
+        return x
+
+
+def calls8(c, x, y):
+    x = step(c, x, y)
+    x = step(c, x, y)
+    x = step(c, x, y)
+    x = step(c, x, y)
+    x = step(c, x, y)
+    x = step(c, x, y)
+    x = step(c, x, y)
+    x = step(c, x, y)
+    return x
+
+
+def loop(n, x, y):
+    while n > 0:
+        if n < 3:
+            x = x @ y
+        else:
+            x = x + x
+        n = n - 1
+    return x
+
+
+def countdown(n, x, y):
+    while n > 0:
+        x = x @ y
+        n = n - 1
+    return x
+
+
+def loop_a(n, x, y):
+    while n > 0:
+        x = x @ y
+        n = n - 1
+    return x
+
+
+def loop_b(n, x, y):
+    while n > 0:
+        x = y @ x
+        n = n - 1
+    return x
+
+
+def loop_c(n, x, y):
+    while n > 0:
+        x = x + x @ y
+        n = n - 1
+    return x
+
+
+def loop_d(n, x, y):
+    while n > 0:
+        x = x @ y - x
+        n = n - 1
+    return x
+
+
+def loops4(c, n, x, y):
+    if c < 1:
+        if c < 0:
+            x = loop_a(n, x, y)
+        else:
+            x = loop_b(n, x, y)
+    else:
+        if c < 2:
+            x = loop_c(n, x, y)
+        else:
+            x = loop_d(n, x, y)
+    return x
+
+
+n = AbstractValue(1_000_000)
+
+benchmarks = [
+    ('branches4', branches4, (ANY, (5, 6), (5, 6)), {}),
+    ('branches8', branches8, (ANY, (5, 6), (5, 6)), {}),
+    ('calls8', calls8, (ANY, (6, 6), (6, 6)), {}),
+    ('branches8/processes=2', branches8, (ANY, (5, 6), (5, 6)),
+     dict(processes=2)),
+    ('branches8/processes=4', branches8, (ANY, (5, 6), (5, 6)),
+     dict(processes=4)),
+    ('loops4', loops4, (ANY, n, (6, 6), (6, 6)),
+     dict(widening=[DepthWidening(50)])),
+    ('loops4/processes=2', loops4, (ANY, n, (6, 6), (6, 6)),
+     dict(widening=[DepthWidening(50)], processes=2)),
+    ('loops4/processes=4', loops4, (ANY, n, (6, 6), (6, 6)),
+     dict(widening=[DepthWidening(50)], processes=4)),
+    ('loop', loop, (ANY, (5, 6), (6, 6)), {}),
+    ('countdown/depth=5', countdown, (n, (5, 6), (6, 6)),
+     dict(widening=[DepthWidening(5)])),
+    ('countdown/depth=50', countdown, (n, (5, 6), (6, 6)),
+     dict(widening=[DepthWidening(50)])),
+    ('countdown/join=3', countdown, (n, (5, 6), (6, 6)),
+     dict(widening=[JoinWidening(3)])),
+    ('countdown/interval', countdown, (n, (5, 6), (6, 6)),
+     dict(widening=[IntervalWidening()])),
+    ('countdown/budget', countdown, (n, (5, 6), (6, 6)),
+     dict(widening=[], budget=Budget(steps=100))),
+]
+
+
+def measure(fn, inputs, options, repeat):
+    proj = builtins.shape
+    inputs = tuple(i if isinstance(i, AbstractValue)
+                   else AbstractValue(i) if i is ANY
+                   else AbstractValue({proj: i})
+                   for i in inputs)
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        afn = abstract_evaluate(parse_function(fn), proj=proj, **options)
+        results = set(afn(*inputs))
+    t = (time.perf_counter() - t0) / repeat
+    return results, t
+
+
+def run(repeat=3):
+    print(f'{os.cpu_count()} cores')
+    print(f'{"function":24}{"time (ms)":>12}  results')
+    for name, fn, inputs, options in benchmarks:
+        results, t = measure(fn, inputs, options, repeat)
+        print(f'{name:24}{t * 1000:>12.1f}  {results}')
+
+
+if __name__ == '__main__':
+    run()
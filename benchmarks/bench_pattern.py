@@ -0,0 +1,95 @@
+"""
+Benchmark the pattern optimizations of myia.ir.pattern on gradient
+graphs. For each function, we report the number of nodes in the
+graphs compiled to compute the gradient (including the ones that are
+only compiled at runtime, e.g. the gradients of primitives) and the
+time it takes to compute the gradient, with and without the rule sets.
+
+$ python benchmarks/bench_pattern.py
+"""
+
+import time
+import numpy
+from myia.front import standard_pipeline, standard_configuration
+from myia.ir import IRGraph
+from myia.ir.pattern import EquilibriumPass, rules
+from myia.parse import parse_function
+from myia.transform import a_normal, Grad
+from myia.impl.impl_interp import exp, sum
+
+
+def sigmoid(x):
+    return 1 / (1 + exp(-x))
+
+
+def logistic(w, b, x, y):
+    y_hat = sigmoid(x @ w + b)
+    return sum((y_hat - y) ** 2)
+
+
+def pow10(x):
+    v = x
+    i = 0
+    j = 0
+    while j < 3:
+        i = 0
+        while i < 3:
+            v = v * x
+            i = i + 1
+        j = j + 1
+    return v
+
+
+def tuples(x, y):
+    a, b = (x * 1.0, y) + (y, x ** 2)
+    return a * b
+
+
+rng = numpy.random.RandomState(1234)
+
+benchmarks = [
+    (logistic, (rng.randn(10, 1), rng.randn(1, 1),
+                rng.randn(100, 10), rng.randn(100, 1))),
+    (pow10, (1.1,)),
+    (tuples, (3.0, 4.0)),
+]
+
+
+def universe(passes):
+    cfg = {**standard_configuration, 'opt_passes': passes}
+    return standard_pipeline.get_universes(**cfg)['full']
+
+
+def measure(univ, glbda, args, repeat):
+    cache = univ.universes['opt'].cache
+    before = set(cache)
+    gfn = univ[glbda]
+    # Warm up (compiles every function reachable at runtime)
+    gfn(*args)[1](1.0)
+    graphs = {cache[k] for k in set(cache) - before}
+    nodes = sum(len(list(g.iternodes()))
+                for g in graphs if isinstance(g, IRGraph))
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        _, bprop = gfn(*args)
+        bprop(1.0)
+    return nodes, (time.perf_counter() - t0) / repeat
+
+
+def run(repeat=20):
+    # Note: the baseline must be measured first, because optimization
+    # modifies the graphs shared by both pipelines in place.
+    base = universe([])
+    opt = universe([EquilibriumPass(*rules())])
+    print(f'{"function":12}{"nodes":>16}{"time (ms)":>24}')
+    for fn, args in benchmarks:
+        lbda = parse_function(fn)
+        glbda = Grad(lbda.ref, a_normal(lbda)).transform()
+        n0, t0 = measure(base, glbda, args, repeat)
+        n1, t1 = measure(opt, glbda, args, repeat)
+        print(f'{fn.__name__:12}{n0:>7} -> {n1:<7}'
+              f'{t0 * 1000:>10.2f} -> {t1 * 1000:<10.2f}')
+
+
+if __name__ == '__main__':
+    run()
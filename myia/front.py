@@ -3,19 +3,26 @@ from typing import Tuple as TupleT
 import inspect
 import textwrap
 import ast
+import numpy
 from .parse import Parser, Locator, parse_function
 from .stx import Symbol, _Assign, python_universe
 from .lib import \
-    BackedUniverse, StructuralMap, is_struct, \
+    BackedUniverse, StructuralMap, is_struct, universe_map_dispatch, \
     UniverseGenerator, UniversePipelineGenerator
 from .stx import PythonUniverse
 from .ir import \
-    SymbolicUniverse, IRUniverse, OptimizedUniverse, \
-    ResolveGlobalsPass  # , ClosureUnconversionPass, ClosureConversionPass
-from .ir.pattern import EquilibriumPass, drop_copy
+    IRNode, SymbolicUniverse, IRUniverse, OptimizedUniverse, \
+    ResolveGlobalsPass, DotChainPass, ElementwiseFusionPass, \
+    StaticDotChainPass, TupleFlatteningPass, LoopInvariantPass
+# , ClosureUnconversionPass, ClosureConversionPass
+from .ir.pattern import EquilibriumPass, PartialEvaluationPass, rules
 from .interpret import VMFunction, VMUniverse
-from .symbols import object_map
+from .inference.irinfer import InferencePass
+from .symbols import object_map, builtins
 from .impl.main import impl_bank
+from .impl.impl_bprop import dual_join, dual_split
+from .transform import a_normal, Grad
+from .lib import ZERO, Batch, Record
 
 
 class CallableVMFunction:
@@ -42,7 +49,7 @@ class EvaluationUniverse(BackedUniverse):
         if isinstance(x, VMFunction):
             return CallableVMFunction(x, self.parent, self)
         elif is_struct(x):
-            return StructuralMap(self.export_value)(x)
+            return StructuralMap(self.export_value, universe_map_dispatch)(x)
         else:
             return x
 
@@ -62,15 +69,27 @@ standard_pipeline = UniversePipelineGenerator(
 )
 
 
+# Inference runs after the conversion to IRGraphs and again after the
+# optimizations, reusing what it found the first time.
+inference_pass = InferencePass()
+
+
 standard_configuration = dict(
     sy_object_map = object_map,
     vm_primitives = impl_bank['interp'],
+    vm_inplace_primitives = impl_bank['inplace'],
     irg_duplicate = True,
-    irg_passes = [ResolveGlobalsPass()],
+    irg_passes = [ResolveGlobalsPass(), inference_pass],
     opt_passes = [
         EquilibriumPass(
-            drop_copy
-        )
+            *rules('structural', 'arithmetic', 'inverses', 'zero',
+                   'constants', 'calls')
+        ),
+        TupleFlatteningPass(),
+        LoopInvariantPass(),
+        DotChainPass(),
+        ElementwiseFusionPass(),
+        inference_pass
     ]
 )
 
@@ -79,27 +98,187 @@ standard_universe = standard_pipeline \
     .get_universes(**standard_configuration)['full']
 
 
+# Configuration to evaluate functions on Dual numbers, for forward
+# mode. Fused elementwise operations have no tangent rule, and the
+# arguments of primitives may not be overwritten since they may be
+# shared by Dual numbers.
+jvp_configuration = dict(
+    standard_configuration,
+    vm_primitives = impl_bank['jvp'],
+    vm_inplace_primitives = {},
+    opt_passes = [p for p in standard_configuration['opt_passes']
+                  if not isinstance(p, ElementwiseFusionPass)]
+)
+
+
+# Configuration to run backpropagators on Batch sensitivities. The
+# sensitivities may not be overwritten since a Batch is not an array.
+batch_configuration = dict(
+    standard_configuration,
+    vm_primitives = impl_bank['batch'],
+    vm_inplace_primitives = {}
+)
+
+
+# Passes run on the versions of a MyiaFunction that are specialized
+# for the shapes of their arguments.
+standard_specialization_passes = [
+    inference_pass,
+    StaticDotChainPass()
+]
+
+
+def arg_signature(arg, shape_buckets=None):
+    """
+    Return a cheap, hashable description of an argument's type. For
+    arrays, this includes their dtype and shape, with each dimension
+    mapped through ``shape_buckets`` if it is given.
+    """
+    t = type(arg)
+    if t is numpy.ndarray:
+        shape = arg.shape
+        if shape_buckets:
+            shape = tuple(map(shape_buckets, shape))
+        return (t, arg.dtype, shape)
+    elif t is tuple or t is list:
+        return (t, tuple(arg_signature(x, shape_buckets) for x in arg))
+    else:
+        return t
+
+
 class MyiaFunction:
-    def __init__(self, fn, **options):
+    """
+    Compiled version of a Python function.
+
+    The function is specialized for each signature of its arguments
+    (see ``arg_signature``): the graph of each version knows the
+    shapes of the arrays it is given, which permits further
+    optimizations. Once ``max_specializations`` versions exist,
+    calls with a new signature use the generic version.
+
+    Arguments:
+        fn: The function to compile.
+        max_specializations: Maximal number of specialized versions.
+        shape_buckets: If given, a function that maps each dimension
+            of an array to a bucket. Arrays with dimensions in the
+            same buckets share a version, which then does not know
+            their exact shape.
+        specialization_passes: The passes to run on the graph of each
+            specialized version.
+        memory_budget: If given, the gradients the function computes,
+            e.g. through ``grad1``, keep the intermediate results of
+            at most this many function applications at a time, and
+            recompute the others (see ``Grad``). This is a number of
+            nodes, not of bytes. Same as the ``vm_memory_budget``
+            option.
+        options: Configuration of ``standard_pipeline``.
+    """
+    def __init__(self, fn,
+                 max_specializations=16,
+                 shape_buckets=None,
+                 specialization_passes=standard_specialization_passes,
+                 memory_budget=None,
+                 **options):
         self.fn = fn
         self.mfn = None
+        if memory_budget is not None:
+            options['vm_memory_budget'] = memory_budget
         self.options = {**standard_configuration, **options}
         self.universe = None
+        self.max_specializations = max_specializations
+        self.shape_buckets = shape_buckets
+        self.specialization_passes = specialization_passes
+        self.specializations = {}
         self.__myia_base__ = fn
 
-    def __call__(self, *args):
-        if not self.universe:
+    def compile(self):
+        """
+        Compile the generic version of the function, if it was not
+        already compiled, and return it.
+        """
+        if not self.mfn:
             self.universe = standard_pipeline \
                 .get_universes(**self.options)['full']
-        if not self.mfn:
             self.mfn = self.universe[self.fn]
-        assert isinstance(self.mfn, CallableVMFunction)
-        return self.mfn(*args)
+            assert isinstance(self.mfn, CallableVMFunction)
+        return self.mfn
+
+    def __call__(self, *args):
+        self.compile()
+        key = tuple(arg_signature(arg, self.shape_buckets) for arg in args)
+        spec = self.specializations.get(key, None)
+        if spec is None:
+            if len(self.specializations) < self.max_specializations:
+                spec = self.specialize_signature(key)
+                self.specializations[key] = spec
+            else:
+                spec = self.mfn
+        return spec(*args)
+
+    def specialize_signature(self, key):
+        """
+        Create a version of the function specialized for arguments
+        with the given signatures.
+        """
+        orig = self.mfn.vmf.graph
+        if len(key) != len(orig.inputs):
+            # Let the generic version report the error.
+            return self.mfn
+        graph, inputs, _ = orig.dup(no_mangle=True)
+        graph.lbda = orig.lbda
+        for inp, sig in zip(inputs, key):
+            if isinstance(sig, tuple) and sig[0] is numpy.ndarray:
+                _, dtype, shape = sig
+                if self.shape_buckets:
+                    shape = (None,) * len(shape)
+                inp.inferred.update(dtype=dtype, shape=shape)
+        opt = self.universe.universes['opt']
+        for passs in self.specialization_passes:
+            passs(opt, graph)
+        vmu = self.mfn.vm_universe
+        return CallableVMFunction(VMFunction(graph, vmu), vmu,
+                                  self.mfn.eval_universe)
+
+    def specialize(self, max_unroll=64, **constants):
+        """
+        Return a version of the function where the arguments named in
+        ``constants`` are bound to the given values, and which takes
+        the other arguments, in order.
+
+        The graph is simplified given these constants (constant
+        folding, elimination of switches on constant conditions,
+        unrolling of loops, see ``PartialEvaluationPass``). It is
+        compiled once.
+
+        Arguments:
+            max_unroll: Maximal number of loop iterations to unroll.
+            constants: The values of the arguments to bind.
+        """
+        mfn = self.compile()
+        orig = mfn.vmf.graph
+        names = mfn.argnames
+        for name in constants:
+            if name not in names:
+                raise TypeError(f"{self.fn.__name__}() has no argument"
+                                f" named '{name}'")
+        graph, inputs, _ = orig.dup(no_mangle=True)
+        graph.lbda = orig.lbda
+        for name, inp in zip(names, inputs):
+            if name in constants:
+                inp.redirect(IRNode(None, inp.tag, constants[name]))
+        graph.inputs = tuple(inp for name, inp in zip(names, inputs)
+                             if name not in constants)
+        PartialEvaluationPass(max_unroll)(self.universe.universes['opt'],
+                                          graph)
+        vmu = mfn.vm_universe
+        return CallableVMFunction(VMFunction(graph, vmu), vmu,
+                                  mfn.eval_universe)
 
     def configure(self, **config):
         self.options = {**self.options, **config}
         self.mfn = None
         self.universe = None
+        self.specializations = {}
 
 
 def myia(fn, **options):
@@ -108,3 +287,136 @@ def myia(fn, **options):
 
 def compile(node):
     return standard_universe[node]
+
+
+def zero_if_none(x):
+    return ZERO if x is None else x
+
+
+def tangent_value(x):
+    """
+    Return the tangent of x, which may contain Dual numbers, with
+    zeros where it has none.
+    """
+    primal, tangent = dual_split(x)
+    if tangent is ZERO:
+        return numpy.zeros_like(primal) \
+            if isinstance(primal, numpy.ndarray) else 0
+    elif isinstance(primal, tuple):
+        return tuple(map(tangent_value, dual_join(primal, tangent)))
+    elif isinstance(primal, Record):
+        return Record(primal.__tag__,
+                      {k: tangent_value(v)
+                       for k, v in dual_join(primal, tangent)})
+    else:
+        return tangent
+
+
+def jvp(fn, **options):
+    """
+    Return a function that computes the output of fn along with its
+    derivative in the direction of some tangents, that is to say the
+    product of its Jacobian with the tangents:
+
+        value, tangent = jvp(fn)(args, tangents)
+
+    The derivative is computed in forward mode, by evaluating fn on
+    Dual numbers. ``tangents`` has one element per argument, which
+    may be None for an argument that stays constant.
+    """
+    mfn = myia(fn, **{**jvp_configuration, **options})
+
+    def jvp_fn(args, tangents):
+        out = mfn(*map(dual_join, args, map(zero_if_none, tangents)))
+        return dual_split(out)[0], tangent_value(out)
+    return jvp_fn
+
+
+def compile_grad(fn, configuration, memory_budget, options):
+    """
+    Return the Grad transform of fn, with the given memory_budget,
+    compiled by ``standard_pipeline`` with the given configuration
+    and options.
+    """
+    lbda = parse_function(fn)
+    glbda = Grad(lbda.ref, a_normal(lbda),
+                 memory_budget=memory_budget).transform()
+    if memory_budget is not None:
+        options = {**options, 'vm_memory_budget': memory_budget}
+    universe = standard_pipeline \
+        .get_universes(**{**configuration, **options})['full']
+    return universe[glbda]
+
+
+def hvp(fn, memory_budget=None, **options):
+    """
+    Return a function that computes the product of the Hessian of fn,
+    which must return a scalar, with vectors:
+
+        hvs = hvp(fn)(args, vectors)
+
+    ``hvs`` has one element per argument. It is computed in forward
+    mode over the reverse mode gradient of fn, which only costs a
+    small constant times the gradient itself. That gradient is
+    computed with the given memory_budget, a number of function
+    applications (see ``Grad``).
+    """
+    gfn = compile_grad(fn, jvp_configuration, memory_budget, options)
+
+    def hvp_fn(args, vectors):
+        _, bprop = gfn(*map(dual_join, args, map(zero_if_none, vectors)))
+        _, *grads = bprop(1.0)
+        return tuple(map(tangent_value, grads))
+    return hvp_fn
+
+
+def batch_jacobian(sen, x, out_shape):
+    """
+    Return the Jacobian wrt x, of shape ``out_shape + shape(x)``, from
+    the gradient sen that was computed for a Batch of sensitivities
+    with one row per element of the output (a tuple of Jacobians if x
+    is a tuple). Parts of sen that are not Batches do not depend on
+    the sensitivities: they are zeros.
+    """
+    if isinstance(x, tuple):
+        if not isinstance(sen, tuple):
+            sen = (sen,) * len(x)
+        return tuple(batch_jacobian(s, y, out_shape) for s, y in zip(sen, x))
+    shp = numpy.shape(x)
+    if isinstance(sen, Batch):
+        # The gradient of an argument that was broadcast has the
+        # shape it was broadcast to, so it is fit to the shape of x.
+        rows = impl_bank['batch'][builtins.fit](sen, shp).values
+        return rows.reshape(out_shape + shp)
+    return numpy.zeros(out_shape + shp)
+
+
+def jacrev(fn, memory_budget=None, **options):
+    """
+    Return a function that computes the Jacobians of fn, which must
+    return a scalar or an array, with respect to each of its
+    arguments:
+
+        jacs = jacrev(fn)(*args)
+
+    ``jacs`` has one element per argument, of shape
+    ``shape(out) + shape(arg)`` (a tuple of them for a tuple
+    argument). They are computed in reverse mode by a single call to
+    the backpropagator of fn, on a Batch of sensitivities: the rows
+    of the identity matrix, one per element of the output. fn is
+    differentiated with the given memory_budget, a number of function
+    applications (see ``Grad``).
+    """
+    gfn = compile_grad(fn, batch_configuration, memory_budget, options)
+
+    def jacrev_fn(*args):
+        out, bprop = gfn(*args)
+        out_shape = numpy.shape(out)
+        n = int(numpy.prod(out_shape))
+        _, *grads = bprop(Batch(numpy.eye(n).reshape((n, *out_shape))))
+        return tuple(batch_jacobian(g, x, out_shape)
+                     for g, x in zip(grads, args))
+    return jacrev_fn
+
+
+jacobian = jacrev
@@ -2,9 +2,9 @@
 
 from .main import symbol_associator, impl_bank
 from ..inference.avm import Fork, WrappedException, \
-    AbstractValue, unwrap_abstract
+    AbstractValue, Interval, to_interval, unwrap_abstract
 from .flow_all import ANY, VALUE, ERROR
-from ..inference.types import typeof, type_map, Tuple
+from ..inference.types import typeof, type_map, Tuple, Int64
 from ..interpret import Primitive
 from itertools import product
 
@@ -113,6 +113,8 @@ def abstract_dot(x, y):
 
 @std_aimpl
 def abstract_index(xs, idx):
+    if isinstance(idx, Interval):
+        return ANY
     return xs[idx]
 
 
@@ -137,6 +139,8 @@ def abstract_less(x, y):
 @std_aimpl
 def abstract_type(x):
     t = type(x)
+    if t is Interval:
+        return Int64
     res = type_map.get(type(x), None)
     if res:
         return res
@@ -164,6 +168,11 @@ def abstract_print(x):
 
 @std_aimpl
 def abstract_equal(x, y):
+    if isinstance(x, Interval) or isinstance(y, Interval):
+        x, y = to_interval(x), to_interval(y)
+        if x.hi < y.lo or y.hi < x.lo:
+            return False
+        return ANY
     return x == y
 
 
@@ -1,16 +1,21 @@
 
-from typing import List, Any, Union, Callable, Dict
+from typing import List, Any, Union, Callable, Dict, Iterable, \
+    Tuple as TupleT
+import numpy
+import pickle
 from .main import symbol_associator, impl_bank
 from ..stx import Symbol, ApplyNode as Apply, ClosureNode, \
     LambdaNode, TupleNode, GenSym, BPROP, JTAG, create_lambda, \
     python_universe
-from ..symbols import inst_builtin
+from ..symbols import builtins, inst_builtin
 from ..parse import parse_function
 from .impl_interp import zeros_like, J, Jinv, switch, first, second, \
     Closure, closure_fn, closure_args, reduce, add, exp, log, transpose, \
-    broadcast, shape, fit, setslice
+    broadcast, shape, fit, setslice, multi_dot, fused, fused_eval_generic, \
+    sparse, index, concat, myiaClosure
 from ..transform.grad import ggen, grad_computers
-from ..lib import Primitive
+from ..lib import Primitive, StructuralMap, Dual, Sparse, Batch, Record, \
+    ZERO, ndarray_map
 
 
 _ = True
@@ -38,6 +43,67 @@ def macro_grad_for(sym, nargs_closure):
     return macro_grad
 
 
+# The Python functions that define the backpropagators of the
+# primitives (see ``impl_bprop``).
+bprop_functions: Dict[Symbol, Callable] = {}
+
+# The backpropagators of the primitives, compiled from
+# bprop_functions, by (primitive, nargs_closure). They are compiled
+# the first time they are used, unless they were loaded by
+# ``load_bprops``.
+bprop_lambdas: Dict[TupleT[Symbol, int], LambdaNode] = {}
+
+
+# The implementations of the primitives whose names are also Python
+# builtins, for the tangent rules.
+interp_map = impl_bank['interp'][builtins.map]
+interp_getattr = impl_bank['interp'][builtins.getattr]
+interp_setattr = impl_bank['interp'][builtins.setattr]
+
+
+def bprop_lambda(sym: Symbol, nargs_closure: int) -> LambdaNode:
+    """
+    Return the backpropagator of the primitive sym, compiling it if
+    needed.
+    """
+    key = (sym, nargs_closure)
+    if key not in bprop_lambdas:
+        # We compile the backpropagator using Myia. We provide
+        # the GRAD macro which will account for nargs_closure
+        # stored arguments.
+        bprop_lambdas[key] = parse_function(
+            bprop_functions[sym],
+            macros={'GRAD': macro_grad_for(sym, nargs_closure)}
+        )
+    return bprop_lambdas[key]
+
+
+def save_bprops(file, nargs_closure: Iterable[int] = (0,)) -> None:
+    """
+    Compile the backpropagators of all primitives for each of the
+    given numbers of closure arguments, and pickle them into file.
+    Processes that call ``load_bprops`` on that file then do not
+    need to compile them.
+    """
+    pickle.dump({(sym, n): bprop_lambda(sym, n)
+                 for sym in bprop_functions
+                 for n in nargs_closure}, file)
+
+
+def load_bprops(file) -> None:
+    """
+    Load the backpropagators saved by ``save_bprops`` in file. It
+    should come from a trusted source, since it is unpickled. Only
+    the backpropagators that were not used yet are replaced.
+    """
+    # The globals the backpropagators refer to are resolved in the
+    # modules that define them.
+    for fn in bprop_functions.values():
+        python_universe.acquire(fn)
+    for key, lbda in pickle.load(file).items():
+        bprop_lambdas.setdefault(key, lbda)
+
+
 @symbol_associator('bprop')
 def impl_bprop(sym, name, orig_fn: Callable) -> Callable:
     """
@@ -54,12 +120,16 @@ def impl_bprop(sym, name, orig_fn: Callable) -> Callable:
     are part of a partial application.
 
     Refer to the previous section on Partial Application.
+
+    The backpropagator is only compiled when it is first used (see
+    ``bprop_lambda``).
     """
 
     # This is the implementation for the forward pass
     root_globals = impl_bank['interp']
     prim = root_globals[sym]
     assert isinstance(prim, Primitive)
+    bprop_functions[sym] = orig_fn
 
     def mkgrad(nargs_closure: int) -> LambdaNode:
         # Copy symbol to grad namespace
@@ -68,14 +138,6 @@ def impl_bprop(sym, name, orig_fn: Callable) -> Callable:
                            namespace='global::builtin_bprop',
                            relation=BPROP)
 
-        # We compile the backpropagator using Myia. We provide
-        # the GRAD macro which will account for nargs_closure
-        # stored arguments.
-        lbda = parse_function(
-            orig_fn,
-            macros={'GRAD': macro_grad_for(sym, nargs_closure)}
-        )
-
         # Now we generate a combined function that returns the
         # result of the forward pass along with a backpropagator
         # function.
@@ -90,7 +152,9 @@ def impl_bprop(sym, name, orig_fn: Callable) -> Callable:
         augm_sym = ggen(sym, JTAG)
         ast = create_lambda(augm_sym, args, TupleNode([forward, backward]), G)
         ast.primal = sym
-        python_universe.associate(bprop_sym, lbda)
+        python_universe.associate_lazy(
+            bprop_sym, lambda: bprop_lambda(sym, nargs_closure)
+        )
         return ast
 
     grad_computers[sym] = mkgrad
@@ -98,6 +162,122 @@ def impl_bprop(sym, name, orig_fn: Callable) -> Callable:
     return orig_fn
 
 
+def dual_split(x):
+    """
+    Split x, which may contain Dual numbers, into its primal value and
+    its tangent. The tangent is ZERO if x contains no Dual numbers.
+
+    The tangent of a tuple, Record or Closure has the same structure,
+    e.g. ``Closure(dfn, dargs)``, with ZERO for the parts that have no
+    Dual numbers.
+    """
+    if isinstance(x, Dual):
+        return x.primal, x.tangent
+    elif isinstance(x, tuple):
+        primals, tangents = zip(*map(dual_split, x)) if x else ((), ())
+        if all(t is ZERO for t in tangents):
+            return tuple(primals), ZERO
+        return tuple(primals), tuple(tangents)
+    elif isinstance(x, Record):
+        keys = [k for k, _ in x]
+        primals, tangents = zip(*[dual_split(v) for _, v in x]) \
+            if keys else ((), ())
+        primal = Record(x.__tag__, dict(zip(keys, primals)))
+        if all(t is ZERO for t in tangents):
+            return primal, ZERO
+        return primal, Record(x.__tag__, dict(zip(keys, tangents)))
+    elif isinstance(x, myiaClosure):
+        fn, dfn = dual_split(x.fn)
+        args, dargs = dual_split(x.args)
+        if dfn is ZERO and dargs is ZERO:
+            return myiaClosure(fn, args), ZERO
+        if dargs is ZERO:
+            dargs = (ZERO,) * len(args)
+        return myiaClosure(fn, args), myiaClosure(dfn, dargs)
+    else:
+        return x, ZERO
+
+
+def dual_join(x, dx):
+    """
+    Inverse of ``dual_split``. The tangent of a tuple or a Record may
+    also be Sparse (see ``tangent_setslice``).
+    """
+    if dx is ZERO:
+        return x
+    elif isinstance(x, tuple):
+        if isinstance(dx, Sparse):
+            dx = dx.normalized(add, len(x))
+        return tuple(dual_join(y, dx[i]) for i, y in enumerate(x))
+    elif isinstance(x, Record):
+        return Record(x.__tag__, {k: dual_join(v, dx[k]) for k, v in x})
+    elif isinstance(x, myiaClosure):
+        return myiaClosure(dual_join(x.fn, dx.fn),
+                           dual_join(x.args, dx.args))
+    else:
+        return Dual(x, dx)
+
+
+def dual_ndarray_map(smap, *arrs):
+    # An array that is paired with a Dual is treated as a whole, both
+    # because it is faster and because numpy.vectorize would try to
+    # take the Dual apart.
+    if any(isinstance(a, Dual) for a in arrs):
+        return smap.fn(*arrs)
+    return ndarray_map(smap, *arrs)
+
+
+def dual_fn(fn, rule):
+    """
+    Wrap fn so that it accepts Dual numbers, using the tangent rule
+    to compute the tangent of the result.
+    """
+    def jvp(*args):
+        if not any(isinstance(a, (Dual, tuple, Record, myiaClosure))
+                   for a in args):
+            return fn(*args)
+        primals, tangents = zip(*map(dual_split, args))
+        out = fn(*primals)
+        dout = ZERO
+        for linear, dx in zip(rule(*primals), tangents):
+            if linear is not None and dx is not ZERO:
+                dout = add(dout, linear(dx))
+        return dual_join(out, dout)
+    return jvp
+
+
+@symbol_associator('tangent')
+def impl_tangent(sym, name, orig_fn: Callable) -> Callable:
+    """
+    Decorator to declare the tangent rule of a primitive, for forward
+    mode. For instance, for builtins.whatever, write:
+
+        @impl_tangent
+        def tangent_whatever(x, y):
+            return (lambda dx: ..., lambda dy: ...)
+
+    The rule is given the primal arguments. It returns, for each of
+    them, a linear function that maps its tangent to its contribution
+    to the tangent of the result, or None if the result does not
+    depend on it. A contribution may be ZERO.
+
+    The primitive of ``impl_bank['jvp']`` for the symbol propagates
+    Dual numbers using the rule. Primitives that have no rule, e.g.
+    ``mktuple``, only move Dual numbers around as they are.
+    """
+    fn = impl_bank['interp'][sym].fn
+    if isinstance(fn, StructuralMap):
+        dispatch = {**fn.dispatch, numpy.ndarray: dual_ndarray_map}
+        # The leaves are given to the whole structural map, since it
+        # may not handle arrays itself.
+        jfn = StructuralMap(dual_fn(fn, orig_fn), dispatch)
+    else:
+        jfn = dual_fn(fn, orig_fn)
+    impl_bank['tangent'][sym] = orig_fn
+    impl_bank['jvp'][sym] = Primitive(jfn, name=sym)
+    return orig_fn
+
+
 ###########################################
 # Gradients of primitives needed for Grad #
 ###########################################
@@ -105,7 +285,23 @@ def impl_bprop(sym, name, orig_fn: Callable) -> Callable:
 
 @impl_bprop
 def bprop_zeros_like(x, d):
-    return GRAD(zeros_like(x))
+    return GRAD(ZERO)
+
+
+@impl_tangent
+def tangent_zeros_like(x):
+    return (None,)
+
+
+@impl_bprop
+def bprop_fill_zeros(sen, x, d):
+    # The elements that are filled are constant.
+    return GRAD(d, ZERO)
+
+
+@impl_tangent
+def tangent_fill_zeros(sen, x):
+    return (lambda dsen: dsen, None)
 
 
 @impl_bprop
@@ -113,11 +309,21 @@ def bprop_J(x, d):
     return GRAD(Jinv(d))
 
 
+@impl_tangent
+def tangent_J(x):
+    return (lambda dx: dx,)
+
+
 @impl_bprop
 def bprop_Jinv(x, d):
     return GRAD(J(d))
 
 
+@impl_tangent
+def tangent_Jinv(x):
+    return (lambda dx: dx,)
+
+
 ######################################
 # Gradients of arithmetic primitives #
 ######################################
@@ -130,21 +336,45 @@ def bprop_add(x, y, dz):
     return GRAD(dz, dz)
 
 
+@impl_tangent
+def tangent_add(x, y):
+    return (lambda dx: dx,
+            lambda dy: dy)
+
+
 @impl_bprop
 def bprop_subtract(x, y, dz):
     return GRAD(dz, -dz)
 
 
+@impl_tangent
+def tangent_subtract(x, y):
+    return (lambda dx: dx,
+            lambda dy: -dy)
+
+
 @impl_bprop
 def bprop_multiply(x, y, dz):
     return GRAD(dz * y, dz * x)
 
 
+@impl_tangent
+def tangent_multiply(x, y):
+    return (lambda dx: dx * y,
+            lambda dy: x * dy)
+
+
 @impl_bprop
 def bprop_divide(x, y, dz):
     return GRAD(dz / y, -dz * x / (y * y))
 
 
+@impl_tangent
+def tangent_divide(x, y):
+    return (lambda dx: dx / y,
+            lambda dy: -dy * x / (y * y))
+
+
 @impl_bprop
 def bprop_power(x, y, dz):
     # Note: this will often give a warning because the second element
@@ -155,31 +385,73 @@ def bprop_power(x, y, dz):
                 dz * log(x) * x ** y)
 
 
+@impl_tangent
+def tangent_power(x, y):
+    # Unlike in the backward pass, the derivative wrt y is only
+    # computed when y has a tangent.
+    return (lambda dx: dx * y * x ** (y - 1),
+            lambda dy: dy * numpy.log(x) * x ** y)
+
+
 @impl_bprop
 def bprop_unary_subtract(x, dz):
     return GRAD(-dz)
 
 
+@impl_tangent
+def tangent_unary_subtract(x):
+    return (lambda dx: -dx,)
+
+
 @impl_bprop
 def bprop_dot(x, y, dz):
     return GRAD(dz @ transpose(y), transpose(x) @ dz)
 
 
+@impl_tangent
+def tangent_dot(x, y):
+    return (lambda dx: dx @ y,
+            lambda dy: x @ dy)
+
+
+@impl_tangent
+def tangent_multi_dot(tree, *xs):
+    # The product is linear in each of its operands.
+    def linear(i):
+        return lambda dx: multi_dot(tree, *xs[:i], dx, *xs[i + 1:])
+    return (None, *[linear(i) for i in range(len(xs))])
+
+
 @impl_bprop
 def bprop_transpose(x, dz):
     return GRAD(transpose(dz))
 
 
+@impl_tangent
+def tangent_transpose(x):
+    return (lambda dx: transpose(dx),)
+
+
 @impl_bprop
 def bprop_exp(x, dz):
     return GRAD(dz * exp(x))
 
 
+@impl_tangent
+def tangent_exp(x):
+    return (lambda dx: dx * numpy.exp(x),)
+
+
 @impl_bprop
 def bprop_log(x, dz):
     return GRAD(dz / x)
 
 
+@impl_tangent
+def tangent_log(x):
+    return (lambda dx: dx / x,)
+
+
 @impl_bprop
 def bprop_sum(xs, dz):
     _, bdz = broadcast((xs, dz))
@@ -187,17 +459,39 @@ def bprop_sum(xs, dz):
     # return GRAD(zeros_like(xs) + dz)
 
 
+@impl_tangent
+def tangent_sum(xs):
+    return (lambda dxs: numpy.sum(dxs),)
+
+
+@impl_tangent
+def tangent_broadcast(arrs):
+    shp = numpy.broadcast(*arrs).shape
+    return (lambda darrs: tuple(ZERO if d is ZERO
+                                else numpy.broadcast_to(d, shp)
+                                for d in darrs),)
+
+
 @impl_bprop
 def bprop_shape(arr, dz):
     # TODO: We should mark this kind of gradient somehow to indicate that
     # it's nonsensical.
-    return GRAD(zeros_like(arr))
+    return GRAD(ZERO)
+
+
+@impl_tangent
+def tangent_shape(arr):
+    return (None,)
 
 
 @impl_bprop
 def bprop_fit(arr, shp, dz):
-    return GRAD(fit(dz, shape(arr)),
-                zeros_like(shp))
+    return GRAD(fit(dz, shape(arr)), ZERO)
+
+
+@impl_tangent
+def tangent_fit(arr, shp):
+    return (lambda darr: fit(darr, shp), None)
 
 
 ###################################################
@@ -210,35 +504,46 @@ def bprop_equal(x, y, dz):
     return GRAD(False, False)
 
 
+@impl_tangent
+def tangent_equal(x, y):
+    return (None, None)
+
+
 @impl_bprop
 def bprop_greater(x, y, dz):
     return GRAD(False, False)
 
 
+@impl_tangent
+def tangent_greater(x, y):
+    return (None, None)
+
+
 @impl_bprop
 def bprop_less(x, y, dz):
     return GRAD(False, False)
 
 
+@impl_tangent
+def tangent_less(x, y):
+    return (None, None)
+
+
 @impl_bprop
 def bprop_switch(c, t, f, dz):
-    # There's a subtlety here, which is that we must return
-    # appropriately-sized gradients for each argument. This
-    # requires the use of zeros_like to match input shapes.
-    # TODO: zeros_like shouldn't be needed for the condition
-    # if it is always boolean (as it should be).
+    # The branch that is not taken gets a symbolic ZERO, which Grad
+    # only makes conformant with it if it reaches a function boundary.
     if c:
-        return GRAD(
-            zeros_like(Jinv(c)),  # False
-            dz,
-            zeros_like(Jinv(f))
-        )
+        return GRAD(ZERO, dz, ZERO)
     else:
-        return GRAD(
-            zeros_like(Jinv(c)),  # False
-            zeros_like(Jinv(t)),
-            dz
-        )
+        return GRAD(ZERO, ZERO, dz)
+
+
+@impl_tangent
+def tangent_switch(c, t, f):
+    return (None,
+            lambda dt: dt if c else ZERO,
+            lambda df: ZERO if c else df)
 
 
 @impl_bprop
@@ -246,42 +551,163 @@ def bprop_identity(v, dz):
     return GRAD(dz)
 
 
+@impl_tangent
+def tangent_identity(v):
+    return (lambda dv: dv,)
+
+
 #################################
 # Gradients of other primitives #
 #################################
 
 
+def tangent_of_call(fn, *args):
+    # Tangent of fn(*args), where the arguments may contain Dual
+    # numbers. This is how the tangent rules of the primitives that
+    # call functions, like map, find the contribution of each
+    # argument: the function propagates the Dual numbers itself.
+    return dual_split(fn(*args))[1]
+
+
+@impl_bprop
+def bprop_checkpoint(fn, x, dz):
+    # fn and x are J-transformed, so this performs the forward pass of
+    # fn again, this time keeping its intermediate results.
+    _, bprop = fn(x)
+    d = bprop(dz)
+    return GRAD(d[0], d[1])
+
+
+@impl_tangent
+def tangent_checkpoint(fn, x):
+    return (lambda dfn: tangent_of_call(dual_join(fn, dfn), x),
+            lambda dx: tangent_of_call(fn, dual_join(x, dx)))
+
+
 @impl_bprop
 def bprop_Closure(fn, args, dz):
     return GRAD(closure_fn(dz), closure_args(dz))
 
 
+@impl_tangent
+def tangent_Closure(fn, args):
+    return (lambda dfn: myiaClosure(dfn, (ZERO,) * len(args)),
+            lambda dargs: myiaClosure(ZERO, dargs))
+
+
 @impl_bprop
 def bprop_closure_fn(clos, dz):
     return GRAD(Closure(dz, Jinv(zeros_like(closure_args(clos)))))
 
 
+@impl_tangent
+def tangent_closure_fn(clos):
+    return (lambda dclos: dclos.fn,)
+
+
 @impl_bprop
 def bprop_closure_args(clos, dz):
     return GRAD(Closure(Jinv(closure_fn(clos)), dz))
 
 
+@impl_tangent
+def tangent_closure_args(clos):
+    return (lambda dclos: dclos.args,)
+
+
+@impl_tangent
+def tangent_partial(fn, *args):
+    def linear(i):
+        return lambda darg: myiaClosure(
+            ZERO, tuple(darg if i == j else ZERO for j in range(len(args)))
+        )
+    return (lambda dfn: myiaClosure(dfn, (ZERO,) * len(args)),
+            *[linear(i) for i in range(len(args))])
+
+
+def tuple_index(tup, idx):
+    """
+    Return idx as a non-negative index if tup is a tuple, e.g. 2
+    instead of -1 for a tuple of length 3. The keys of Sparse
+    sensitivities are kept non-negative this way, since a Sparse
+    does not know the length of its tuple.
+    """
+    if isinstance(tup, (tuple, list)) and idx < 0:
+        return idx + len(tup)
+    return idx
+
+
 @impl_bprop
 def bprop_index(tup, idx, dz):
-    rval = zeros_like(tup)
-    rval[idx] = dz
-    return GRAD(rval, 0)
+    # See tuple_index
+    if idx < 0:
+        return GRAD(sparse(idx + len(tup), dz), 0)
+    else:
+        return GRAD(sparse(idx, dz), 0)
+
+
+@impl_tangent
+def tangent_index(tup, idx):
+    # Arrays are indexed like their tangent, and tuples give the
+    # tangent of the element, which may be ZERO.
+    idx = tuple_index(tup, idx)
+    return (lambda dtup: index(dtup, idx), None)
+
+
+@impl_tangent
+def tangent_first(tup):
+    return (lambda dtup: index(dtup, 0),)
+
+
+@impl_tangent
+def tangent_second(tup):
+    return (lambda dtup: index(dtup, 1),)
 
 
 @impl_bprop
 def bprop_setslice(tup, idx, value, dz):
-    dtup = setslice(dz, idx, zeros_like(tup[idx]))
-    return GRAD(dtup, 0, dz[idx])
+    # See tuple_index
+    if idx < 0:
+        i = idx + len(tup)
+    else:
+        i = idx
+    return GRAD(setslice(dz, i, ZERO), 0, dz[i])
+
+
+@impl_tangent
+def tangent_setslice(tup, idx, value):
+    idx = tuple_index(tup, idx)
+    return (lambda dtup: setslice(dtup, idx, ZERO),
+            None,
+            lambda dvalue: sparse(idx, dvalue))
+
+
+@impl_tangent
+def tangent_concat(*xs):
+    def linear(i):
+        return lambda dx: concat(*[dx if i == j else (ZERO,) * len(x)
+                                   for j, x in enumerate(xs)])
+    return tuple(linear(i) for i in range(len(xs)))
+
+
+@impl_bprop
+def bprop_sparse(key, value, dz):
+    return GRAD(ZERO, dz[key])
+
+
+@impl_tangent
+def tangent_sparse(key, value):
+    return (None, lambda dvalue: Sparse({key: dvalue}))
 
 
 @impl_bprop
 def bprop_len(xs, dz):
-    return GRAD(zeros_like(Jinv(xs)))
+    return GRAD(ZERO)
+
+
+@impl_tangent
+def tangent_len(xs):
+    return (None,)
 
 
 @impl_bprop
@@ -289,6 +715,17 @@ def bprop_range(n, dz):
     return GRAD(0)
 
 
+@impl_tangent
+def tangent_range(n):
+    return (None,)
+
+
+@impl_tangent
+def tangent_reduce(f, xs):
+    return (lambda df: tangent_of_call(reduce, dual_join(f, df), xs),
+            lambda dxs: tangent_of_call(reduce, f, dual_join(xs, dxs)))
+
+
 @impl_bprop
 def bprop_map(f, xs, dz):
     # I... think that's right?
@@ -304,19 +741,266 @@ def bprop_map(f, xs, dz):
     return GRAD(df, dxs)
 
 
+@impl_tangent
+def tangent_map(f, xs):
+    return (lambda df: tangent_of_call(interp_map, dual_join(f, df), xs),
+            lambda dxs: tangent_of_call(interp_map, f, dual_join(xs, dxs)))
+
+
 @impl_bprop
 def bprop_enumerate(xs, dz):
     return GRAD(map(second, dz))
 
 
+@impl_tangent
+def tangent_enumerate(xs):
+    # The indexes are constant.
+    return (lambda dxs: type(xs)((ZERO, index(dxs, i))
+                                 for i in range(len(xs))),)
+
+
 @impl_bprop
 def bprop_getattr(rec, field, dz):
-    rval = zeros_like(Jinv(rec))
-    rval = setattr(rval, field, dz)
-    return GRAD(rval, 0)
+    return GRAD(sparse(field, dz), 0)
+
+
+@impl_tangent
+def tangent_getattr(rec, field):
+    return (lambda drec: interp_getattr(drec, field), None)
 
 
 @impl_bprop
 def bprop_setattr(rec, field, value, dz):
-    drec = setattr(dz, field, zeros_like(getattr(rec, field)))
+    drec = setattr(dz, field, ZERO)
     return GRAD(drec, 0, getattr(dz, field))
+
+
+@impl_tangent
+def tangent_setattr(rec, field, value):
+    return (lambda drec: interp_setattr(drec, field, ZERO),
+            None,
+            lambda dvalue: sparse(field, dvalue))
+
+
+def jvp_fused(tree, *xs):
+    # Fused expressions are evaluated operation by operation on Dual
+    # numbers, using the tangent rules of the elementwise primitives.
+    if any(isinstance(x, Dual) for x in xs):
+        return fused_eval_generic(tree, xs, 'jvp')
+    else:
+        return fused(tree, *xs)
+
+
+impl_bank['jvp'][builtins.fused] = Primitive(jvp_fused, name=builtins.fused)
+
+
+# Primitives without a tangent rule propagate Dual numbers as they are.
+for _sym, _prim in impl_bank['interp'].items():
+    impl_bank['jvp'].setdefault(_sym, _prim)
+
+
+###########################
+# Batched backpropagation #
+###########################
+
+
+def batch_align(args, ndim=0):
+    """
+    Return the values of the Batches in args, with singleton axes
+    inserted after the batch axis so that each value has as many
+    dimensions as the other arguments, and at least ndim. The other
+    arguments are returned as they are: they broadcast against each
+    value of the Batches.
+    """
+    ndim = max(ndim, *[a.values.ndim - 1 if isinstance(a, Batch)
+                       else numpy.ndim(a) for a in args])
+    return [a.values.reshape(a.values.shape[:1]
+                             + (1,) * (ndim + 1 - a.values.ndim)
+                             + a.values.shape[1:])
+            if isinstance(a, Batch) else a
+            for a in args]
+
+
+def batch_ndarray_map(smap, *arrs):
+    # An array that is paired with a Batch is treated as a whole.
+    if any(isinstance(a, Batch) for a in arrs):
+        return smap.fn(*arrs)
+    return ndarray_map(smap, *arrs)
+
+
+def has_batch(x):
+    return isinstance(x, Batch) \
+        or (isinstance(x, tuple) and any(isinstance(y, Batch) for y in x))
+
+
+def batch_fn(fn, rule):
+    """
+    Wrap fn so that it accepts Batches, using rule when there are any.
+    """
+    def batched(*args):
+        if not any(has_batch(a) for a in args):
+            return fn(*args)
+        return rule(*args)
+    return batched
+
+
+@symbol_associator('batch')
+def impl_batch(sym, name, orig_fn: Callable) -> Callable:
+    """
+    Decorator to declare how a primitive computes its results for all
+    the values of Batch arguments at once. For instance, for
+    builtins.whatever, write:
+
+        @impl_batch
+        def batch_whatever(x, y):
+            ...
+
+    The rule is called when at least one of the arguments is a Batch
+    (or a tuple that contains Batches), and returns a Batch. It only
+    needs to handle the arguments the primitive is given in
+    backpropagators, where Batches stand for sensitivities: the
+    primitives that are linear in them.
+
+    The primitive of ``impl_bank['batch']`` for the symbol uses the
+    rule. Primitives that have no rule, e.g. ``mktuple``, only move
+    Batches around as they are.
+    """
+    fn = impl_bank['interp'][sym].fn
+    if isinstance(fn, StructuralMap):
+        dispatch = {**fn.dispatch, numpy.ndarray: batch_ndarray_map}
+        bfn = StructuralMap(batch_fn(fn, orig_fn), dispatch)
+    else:
+        bfn = batch_fn(fn, orig_fn)
+    impl_bank['batch'][sym] = Primitive(bfn, name=sym)
+    return orig_fn
+
+
+@impl_batch
+def batch_add(x, y):
+    if x is ZERO:
+        return y
+    elif y is ZERO:
+        return x
+    return Batch(numpy.add(*batch_align((x, y))))
+
+
+@impl_batch
+def batch_subtract(x, y):
+    if y is ZERO:
+        return x
+    elif x is ZERO:
+        return batch_unary_subtract(y)
+    return Batch(numpy.subtract(*batch_align((x, y))))
+
+
+@impl_batch
+def batch_unary_subtract(x):
+    return Batch(-x.values)
+
+
+@impl_batch
+def batch_multiply(x, y):
+    if x is ZERO or y is ZERO:
+        return ZERO
+    return Batch(numpy.multiply(*batch_align((x, y))))
+
+
+@impl_batch
+def batch_divide(x, y):
+    if x is ZERO:
+        return ZERO
+    return Batch(numpy.true_divide(*batch_align((x, y))))
+
+
+@impl_batch
+def batch_dot(x, y):
+    if x is ZERO or y is ZERO:
+        return ZERO
+    elif isinstance(x, Batch) and not isinstance(y, Batch) \
+            and x.values.ndim > 1:
+        # (B, ..., m) @ (m, ...)
+        return Batch(numpy.matmul(x.values, y))
+    elif isinstance(y, Batch) and not isinstance(x, Batch):
+        if y.values.ndim == 2:
+            # x @ v for each vector v, i.e. the rows of (B, m) @ x.T
+            return Batch(y.values @ numpy.transpose(x))
+        elif y.values.ndim > 2:
+            return Batch(numpy.matmul(x, y.values))
+    # Anything else is computed value by value.
+    xs = x.values if isinstance(x, Batch) else [x] * len(y.values)
+    ys = y.values if isinstance(y, Batch) else [y] * len(x.values)
+    return Batch([a @ b for a, b in zip(xs, ys)])
+
+
+@impl_batch
+def batch_transpose(x):
+    v = x.values
+    return Batch(v.transpose(0, *reversed(range(1, v.ndim))))
+
+
+@impl_batch
+def batch_sum(xs):
+    v = xs.values
+    return Batch(v.reshape(v.shape[0], -1).sum(axis=1))
+
+
+@impl_batch
+def batch_broadcast(arrs):
+    shp = numpy.broadcast(*[a.values[0] if isinstance(a, Batch) else a
+                            for a in arrs if a is not ZERO]).shape
+    aligned = batch_align(arrs, len(shp))
+    return tuple(arr if arr is ZERO
+                 else Batch(numpy.broadcast_to(
+                     v, v.shape[:1] + shp)) if isinstance(arr, Batch)
+                 else numpy.broadcast_to(arr, shp)
+                 for arr, v in zip(arrs, aligned))
+
+
+@impl_batch
+def batch_fit(arr, shp):
+    v, = batch_align([arr], len(shp))
+    v = v.sum(axis=tuple(range(1, v.ndim - len(shp))))
+    sum_axes = tuple(i + 1 for i, (s0, s1) in enumerate(zip(v.shape[1:], shp))
+                     if s1 == 1 and s0 != 1)
+    v = v.sum(axis=sum_axes, keepdims=True)
+    return Batch(numpy.broadcast_to(v, v.shape[:1] + tuple(shp)))
+
+
+def batch_dot_tree_eval(tree, xs):
+    if isinstance(tree, int):
+        return xs[tree]
+    elif tree[0] == 'T':
+        return impl_bank['batch'][builtins.transpose](
+            batch_dot_tree_eval(tree[1], xs))
+    else:
+        left, right = tree
+        return impl_bank['batch'][builtins.dot](
+            batch_dot_tree_eval(left, xs), batch_dot_tree_eval(right, xs))
+
+
+def batch_multi_dot(tree, *xs):
+    # The products are computed as written, with the batched dot.
+    if any(isinstance(x, Batch) for x in xs):
+        return batch_dot_tree_eval(tree, xs)
+    else:
+        return multi_dot(tree, *xs)
+
+
+def batch_fused(tree, *xs):
+    # Fused expressions are evaluated operation by operation on
+    # Batches, each operation being vectorized.
+    if any(isinstance(x, Batch) for x in xs):
+        return fused_eval_generic(tree, xs, 'batch')
+    else:
+        return fused(tree, *xs)
+
+
+impl_bank['batch'][builtins.multi_dot] = \
+    Primitive(batch_multi_dot, name=builtins.multi_dot)
+impl_bank['batch'][builtins.fused] = \
+    Primitive(batch_fused, name=builtins.fused)
+
+
+# Primitives without a batch rule propagate Batches as they are.
+for _sym, _prim in impl_bank['interp'].items():
+    impl_bank['batch'].setdefault(_sym, _prim)
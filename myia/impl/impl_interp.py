@@ -8,9 +8,10 @@ from ..lib import ZERO
 from ..transform import find_grad
 from ..inference.types import typeof
 from ..lib import \
-    Primitive, Closure, Function, \
-    StructuralMap, default_structural_map_dispatch
-from ..symbols import object_map
+    Primitive, Closure, Function, Record, Sparse, \
+    StructuralMap, default_structural_map_dispatch, ndarray_map, \
+    ndarray_leaf_map
+from ..symbols import builtins, object_map
 from ..parse import parse_function
 from ..util.debug import Breakpoint, BreakpointMode
 
@@ -31,6 +32,7 @@ pyenumerate = enumerate
 pyException = Exception
 pyprint = print
 pyslice = slice
+pysum = sum
 
 
 @symbol_associator('')
@@ -72,7 +74,7 @@ def impl_interp_smap(dispatch):
         dispatch = default_structural_map_dispatch
         return deco(fn)
     else:
-        dispatch = {**dispatch, **default_structural_map_dispatch}
+        dispatch = {**default_structural_map_dispatch, **dispatch}
         return deco
 
 
@@ -81,7 +83,37 @@ def impl_interp_smap(dispatch):
 ##############################################
 
 
-@impl_interp_smap
+def add_special(map_fn):
+    def map_add(smap, x, y):
+        if y is ZERO:
+            return x
+        elif isinstance(y, Sparse):
+            return y.add_to(smap, x)
+        else:
+            return map_fn(smap, x, y)
+    return map_add
+
+
+def add_object(smap, x, y):
+    return x.__map__(smap, y)
+
+
+def add_sparse(smap, x, y):
+    return x.add_to(smap, y)
+
+
+def add_ndarray(smap, x, y):
+    if x.dtype == object or pygetattr(y, 'dtype', None) == object:
+        return ndarray_map(smap, x, y)
+    return numpy.add(x, y)
+
+
+@impl_interp_smap({Sparse: add_sparse, **{t: add_special(m) for t, m in {
+    **default_structural_map_dispatch,
+    numpy.ndarray: add_ndarray,
+    myiaClosure: add_object,
+    Record: add_object
+}.items()}})
 def add(x, y):
     """
     Element-wise addition. Note that unlike Python's addition, this
@@ -94,12 +126,36 @@ def add(x, y):
     >>> add((1, 2, (3, 4)), (4, 3, (2, 1)))
     (5, 5, (5, 5))
 
-    As a special case, ``add(ZERO, x) == x``. The converse, ``add(x, ZERO)``,
-    is considered an error.
+    As a special case, ``add(ZERO, x) == add(x, ZERO) == x``, at any
+    depth in the structure. Sparse sensitivities are added to tuples,
+    Records and other Sparse sensitivities entry by entry.
     """
     return x + y
 
 
+def add_inplace(buffers, x, y):
+    """
+    Same as ``add``, but the arrays at the indexes in ``buffers`` may
+    be overwritten. The sensitivities accumulated by ``Grad`` are
+    chains of ``add``, so when the partial sums are not used anywhere
+    else, the VM runs the chain as ``+=`` into a single buffer.
+    """
+    xs = (x, y)
+    if all(isinstance(v, (numpy.ndarray, *fused_scalar_types))
+           for v in xs):
+        shape = numpy.broadcast(*xs).shape
+        dtype = numpy.result_type(*xs)
+        for i in sorted(buffers):
+            buf = xs[i]
+            if buf.dtype != object and buf.shape == shape \
+                    and buf.dtype == dtype:
+                return numpy.add(x, y, out=buf)
+    return add(x, y)
+
+
+impl_bank['inplace'][builtins.add] = add_inplace
+
+
 @impl_interp_smap
 def subtract(x, y):
     return x - y
@@ -125,6 +181,91 @@ def transpose(x):
     return x.T
 
 
+def dot_tree_eval(tree, xs):
+    """
+    Evaluate a product tree as written. ``tree`` is either the index
+    of an operand in ``xs``, ``('T', subtree)`` for a transpose, or a
+    ``(left, right)`` pair for a dot product.
+    """
+    if isinstance(tree, int):
+        return xs[tree]
+    elif tree[0] == 'T':
+        return dot_tree_eval(tree[1], xs).T
+    else:
+        left, right = tree
+        return dot_tree_eval(left, xs) @ dot_tree_eval(right, xs)
+
+
+def dot_tree_flatten(tree, transposed=False):
+    """
+    Flatten a product tree into a list of ``(index, transposed)``
+    operands, pushing transposes down to the leaves using
+    ``(A @ B).T == B.T @ A.T``.
+    """
+    if isinstance(tree, int):
+        return [(tree, transposed)]
+    elif tree[0] == 'T':
+        return dot_tree_flatten(tree[1], not transposed)
+    else:
+        left, right = (dot_tree_flatten(t, transposed) for t in tree)
+        return right + left if transposed else left + right
+
+
+def matrix_chain_order(dims):
+    """
+    Find the parenthesization of a chain of matrix products that
+    minimizes the number of scalar multiplications, using the classic
+    dynamic programming algorithm. The ith matrix has shape
+    ``(dims[i], dims[i + 1])``.
+
+    Returns a table ``split`` such that the product of matrices ``i``
+    to ``j`` should be computed as the product of ``i..split[i][j]``
+    and ``split[i][j]+1..j``.
+    """
+    n = pylen(dims) - 1
+    cost = [[0] * n for _ in pyrange(n)]
+    split = [[0] * n for _ in pyrange(n)]
+    for length in pyrange(1, n):
+        for i in pyrange(n - length):
+            j = i + length
+            cost[i][j] = None
+            for k in pyrange(i, j):
+                c = cost[i][k] + cost[k + 1][j] \
+                    + dims[i] * dims[k + 1] * dims[j + 1]
+                if cost[i][j] is None or c < cost[i][j]:
+                    cost[i][j] = c
+                    split[i][j] = k
+    return split
+
+
+@impl_interp
+def multi_dot(tree, *xs):
+    """
+    Compute the product tree ``tree`` (see ``dot_tree_eval``) over the
+    operands ``xs``. If the operands are matrices (the first and last
+    may also be vectors), the product is reordered to minimize the
+    number of scalar multiplications. Otherwise, the tree is evaluated
+    as written.
+    """
+    if all(numpy.ndim(x) in (1, 2) for x in xs):
+        mats = [xs[i].T if t else xs[i] for i, t in dot_tree_flatten(tree)]
+        if all(m.ndim == 2 for m in mats[1:-1]):
+            first, last = mats[0], mats[-1]
+            dims = [first.shape[0] if first.ndim == 2 else 1] \
+                + [m.shape[-1] for m in mats[:-1]] \
+                + [last.shape[1] if last.ndim == 2 else 1]
+            split = matrix_chain_order(dims)
+
+            def product(i, j):
+                if i == j:
+                    return mats[i]
+                k = split[i][j]
+                return product(i, k) @ product(k + 1, j)
+
+            return product(0, pylen(mats) - 1)
+    return dot_tree_eval(tree, xs)
+
+
 @impl_interp_smap
 def unary_subtract(x):
     return -x
@@ -145,6 +286,129 @@ def log(x):
     return numpy.log(x)
 
 
+# Elementwise operations that can be fused by ``fused``, mapped to
+# the equivalent NumPy ufunc.
+elementwise_ufuncs = {
+    'add': numpy.add,
+    'subtract': numpy.subtract,
+    'multiply': numpy.multiply,
+    'divide': numpy.true_divide,
+    'power': numpy.power,
+    'unary_subtract': numpy.negative,
+    'exp': numpy.exp,
+    'log': numpy.log
+}
+
+
+fused_scalar_types = (int, float, bool, numpy.generic)
+
+
+def fused_eval_generic(tree, xs, bank='interp'):
+    """
+    Evaluate an elementwise expression tree (see ``fused``) using the
+    regular primitives, or those of ``impl_bank[bank]``. This works on
+    any data the primitives accept.
+    """
+    if isinstance(tree, int):
+        return xs[tree]
+    op, *args = tree
+    return impl_bank[bank][pygetattr(builtins, op)](
+        *[fused_eval_generic(arg, xs, bank) for arg in args]
+    )
+
+
+def ufunc_result_type(ufunc, args):
+    """
+    Dtype of the result of ufunc on args, which is not always their
+    ``result_type``, e.g. ``true_divide`` and ``exp`` return floats
+    on integer arrays. It is found by calling ufunc on one element of
+    each array. Zero-dimensional arrays are kept whole, since NumPy
+    casts them like scalars, based on their value.
+    """
+    trial = [arg.reshape(-1)[:1]
+             if isinstance(arg, numpy.ndarray) and arg.ndim else arg
+             for arg in args]
+    with numpy.errstate(all='ignore'):
+        return ufunc(*trial).dtype
+
+
+def fused_eval_numpy(tree, xs, buffers=()):
+    """
+    Evaluate an elementwise expression tree (see ``fused``) on arrays
+    and scalars using NumPy ufuncs. Returns the result along with
+    whether it is an array that may be overwritten, i.e. a temporary
+    array allocated during evaluation, or an operand whose index is
+    in ``buffers``.
+
+    These arrays are overwritten by the operation that consumes them
+    whenever the result fits in them, so that only one or two arrays
+    are allocated for the whole expression.
+    """
+    if isinstance(tree, int):
+        return xs[tree], tree in buffers
+    op, *args = tree
+    args, owned = zip(*[fused_eval_numpy(arg, xs, buffers)
+                        for arg in args])
+    if not any(isinstance(arg, numpy.ndarray) for arg in args):
+        # Keep Python's semantics for scalar subexpressions,
+        # e.g. 2 ** -1 == 0.5
+        return impl_bank['interp'][pygetattr(builtins, op)](*args), False
+    ufunc = elementwise_ufuncs[op]
+    shape = numpy.broadcast(*args).shape
+    candidates = [arg for arg, tmp in zip(args, owned)
+                  if tmp and arg.shape == shape]
+    if candidates:
+        dtype = ufunc_result_type(ufunc, args)
+        for arg in candidates:
+            if arg.dtype == dtype:
+                return ufunc(*args, out=arg), True
+    return ufunc(*args), True
+
+
+@impl_interp
+def fused(tree, *xs):
+    """
+    Evaluate a fused expression of elementwise operations.
+
+    ``tree`` is either the index of an operand in ``xs``, or a tuple
+    ``(op, *subtrees)`` where ``op`` is the name of an elementwise
+    builtin (see ``elementwise_ufuncs``).
+
+    If all operands are arrays or scalars, the expression is computed
+    with NumPy ufuncs, reusing the intermediate arrays as output
+    buffers. Otherwise, the regular primitives are used.
+    """
+    if all(isinstance(x, (numpy.ndarray, *fused_scalar_types))
+           for x in xs):
+        res, _ = fused_eval_numpy(tree, xs)
+        return res
+    else:
+        return fused_eval_generic(tree, xs)
+
+
+def fused_inplace(buffers, tree, *xs):
+    """
+    Same as ``fused``, but the arguments at the indexes in ``buffers``
+    may be overwritten. This is used by the VM when nothing else
+    refers to these arguments.
+    """
+    if all(isinstance(x, (numpy.ndarray, *fused_scalar_types))
+           for x in xs):
+        def count(tree, i):
+            if isinstance(tree, int):
+                return tree == i
+            return pysum(count(arg, i) for arg in tree[1:])
+        # An operand that is read more than once must stay intact.
+        buffers = {i - 1 for i in buffers if count(tree, i - 1) == 1}
+        res, _ = fused_eval_numpy(tree, xs, buffers)
+        return res
+    else:
+        return fused_eval_generic(tree, xs)
+
+
+impl_bank['inplace'][builtins.fused] = fused_inplace
+
+
 @impl_interp
 def sum(xs):
     return numpy.sum(xs)
@@ -167,11 +431,18 @@ def greater(x, y):
 
 @impl_interp
 def broadcast(arrs):
+    # ZERO is left as it is, since it broadcasts to any shape.
+    nonzero = [arr for arr in arrs if arr is not ZERO]
+    if pylen(nonzero) < pylen(arrs):
+        bcast = iter(numpy.broadcast_arrays(*nonzero))
+        return tuple(arr if arr is ZERO else next(bcast) for arr in arrs)
     return tuple(numpy.broadcast_arrays(*arrs))
 
 
 @impl_interp
 def fit(arr, shp):
+    if arr is ZERO:
+        return ZERO
     if isinstance(arr, (int, float)):
         arr = numpy.asarray(arr)
     orig_shp = shp
@@ -208,11 +479,15 @@ def Closure(fn, args):
 
 @impl_interp
 def closure_fn(clos):
+    if clos is ZERO:
+        return ZERO
     return clos.fn
 
 
 @impl_interp
 def closure_args(clos):
+    if clos is ZERO:
+        return ZERO
     return clos.args
 
 
@@ -233,12 +508,22 @@ def mklist(*args):
 
 @impl_interp
 def index(t, i):
+    if t is ZERO:
+        return ZERO
     return t[i]
 
 
 @impl_interp
 def setslice(t, i, v):
+    if t is ZERO:
+        # This only happens when backpropagating through a symbolic
+        # ZERO, which is a constant, so nothing is lost.
+        return ZERO
+    elif isinstance(t, Sparse):
+        return t.__variant__(i, v)
     typ = pytype(t)
+    if i < 0:
+        i += pylen(t)
     return typ(v if i == j else orig
                for j, orig in enumerate(t))
 
@@ -255,12 +540,19 @@ def second(t):
 
 @impl_interp
 def getattr(obj, attr):
+    if obj is ZERO:
+        return ZERO
+    elif isinstance(obj, Sparse):
+        return obj[attr]
     return pygetattr(obj, attr)
 
 
 @impl_interp
 def setattr(obj, attr, value):
-    if hasattr(obj, '__variant__'):
+    if obj is ZERO:
+        # See setslice
+        return ZERO
+    elif hasattr(obj, '__variant__'):
         return obj.__variant__(attr, value)
     else:
         obj2 = copy(obj)
@@ -349,16 +641,30 @@ def J_fn(x, nargs_closure):
     See previous section on Partial Application for the
     purpose of the ``nargs_closure`` argument.
     """
+    # The gradient is stored in the cache of the pipeline, if any, and
+    # follows its memory budget (see VMUniverse).
+    cache = pygetattr(x.universe, 'grad_cache', None)
+    budget = pygetattr(x.universe, 'memory_budget', None)
     if isinstance(x, Primitive):
         ref = x.name
+    elif isinstance(x, Function) and budget is not None \
+            and pygetattr(x, 'ast', None):
+        # Only the gradients of Lambdas are checkpointed.
+        ref = x.ast.ref
+    elif isinstance(x, Function) and pygetattr(x, 'graph', None):
+        # Differentiate the graph the function was compiled to, which
+        # benefits from its optimizations.
+        from ..ir.grad import graph_grad
+        return x.universe[graph_grad(x.graph, nargs_closure, cache)]
     elif isinstance(x, Function):
         ref = x.ast.ref
     else:
         raise TypeError(f'J_fn applied on wrong type: {x}')
-    return x.universe[find_grad(ref, nargs_closure)]
+    return x.universe[find_grad(ref, nargs_closure, budget, cache)]
 
 
-@impl_interp_smap({myiaClosure: J_dispatch_closure})
+@impl_interp_smap({myiaClosure: J_dispatch_closure,
+                   numpy.ndarray: ndarray_leaf_map})
 def J(x):
     """
     Return a Grad-transformed version of this data.
@@ -388,7 +694,7 @@ def J(x):
         raise TypeError(f'Invalid argument for J: {x}')
 
 
-@impl_interp_smap
+@impl_interp_smap({numpy.ndarray: ndarray_leaf_map})
 def Jinv(x):
     """
     Undo the effect of ``J``.
@@ -405,6 +711,9 @@ def Jinv(x):
     if isinstance(x, Primitive):
         raise Exception('Primitives have no primals.')
     elif isinstance(x, Function):
+        graph = pygetattr(x, 'graph', None)
+        if graph and graph.primal:
+            return x.universe[graph.primal]
         assert isinstance(x.primal_sym, Symbol)
         primal = x.universe[x.primal_sym]
         if not isinstance(primal, (Function, Primitive)):
@@ -450,6 +759,16 @@ def grad3(fn):
     return g
 
 
+@impl_interp
+def checkpoint(fn, x):
+    """
+    Return ``fn(x)``. The gradient of ``checkpoint`` only keeps ``fn``
+    and ``x`` for the backward pass, which recomputes the
+    intermediate results of ``fn(x)`` instead of storing them.
+    """
+    return fn(x)
+
+
 def zeros_like_closure(smap, x):
     return smap(x.args)
 
@@ -480,6 +799,54 @@ def zeros_like(x):
         raise TypeError(f'Cannot create a zero conformant with {x}')
 
 
+@impl_interp
+def sparse(key, value):
+    """
+    Return a sensitivity for a tuple or a Record that is ``value`` at
+    the index or field ``key``, and zero everywhere else. The size of
+    the container does not matter.
+    """
+    return Sparse({key: value})
+
+
+@impl_interp
+def fill_zeros(sen, x):
+    """
+    Replace the ``ZERO`` placeholders in the sensitivity ``sen`` by
+    zeros conformant with the corresponding parts of ``x``. The rest
+    of ``sen`` is returned as it is.
+
+    >>> fill_zeros((ZERO, (2, ZERO)), (1, (2, (3, 4))))
+    (0, (2, (0, 0)))
+
+    Sparse sensitivities are made dense the same way:
+
+    >>> fill_zeros(Sparse({1: 2}), (1, 2, 3))
+    (0, 2, 0)
+    """
+    if sen is ZERO:
+        return zeros_like(x)
+    elif isinstance(sen, Sparse):
+        if isinstance(x, myiaClosure):
+            x = x.args
+        if isinstance(x, Record):
+            return Record(x.__tag__, {k: fill_zeros(sen[k], v)
+                                      for k, v in x})
+        sen = sen.normalized(add, pylen(x))
+        return pytype(x)(fill_zeros(sen[i], v)
+                         for i, v in pyenumerate(x))
+    elif isinstance(sen, (pytuple, pylist)):
+        if isinstance(x, myiaClosure):
+            x = x.args
+        return pytype(sen)(fill_zeros(s, y) for s, y in zip(sen, x))
+    elif isinstance(sen, Record):
+        return Record(sen.__tag__, {k: fill_zeros(v, x[k]) for k, v in sen})
+    elif isinstance(sen, myiaClosure):
+        return myiaClosure(sen.fn, fill_zeros(sen.args, x.args))
+    else:
+        return sen
+
+
 @impl_interp
 def assert_true(x, msg):
     assert x, msg
@@ -1,5 +1,9 @@
 
-from typing import List, Any, Dict
+import math
+import os
+import pickle
+import time
+from typing import List, Any, Dict, Set, MutableMapping
 from ..legacy_interpret import VMCode, VMFrame, EnvT, \
     Primitive, Function, Closure, Instruction, \
     EvaluationEnv, EvaluationEnvCollection
@@ -10,27 +14,13 @@ from itertools import product
 from .dfa import DFA, ValueTrack, NeedsTrack
 from ..stx import maptup2, Symbol, TupleNode, LambdaNode, python_universe
 from collections import defaultdict
+from weakref import WeakValueDictionary
 from ..lib import ANY, VALUE, ERROR
 from .types import Type
 
 
 aroot_globals = impl_bank['abstract']
 projector_set = set()
-max_depth = 5
-
-
-class SetDepth:
-    def __init__(self, depth):
-        self.prev_depth = max_depth
-        self.depth = depth
-
-    def __enter__(self):
-        global max_depth
-        max_depth = self.depth
-
-    def __exit__(self, excv, exct, exctb):
-        global max_depth
-        max_depth = self.prev_depth
 
 
 def wrap_abstract(v):
@@ -50,20 +40,58 @@ def unwrap_abstract(v):
         return v
 
 
+def intern_key(x):
+    if isinstance(x, dict):
+        return frozenset((p, intern_key(v)) for p, v in x.items())
+    elif isinstance(x, tuple):
+        return (tuple, tuple(map(intern_key, x)))
+    else:
+        return (type(x), x)
+
+
 class AbstractValue:
-    def __init__(self, value, depth=0):
-        self.depth = depth
-        if depth > max_depth:
-            value = ANY
+    """
+    Abstract value, mapping projections (e.g. ``VALUE``, ``type`` or
+    ``shape``) to what is known about them.
+
+    Abstract values are interned: creating one with the same values and
+    depth as a live one returns it. Its hash is computed once, and two
+    abstract values are usually equal only if they are the same object.
+    The depth is not compared.
+    """
+
+    _interned: MutableMapping = WeakValueDictionary()
+
+    def __new__(cls, value, depth=0):
         if isinstance(value, dict):
-            self.values = value
+            values = dict(value)
+        else:
+            values = {VALUE: value}
+        if VALUE in values:
+            while isinstance(values[VALUE], AbstractValue):
+                v = values[VALUE]
+                depth = max(v.depth, depth)
+                values[VALUE] = v[VALUE]
+
+        try:
+            h = hash(frozenset(values.items()))
+            # The key distinguishes e.g. 1 and 1.0, which are equal.
+            key = (intern_key(values), depth)
+        except TypeError:
+            # Values that cannot be hashed are not interned.
+            h = key = None
         else:
-            self.values = {VALUE: value}
-        if VALUE in self.values:
-            while isinstance(self[VALUE], AbstractValue):
-                v = self[VALUE]
-                self.depth = max(v.depth, self.depth)
-                self.values[VALUE] = v[VALUE]
+            av = cls._interned.get(key, None)
+            if av is not None:
+                return av
+
+        self = super().__new__(cls)
+        self.values = values
+        self.depth = depth
+        self._hash = h
+        if key is not None:
+            cls._interned[key] = self
+        return self
 
     def __getitem__(self, proj):
         return self.values[proj]
@@ -82,11 +110,19 @@ class AbstractValue:
         return hrepr(self.values)
 
     def __hash__(self):
-        return hash(tuple(self.values.items()))
+        if self._hash is None:
+            raise TypeError(f'Unhashable abstract value: {self}')
+        return self._hash
 
     def __eq__(self, other):
-        return isinstance(other, AbstractValue) \
+        return self is other or (
+            isinstance(other, AbstractValue)
+            and self._hash == other._hash
             and self.values == other.values
+        )
+
+    def __reduce__(self):
+        return (AbstractValue, (self.values, self.depth))
 
 
 def load():
@@ -125,6 +161,240 @@ class Fork:
         return f'Fork({paths})'
 
 
+class Interval:
+    """
+    Abstract integer between lo and hi inclusively. The bounds may be
+    infinite. Comparisons return ANY when they depend on the value in
+    the interval.
+    """
+    def __init__(self, lo, hi):
+        self.lo = lo
+        self.hi = hi
+
+    @staticmethod
+    def hull(x, y):
+        """
+        Smallest interval that contains the integers or intervals x
+        and y.
+        """
+        x, y = to_interval(x), to_interval(y)
+        return Interval(min(x.lo, y.lo), max(x.hi, y.hi))
+
+    def __add__(self, other):
+        if not isinstance(other, (int, Interval)):
+            return NotImplemented
+        other = to_interval(other)
+        return Interval(self.lo + other.lo, self.hi + other.hi)
+
+    __radd__ = __add__
+
+    def __neg__(self):
+        return Interval(-self.hi, -self.lo)
+
+    def __sub__(self, other):
+        if not isinstance(other, (int, Interval)):
+            return NotImplemented
+        return self + -to_interval(other)
+
+    def __rsub__(self, other):
+        return -self + other
+
+    def __lt__(self, other):
+        other = to_interval(other)
+        if self.hi < other.lo:
+            return True
+        elif self.lo >= other.hi:
+            return False
+        return ANY
+
+    def __gt__(self, other):
+        return to_interval(other) < self
+
+    def __le__(self, other):
+        # Only integers are compared to intervals
+        return self < to_interval(other) + 1
+
+    def __ge__(self, other):
+        return to_interval(other) <= self
+
+    def __hash__(self):
+        return hash((Interval, self.lo, self.hi))
+
+    def __eq__(self, other):
+        return isinstance(other, Interval) \
+            and self.lo == other.lo and self.hi == other.hi
+
+    def __str__(self):
+        return f'[{self.lo}..{self.hi}]'
+
+    __repr__ = __str__
+
+
+def to_interval(x):
+    if isinstance(x, Interval):
+        return x
+    elif isinstance(x, (int, float)) and not isinstance(x, bool):
+        return Interval(x, x)
+    else:
+        raise TypeError(f'Not a number: {x}')
+
+
+def is_integer(x):
+    return isinstance(x, Interval) \
+        or isinstance(x, int) and not isinstance(x, bool)
+
+
+def join_values(x, y):
+    """
+    Value that covers both x and y: equal values are kept, tuples and
+    abstract values are joined elementwise, and anything else becomes
+    ANY. In particular, shapes that differ in some dimensions become
+    ANY in these dimensions only.
+    """
+    if type(x) is type(y) and x == y:
+        return x
+    elif isinstance(x, AbstractValue) and isinstance(y, AbstractValue):
+        return join(x, y)
+    elif isinstance(x, tuple) and isinstance(y, tuple) \
+            and len(x) == len(y):
+        return tuple(map(join_values, x, y))
+    else:
+        return ANY
+
+
+def join(x, y):
+    """
+    Abstract value that covers the abstract values x and y.
+    """
+    if x == y and x.depth >= y.depth:
+        return x
+    depth = max(x.depth, y.depth)
+    if ERROR in x.values or ERROR in y.values \
+            or x.values.keys() != y.values.keys():
+        return AbstractValue(ANY, depth)
+    return AbstractValue({p: join_values(v, y[p])
+                          for p, v in x.values.items()},
+                         depth)
+
+
+def join_args(history, args):
+    """
+    Join each argument in args with the corresponding arguments in
+    history, a list of tuples of arguments.
+    """
+    for prev in history:
+        args = tuple(join(a, p) if isinstance(a, AbstractValue)
+                     and isinstance(p, AbstractValue) else a
+                     for a, p in zip(args, prev))
+    return args
+
+
+class Widening:
+    """
+    Widening strategy for the abstract VM. Before a function is called
+    with new arguments, each strategy may replace them by less precise
+    ones, so that the number of signatures a function is evaluated
+    with stays finite, e.g. for a loop.
+    """
+    def widen(self, history, args):
+        """
+        Widen args, a tuple of abstract values.
+
+        Arguments:
+            history: The (widened) arguments the same function was
+                called with so far, oldest first.
+            args: The new arguments.
+        """
+        raise NotImplementedError()
+
+
+class DepthWidening(Widening):
+    """
+    Replace by ANY the arguments that were computed by a chain of more
+    than max_depth primitive calls.
+    """
+    def __init__(self, max_depth=5):
+        self.max_depth = max_depth
+
+    def widen(self, history, args):
+        return tuple(AbstractValue(ANY) if isinstance(arg, AbstractValue)
+                     and arg.depth > self.max_depth else arg
+                     for arg in args)
+
+
+class JoinWidening(Widening):
+    """
+    Once a function was called with k distinct arguments, join the new
+    arguments with all the previous ones. The values that differ
+    become ANY, but the dimensions of the shapes that are the same
+    in all calls are kept.
+    """
+    def __init__(self, k=3):
+        self.k = k
+
+    def widen(self, history, args):
+        if len(history) < self.k:
+            return args
+        return join_args(history, args)
+
+
+class IntervalWidening(Widening):
+    """
+    Once a function was called with k distinct arguments, widen the
+    integers that change from call to call, e.g. loop counters, to
+    intervals. A bound that moves is widened to infinity, so a counter
+    that goes down from n becomes ``[-inf..n]`` and the next call with
+    ``[-inf..n-1]`` falls in the same interval.
+    """
+    def __init__(self, k=3):
+        self.k = k
+
+    def widen(self, history, args):
+        if len(history) < self.k:
+            return args
+        return tuple(self.widen_arg([prev[i] for prev in history], arg)
+                     for i, arg in enumerate(args))
+
+    def widen_arg(self, prevs, arg):
+        if not isinstance(arg, AbstractValue) \
+                or not is_integer(arg.values.get(VALUE, None)):
+            return arg
+        new = arg[VALUE]
+        olds = [p[VALUE] for p in prevs
+                if isinstance(p, AbstractValue)
+                and is_integer(p.values.get(VALUE, None))]
+        if not olds or all(old == new for old in olds):
+            return arg
+        old = olds[0]
+        for o in olds[1:]:
+            old = Interval.hull(old, o)
+        old, newi = to_interval(old), to_interval(new)
+        lo = old.lo if newi.lo >= old.lo else -math.inf
+        hi = old.hi if newi.hi <= old.hi else math.inf
+        return AbstractValue(Interval(lo, hi), arg.depth)
+
+
+class Budget:
+    """
+    Limits on the work of an abstract VM. Once the VM processed more
+    than ``steps`` states or ran for more than ``time`` seconds, the
+    arguments of the functions it calls with new arguments are joined
+    with all their previous arguments (see ``JoinWidening``), so that
+    it finishes quickly.
+    """
+    def __init__(self, steps=None, time=None):
+        self.steps = steps
+        self.time = time
+
+    def exhausted(self, vm):
+        return (self.steps is not None and vm.steps > self.steps) \
+            or (self.time is not None
+                and time.perf_counter() - vm.start_time > self.time)
+
+
+default_widening = (DepthWidening(5),)
+
+
 def find_projector(proj, fn):
     if proj is VALUE:
         return fn
@@ -139,24 +409,103 @@ def find_projector(proj, fn):
         raise Exception(f'Cannot project "{proj}" with {fn}.')
 
 
+class LocalEnv:
+    """
+    Persistent local environment. A binding is stored by creating a
+    new LocalEnv on top of the previous one, so that the bindings are
+    shared by all the copies of a frame.
+    """
+    __slots__ = ('parent', 'key', 'value')
+
+    def __init__(self, parent, key, value):
+        self.parent = parent
+        self.key = key
+        self.value = value
+
+    def __getitem__(self, key):
+        env = self
+        while isinstance(env, LocalEnv):
+            if env.key == key:
+                return env.value
+            env = env.parent
+        return env[key]
+
+
+class Waiter:
+    """
+    A frame suspended on a function call, with its continuation. It
+    is resumed once for each distinct value the call may return. The
+    waiter with no frame stands for the caller of the AVM.
+    """
+    def __init__(self, frame, conts):
+        self.frame = frame
+        self.conts = conts
+        self.seen: Set = set()
+
+
+def unroll_closure(fn, args):
+    fn = unwrap_abstract(fn)
+    while isinstance(fn, Closure):
+        args = [*fn.args, *args]
+        fn = unwrap_abstract(fn.fn)
+    return fn, args
+
+
 class AVMFrame(VMFrame):
+    """
+    Frame of the abstract VM. The stack is a linked list of
+    ``(rest, top)`` pairs and the local environment is a LocalEnv,
+    so ``copy`` is O(1) and the copies of a frame share their
+    contents.
+    """
     def __init__(self,
                  vm,
                  code,
                  local_env,
                  universe,
                  signature=None) -> None:
-        from ..symbols import builtins
-        from ..interpret import Primitive
         super().__init__(vm, code, local_env, universe)
         self.signature = signature
+        self.stack = ((), None)
+
+    def advance(self):
+        # Unlike VMFrame.advance, this does not rewind pc when the
+        # instruction raises: a frame that raises Escape is suspended
+        # after the call it made.
+        instr = self.current_instruction()
+        if not instr:
+            raise StopIteration()
+        self.pc += 1
+        method = getattr(self, 'instruction_' + instr.command)
+        return method(instr.node, *instr.args)
+
+    def top(self):
+        return self.stack[1]
+
+    def take_forks(self, n):
+        """
+        Pop n values from the stack, Forks included.
+        """
+        values = []
+        stack = self.stack
+        for _ in range(n):
+            stack, v = stack
+            values.append(v)
+        self.stack = stack
+        values.reverse()
+        return values
 
     def take(self, n):
-        taken = super().take(n)
+        """
+        Pop n values from the stack. If some of them are Forks, the
+        first possibility is returned and the VM will execute the
+        current instruction again on the others.
+        """
+        taken = self.take_forks(n)
         possibilities = list(product(*[x.paths if isinstance(x, Fork) else [x]
                                        for x in taken]))
-        if len(possibilities) > 1:
-            self.vm.checkpoint(possibilities[1:])
+        for p in possibilities[1:]:
+            self.vm.fork(self, p)
         return possibilities[0]
 
     def pop(self):
@@ -172,14 +521,15 @@ class AVMFrame(VMFrame):
                 for vv in v.paths:
                     ann(vv)
 
-        # values = [value if isinstance(value, AbstractValue)
-        #           else AbstractValue(value) for value in values]
-        super().push(*values)
+        self.push_no_annotate(*values)
         for v in values:
             ann(v)
 
     def push_no_annotate(self, *values):
-        super().push(*values)
+        for value in values:
+            if isinstance(value, LambdaNode):
+                value = self.universe[value]
+            self.stack = (self.stack, value)
 
     def aux(self, node, fn, args, projs):
         if isinstance(node, TupleNode):
@@ -204,34 +554,38 @@ class AVMFrame(VMFrame):
         fn = unwrap_abstract(fn)
         args = unwrap_abstract(args)
         clos = Closure(fn, args)
-        self.stack.append(clos)
+        self.push_no_annotate(clos)
 
     def instruction_store(self, node, dest) -> None:
         def store(dest, val):
             if isinstance(dest, Symbol):
-                self.envs[0][dest] = val
+                self.local_env = LocalEnv(self.local_env, dest, val)
+                self.envs[0] = self.local_env
             else:
                 raise TypeError(f'Cannot store into {dest}.')
 
-        def spread_error(x):
+        def spread(x, v):
             if isinstance(x, TupleNode):
                 for y in x.values:
-                    spread_error(y)
+                    spread(y, v)
             else:
-                store(x, err)
+                store(x, v)
 
         value = self.pop()
         if isinstance(dest, TupleNode) and isinstance(value, AbstractValue):
             if ERROR in value.values:
-                err = value[ERROR]
-                spread_error(dest)
+                spread(dest, value[ERROR])
                 return
             elif VALUE in value.values:
                 value = value[VALUE]
             else:
                 err = AbstractValue({ERROR: WrappedException("No VALUE.")})
-                spread_error(dest)
+                spread(dest, err)
                 return
+        if isinstance(dest, TupleNode) and value is ANY:
+            # e.g. a tuple argument that was widened
+            spread(dest, ANY)
+            return
 
         maptup2(store, dest, value)
 
@@ -241,24 +595,22 @@ class AVMFrame(VMFrame):
         self.push(value)
 
     def instruction_reduce(self, node, nargs, has_projs=True):
-        fn, *args = self.take(nargs + 1)
+        args = self.take(nargs)
+        fn, = self.take_forks(1)
+        if isinstance(fn, Fork):
+            # The branches of a switch. If they are all functions, they
+            # are called together, so that the rest of this frame is
+            # only evaluated once for each value they may return.
+            calls = [unroll_closure(path, args) for path in fn.paths]
+            if all(isinstance(f, Function) for f, _ in calls):
+                return self.vm.call(self, calls)
+            for path in fn.paths[1:]:
+                self.vm.fork(self, (path, *args))
+            fn = fn.paths[0]
+
         fn = unwrap_abstract(fn)
         if isinstance(fn, Function):
-            bind: EnvT = {k: v for k, v in zip(fn.ast.args, args)}
-            sig = (fn, tuple(args))
-
-            open, cached = self.vm.consult_cache(sig)
-            if cached is None:
-                return self.__class__(self.vm, fn.code, bind,
-                                      fn.universe, sig)
-            elif open:
-                self.vm.checkpoint_on(sig)
-                if not cached:
-                    raise Escape()
-                else:
-                    self.push(Fork(cached))
-            else:
-                self.push(Fork(cached))
+            return self.vm.call(self, [(fn, args)])
 
         elif isinstance(fn, Closure):
             self.push_no_annotate(fn.fn, *fn.args, *args)
@@ -287,16 +639,35 @@ class AVMFrame(VMFrame):
             raise TypeError(f'Cannot reduce on {fn}.')
 
     def copy(self, pc_offset=0):
-        local_env = {**self.local_env}
-        universe = self.universe
-        fr = AVMFrame(self.vm, self.code,
-                      local_env, universe, self.signature)
-        fr.stack = [s for s in self.stack]
+        fr = object.__new__(self.__class__)
+        fr.__dict__.update(self.__dict__)
+        fr.envs = [fr.local_env, fr.universe]
         fr.pc = self.pc + pc_offset
         return fr
 
 
 class AVM(EventDispatcher):
+    """
+    Abstract VM. It explores every path through the code with a
+    worklist of states. A state is a frame, its continuation (a
+    linked list of ``(frame, rest)`` pairs, which ends at the frame
+    of the current function call), and values to push on the frame
+    before it is run.
+
+    Function calls are memoized by signature, i.e. by function and
+    abstract arguments. The first call with a signature schedules the
+    evaluation of the function; every caller waits on the signature
+    and is resumed once for each distinct value it may return. This
+    is what lets recursive functions terminate, provided that they
+    are called with finitely many signatures: the arguments of new
+    signatures go through the ``widening`` strategies (see
+    ``Widening``), or are joined with the previous ones once the
+    ``budget`` is exhausted.
+
+    If ``processes`` is more than 1, the states are explored in up to
+    that many processes whenever there are several of them, e.g. the
+    branches of a switch (see ``eval_parallel``).
+    """
     def __init__(self,
                  code: VMCode,
                  local_env: EnvT,
@@ -304,143 +675,298 @@ class AVM(EventDispatcher):
                  signature=None,
                  needs: Dict = {},
                  projs=None,
+                 widening=default_widening,
+                 budget=None,
+                 processes=None,
                  emit_events=True) -> None:
         super().__init__(self, emit_events)
-        self.results_cache: Dict = {}
-        self.open_cache: Dict = {}
         self.needs = needs
+        self.widening = widening
+        self.budget = budget
+        self.processes = processes
+        # In a forked process (see eval_parallel): the signatures to
+        # evaluate again when they are called, the index of each
+        # signature of the parent process, the waiters it inherited
+        # from it, and the results to send back to it.
+        self.inherited: Set = set()
+        self.exports: Dict = {}
+        self.remote: Set = set()
+        self.exported: List = []
+        # The arguments each function was called with, after widening.
+        self.contexts: Dict = defaultdict(list)
+        self.steps = 0
+        self.start_time = time.perf_counter()
         self.do_emit_events = emit_events
-        # Current frame
         self.universe = universe
-        self.frame = AVMFrame(self, code, local_env, universe, signature)
-        # Stack of previous frames (excludes current one)
-        self.frames: List[AVMFrame] = []
+        # Memo table: the values each signature may return so far,
+        # and the frames waiting on them.
+        self.results_cache: Dict = {signature: set()}
+        self.waiters: Dict = {signature: [Waiter(None, None)]}
+        self.results: List = []
+        self.worklist: List = []
+        self.frame = None
+        self.conts = None
+        frame = AVMFrame(self, code, local_env, universe, signature)
         if self.do_emit_events:
-            self.emit_new_frame(self.frame)
-        self.checkpoints: List = []
-        self.checkpoints_on: Dict = defaultdict(list)
-        self.sig_stack: List = []
+            self.emit_new_frame(frame)
+        self.schedule(frame)
         self.annotations: Dict = \
             defaultdict(lambda: defaultdict(lambda: defaultdict(set)))
 
+    @property
+    def frames(self):
+        """
+        Frames the current frame returns to, outermost first.
+        """
+        frames = []
+        conts = self.conts
+        while conts is not None:
+            frame, conts = conts
+            frames.append(frame)
+        return frames[::-1]
+
     def annotate(self, track, value, node=None):
-        # path = [f.focus for f in self.frames]
         node = node or self.frame.focus
         path = tuple(f.signature[0].ast.ref or '?' if f.signature else '?'
                      for f in self.frames + [self.frame])
         self.annotations[node][track][path].add(value)
 
-    def consult_cache(self, key):
-        try:
-            open = self.open_cache[key]
-            results = self.results_cache[key]
-            return open, results
-        except ValueError:
-            results = None
-            return False, None
-        except KeyError:
-            self.open_cache[key] = True
-            self.results_cache[key] = set()
-            return False, None
-
-    def add_cache(self, sig, value):
-        if sig not in self.results_cache:
+    def schedule(self, frame, conts=None, values=(), annotate=False):
+        """
+        Add a state to the worklist. The frame must not be modified
+        afterwards, since ``run_state`` works on a copy.
+        """
+        self.worklist.append((frame, conts, values, annotate))
+
+    def fork(self, frame, values):
+        """
+        Execute the current instruction of frame again, after pushing
+        values.
+        """
+        self.schedule(frame.copy(-1), self.conts, values)
+
+    def call(self, frame, calls):
+        """
+        Suspend frame until the functions in calls, a list of
+        ``(function, args)`` pairs, return.
+        """
+        waiter = Waiter(frame, self.conts)
+        for fn, args in calls:
+            args = self.widen(fn, tuple(args))
+            sig = (fn, args)
+            if sig not in self.results_cache or sig in self.inherited:
+                self.inherited.discard(sig)
+                self.results_cache.setdefault(sig, set())
+                self.waiters.setdefault(sig, [])
+                bind = {k: v for k, v in zip(fn.ast.args, args)}
+                new_frame = AVMFrame(self, fn.code, bind, fn.universe, sig)
+                if self.do_emit_events:
+                    self.emit_new_frame(new_frame)
+                self.schedule(new_frame)
+            self.waiters[sig].append(waiter)
+            for value in self.results_cache[sig]:
+                self.resume(waiter, value)
+        raise Escape()
+
+    def widen(self, fn, args):
+        """
+        Arguments to call fn with instead of args.
+        """
+        if (fn, args) in self.results_cache:
+            return args
+        history = self.contexts[fn]
+        if self.budget and self.budget.exhausted(self):
+            args = join_args(history, args)
+        else:
+            for strategy in self.widening:
+                args = strategy.widen(history, args)
+        if (fn, args) not in self.results_cache:
+            history.append(args)
+        return args
+
+    def resume(self, waiter, value):
+        if value in waiter.seen:
             return
-        if value in self.results_cache[sig]:
+        waiter.seen.add(value)
+        if waiter.frame is None:
+            self.results.append(value)
+        else:
+            self.schedule(waiter.frame, waiter.conts, (value,), True)
+
+    def ret(self, frame, conts, value):
+        """
+        Return value from frame, to its continuation or to the
+        callers of its signature.
+        """
+        if isinstance(value, Fork):
+            for v in value.paths:
+                self.ret(frame, conts, v)
+        elif conts is not None:
+            caller, conts = conts
+            self.schedule(caller, conts, (value,), True)
+        else:
+            self.add_result(frame.signature, value)
+
+    def add_result(self, sig, value):
+        """
+        Add value to the results of sig, and resume its callers.
+        """
+        results = self.results_cache[sig]
+        if value in results:
             return
-        self.results_cache[sig].add(value)
-        for (frs, fr, sig_stack) in self.checkpoints_on[sig]:
-            self.checkpoints.append((frs, fr, sig_stack, [[value]], True))
-
-    def checkpoint(self, paths, step_back=-1):
-        fr = self.frame.copy(step_back)
-        frs = [f.copy() for f in self.frames]
-        self.checkpoints.append((frs, fr, set(self.sig_stack), paths, False))
-
-    def checkpoint_on(self, sig):
-        fr = self.frame.copy()
-        frs = [f.copy() for f in self.frames]
-        self.checkpoints_on[sig].append((frs, fr, set(self.sig_stack)))
-
-    def go(self) -> Any:
+        results.add(value)
+        if sig in self.exports:
+            self.exported.append((self.exports[sig], value))
+        for waiter in self.waiters[sig]:
+            if waiter not in self.remote:
+                self.resume(waiter, value)
+
+    def live_signatures(self):
+        """
+        Signatures that may still get new results: those of the
+        functions the states of the worklist are evaluating, and of
+        the functions that wait on them, transitively.
+        """
+        def signature(frame, conts):
+            while conts is not None:
+                frame, conts = conts
+            return frame.signature
+
+        todo = [signature(frame, conts)
+                for frame, conts, _, _ in self.worklist]
+        live: Set = set()
+        while todo:
+            sig = todo.pop()
+            if sig not in live:
+                live.add(sig)
+                todo += [signature(w.frame, w.conts)
+                         for w in self.waiters[sig] if w.frame is not None]
+        return live
+
+    def run_state(self, frame, conts, values, annotate):
+        self.steps += 1
+        self.frame = frame.copy()
+        self.conts = conts
+        if annotate:
+            self.frame.push(*values)
+        else:
+            self.frame.push_no_annotate(*values)
         while True:
             try:
                 # AVMFrame does most of the work.
                 new_frame = self.frame.advance()
-                if new_frame is not None:
-                    if new_frame.signature:
-                        self.sig_stack.append(new_frame.signature)
-                    # When the current frame gives us a new frame,
-                    # we push the old one on the stack and start
-                    # processing the new one.
-                    if True or not self.frame.done():
-                        # We push the current frame only if it's
-                        # not done (this implement tail calls).
-                        self.frames.append(self.frame)
-                    self.frame = new_frame  # type: ignore
-                    if self.do_emit_events:
-                        self.emit_new_frame(self.frame)
             except Escape:
-                return None
+                return
             except StopIteration:
                 # The result of a frame's evaluation is the value at
                 # the top of its stack.
-                rval = self.frame.top()
-                if isinstance(rval, Fork):
-                    self.frame.pop()
-                    self.checkpoint([[p] for p in rval.paths], 0)
-                    return None
-
-                sig = self.frame.signature
-                if sig is not None:
-                    # TODO: reintegrate this code to close open
-                    # function evaluations when possible.
-                    # self.sig_stack.pop()
-                    # if all(sig not in sigs
-                    #        for _, _, sigs, _ in self.checkpoints):
-                    #     self.open_cache[sig] = False
-                    self.add_cache(sig, rval)
-
-                if not self.frames:
-                    # We are done!
-                    return rval
-                else:
-                    # We push the result on the previous frame's stack
-                    # and we resume execution.
-                    self.frame = self.frames.pop()
-                    self.frame.push(rval)
-            # except Exception as exc:
-            #     if self.do_emit_events:
-            #         self.emit_error(exc)
-            #     raise exc from None
+                self.ret(self.frame, self.conts, self.frame.top())
+                return
             except WrappedException as exc:
-                return AbstractValue({ERROR: exc.error})
+                self.results.append(AbstractValue({ERROR: exc.error}))
+                return
+            if new_frame is not None:
+                self.conts = (self.frame, self.conts)
+                self.frame = new_frame
+                if self.do_emit_events:
+                    self.emit_new_frame(self.frame)
 
     def eval(self) -> Any:
-        while True:
-            rval = self.go()
-            if rval is not None:
-                yield rval
-            if self.checkpoints:
-                frames, frame, sig_stack, paths, annotate = \
-                    self.checkpoints.pop()
-                p, *rest = paths
-                self.frames = [f.copy() for f in frames]
-                self.frame = frame.copy()
-                if annotate:
-                    self.frame.push(*p)
-                else:
-                    self.frame.push_no_annotate(*p)
-                if rest:
-                    self.checkpoints.append((frames, frame, sig_stack, rest))
+        while self.worklist:
+            if self.processes and self.processes > 1 \
+                    and len(self.worklist) > 1 and hasattr(os, 'fork'):
+                self.eval_parallel()
             else:
-                return
+                self.run_state(*self.worklist.pop())
+            while self.results:
+                yield self.results.pop()
+
+    def eval_parallel(self):
+        """
+        Split the worklist among forked processes, which explore their
+        share of the states until they return from the functions that
+        were being evaluated, and merge the results they send back.
+
+        The callers of these functions are only resumed here, once
+        for each distinct result, so the rest of their evaluation is
+        not repeated by every process, and the worklist is split
+        again at the next fork. The processes also split their own
+        worklist, with their share of the ``processes``.
+
+        A process has a copy of the memo table. The signatures that
+        may still get new results in other processes (see
+        ``live_signatures``) are evaluated again if the process calls
+        them, since it would otherwise miss these results. The others
+        are complete.
+
+        The results must be picklable, which is the case for types
+        and shapes. If they are not, the states are explored in this
+        process instead.
+        """
+        n = min(self.processes, len(self.worklist))
+        shares = [self.worklist[i::n] for i in range(n)]
+        budgets = [self.processes // n + (i < self.processes % n)
+                   for i in range(n)]
+        sigs = list(self.results_cache)
+        inherited = self.inherited | self.live_signatures()
+
+        def explore(i):
+            self.processes = budgets[i]
+            self.inherited = inherited
+            self.exports = {sig: j for j, sig in enumerate(sigs)}
+            self.remote = {w for ws in self.waiters.values() for w in ws}
+            self.exported = []
+            self.worklist = shares[i]
+            errors = list(self.eval())
+            return self.exported, errors
+
+        outcomes = fork_map(explore, range(n))
+        if outcomes is None:
+            self.processes = None
+            return
+        self.worklist = []
+        for exported, errors in outcomes:
+            self.results += errors
+            for j, value in exported:
+                self.add_result(sigs[j], value)
 
     def run(self) -> Any:
         self.result = self.eval()
         return self.result
 
 
+def fork_map(fn, items):
+    """
+    Return ``[fn(item) for item in items]``, where each element is
+    computed in a forked process and sent back pickled, or None if
+    one of them failed, e.g. because it cannot be pickled.
+    """
+    children = []
+    for item in items:
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            try:
+                data = pickle.dumps((True, fn(item)))
+            except BaseException:
+                data = pickle.dumps((False, None))
+            with os.fdopen(w, 'wb') as f:
+                f.write(data)
+            os._exit(0)
+        os.close(w)
+        children.append((pid, r))
+    outcomes = []
+    for pid, r in children:
+        with os.fdopen(r, 'rb') as f:
+            data = f.read()
+        os.waitpid(pid, 0)
+        outcomes.append(pickle.loads(data) if data else (False, None))
+    if not all(ok for ok, _ in outcomes):
+        return None
+    return [result for _, result in outcomes]
+
+
 class AEvaluationEnv(EvaluationEnv):
     def __init__(self, primitives, pool, config={}):
         super().__init__(primitives, pool, config)
@@ -479,14 +1005,31 @@ eenvs = EvaluationEnvCollection(AEvaluationEnv, aroot_globals,
                                 python_universe, cache=False)
 
 
-def abstract_evaluate(node, proj=None):
+def abstract_evaluate(node, proj=None, widening=default_widening,
+                      budget=None, processes=None):
+    """
+    Return a function that evaluates node on abstract values.
+
+    Arguments:
+        node: The LambdaNode to evaluate.
+        proj: The projection(s) to compute, e.g. ``builtins.shape``.
+            Defaults to the values themselves.
+        widening: A sequence of ``Widening`` strategies, applied in
+            order to the arguments of new function calls.
+        budget: A ``Budget`` for each call of the returned function,
+            or None for no limit.
+        processes: Number of processes to explore the branches of the
+            code in (see ``AVM.eval_parallel``), or None to explore
+            them in this process.
+    """
     if not proj:
         proj = (VALUE,)
     elif not isinstance(proj, (list, tuple)):
         proj = (proj,)
     elif isinstance(proj, list):
         proj = tuple(proj)
-    return eenvs.run_env(node, projs=proj)
+    return eenvs.run_env(node, projs=proj, widening=tuple(widening),
+                         budget=budget, processes=processes)
 
 
 avm_eenv = AEvaluationEnv
@@ -5,16 +5,22 @@ See Inference section of DEVELOPERS.md for some more information.
 """
 
 
+import time
 from types import FunctionType
+from collections import deque
+from collections.abc import Mapping, Set as AbstractSet
 from ..util import Event, EventDispatcher, buche
 from ..stx import \
     MyiaASTNode, LambdaNode, ClosureNode, TupleNode, Symbol, is_global
-from collections import defaultdict
 from ..impl.flow_all import default_flow, ANY, VALUE
 from ..impl.main import impl_bank
 from ..symbols import builtins, object_map
 from .types import Int64, Float64
 from ..lib import Primitive
+from ..parse import parse_function
+
+
+builtin_symbols = set(builtins.__dict__.values())
 
 
 def import_node(x):
@@ -29,12 +35,83 @@ def import_node(x):
         return x.name
     elif isinstance(x, FunctionType):
         try:
-            lbda = parse_function(v)
+            lbda = parse_function(x)
         except (TypeError, OSError):
-            raise ValueError(f'myia.dfa cannot interpret value: {v}')
+            raise ValueError(f'myia.dfa cannot interpret value: {x}')
         return lbda
     else:
-        raise ValueError(f'myia.dfa cannot interpret value: {v}')
+        raise ValueError(f'myia.dfa cannot interpret value: {x}')
+
+
+def iterbits(bits):
+    """
+    Iterate over the indexes of the bits set in the integer bits.
+    """
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+class ValueSet(AbstractSet):
+    """
+    Set of the values of a node on a track. It is stored as a bitset,
+    an integer where bit i is set if the value with id i (see
+    ``DFA.intern``) is in the set.
+    """
+    def __init__(self, dfa, bits):
+        self.dfa = dfa
+        self.bits = bits
+
+    def __contains__(self, value):
+        i = self.dfa.ids.get(value, None)
+        return i is not None and bool(self.bits >> i & 1)
+
+    def __iter__(self):
+        return (self.dfa.id_values[i] for i in iterbits(self.bits))
+
+    def __len__(self):
+        return bin(self.bits).count('1')
+
+    def __repr__(self):
+        return repr(set(self))
+
+
+class ValueSets(Mapping):
+    """
+    Map each node to its ``ValueSet`` on a track, or to an empty set
+    if no values flow to it.
+    """
+    def __init__(self, dfa, track):
+        self.dfa = dfa
+        self.track = track
+
+    def __getitem__(self, node):
+        event = self.dfa.flow_events.get(node, None)
+        bits = event.bits.get(self.track, 0) if event is not None else 0
+        return ValueSet(self.dfa, bits)
+
+    def __iter__(self):
+        return (node for node, event in self.dfa.flow_events.items()
+                if self.track in event.bits)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class FlowEvent(Event):
+    """
+    Event triggered with the values that flow to a node.
+
+    Attributes:
+        bits: Maps each track to the bitset of the values of the node.
+        pending: Maps each track to the bitset of the values that the
+            event was not triggered with yet.
+    """
+    def __init__(self, name):
+        super().__init__(name)
+        self.bits = {}
+        self.pending = {}
 
 
 class DFA(EventDispatcher):
@@ -47,6 +124,12 @@ class DFA(EventDispatcher):
     as LambdaNodes and ClosureNodes, but there are also TypeTracks and
     NeedsTracks.
 
+    New values are not propagated right away: the nodes and tracks
+    they flow to are put on a worklist, and each item of the worklist
+    fires the flow events of a node for all the values it received
+    since it was last processed. The values are numbered by ``intern``
+    and the set of the values of a node on a track is a bitset.
+
     Attributes:
         tracks: Associates track names to Track instances.
         value_track: Shortcut for ``dva.values['value']``
@@ -57,6 +140,10 @@ class DFA(EventDispatcher):
             that node, and can be listened to.
         values: Maps each track to a map of each node to a set
             of possible values flowing to that node.
+        ids: Maps each value that flowed to some node to its id.
+        id_values: Maps ids back to values.
+        iterations: Number of items of the worklist processed so far.
+        time: Time spent in processing the worklist, in seconds.
     """
     def __init__(self, tracks, genv):
         super().__init__(self)
@@ -65,8 +152,26 @@ class DFA(EventDispatcher):
         self.value_track = self.tracks['value']
         self.genv = genv
         self.flow_events = {}
-        self.values = {track: defaultdict(set)
+        self.values = {track: ValueSets(self, track)
                        for track in self.tracks.values()}
+        self.ids = {}
+        self.id_values = []
+        # (event, track) pairs with pending values, in order.
+        self.worklist = deque()
+        self.solving = False
+        self.iterations = 0
+        self.time = 0.0
+
+    def intern(self, value):
+        """
+        Return the id of value, allocating a new one if needed.
+        """
+        i = self.ids.get(value, None)
+        if i is None:
+            i = len(self.id_values)
+            self.ids[value] = i
+            self.id_values.append(value)
+        return i
 
     def propagate(self, node, track, value):
         """
@@ -75,10 +180,47 @@ class DFA(EventDispatcher):
         """
         if isinstance(track, str):
             track = self.tracks[track]
-        vals = self.values[track]
-        if value not in vals[node]:
-            vals[node].add(value)
-            self.flow_events[node](track, value)
+        bit = 1 << self.intern(value)
+        event = self.flow_events[node]
+        bits = event.bits.get(track, 0)
+        if not bits & bit:
+            event.bits[track] = bits | bit
+            delta = event.pending.get(track, 0)
+            if not delta:
+                self.worklist.append((event, track))
+            event.pending[track] = delta | bit
+            self.solve()
+
+    def solve(self):
+        """
+        Process the worklist until it is empty, unless it is already
+        being processed.
+        """
+        if self.solving:
+            return
+        self.solving = True
+        t0 = time.perf_counter()
+        try:
+            while self.worklist:
+                event, track = self.worklist.popleft()
+                delta = event.pending.pop(track)
+                self.iterations += 1
+                for i in iterbits(delta):
+                    event(track, self.id_values[i])
+        finally:
+            self.solving = False
+            self.time += time.perf_counter() - t0
+
+    def stats(self):
+        """
+        Statistics about the analysis so far.
+        """
+        return {
+            'iterations': self.iterations,
+            'time': self.time,
+            'values': len(self.id_values),
+            'nodes': len(self.flow_events)
+        }
 
     def propagate_value(self, node, value):
         """
@@ -126,21 +268,25 @@ class DFA(EventDispatcher):
             require_track = self.tracks[require_track]
 
         def deco(fn):
-            reg = self.flow_events[node].register
+            event = self.flow_events[node]
 
-            @reg
+            @event.register
             def flow(_, track, value):
                 # The first argument is the event instance, we
                 # don't need it.
                 if not require_track or track is require_track:
                     fn(track, value)
 
-            # Call the function for all tracks and values
-            # TODO: avoid doing this for tracks that are not
-            # required!
-            for track in self.tracks.values():
-                for v in self.values[track][node]:
-                    flow(None, track, v)
+            # Call the function for the values that were already
+            # propagated. The others will trigger the event.
+            tracks = [require_track] if require_track \
+                else self.tracks.values()
+            for track in tracks:
+                bits = event.bits.get(track, 0)
+                if bits:
+                    bits &= ~event.pending.get(track, 0)
+                    for i in iterbits(bits):
+                        flow(None, track, self.id_values[i])
         return deco
 
     def function_flow(self, fn, args, node, flow_body=True):
@@ -174,7 +320,7 @@ class DFA(EventDispatcher):
                 # which will receive the totality of the arguments.
                 args = new_value.args + args
                 self.function_flow(new_value.fn, args, node, flow_body)
-            elif new_value in builtins.__dict__.values():
+            elif new_value in builtin_symbols:
                 # If we get a Primitive, we dispatch to the tracks.
                 if flow_body:
                     self.run_flows('prim', new_value, args, node)
@@ -194,7 +340,7 @@ class DFA(EventDispatcher):
             return self.flow_events[node]
         self.emit_visit(node)
         cls = node.__class__.__name__
-        flow = Event(f'flow_{cls}')
+        flow = FlowEvent(f'flow_{cls}')
         self.flow_events[node] = flow
         method = getattr(self, f'visit_{cls}')
         return method(node)
@@ -284,7 +430,7 @@ class DFA(EventDispatcher):
         self.run_flows('LetNode', node)
 
     def visit_Symbol(self, node):
-        if node in builtins.__dict__.values():
+        if node in builtin_symbols:
             # We propagate builtin symbols, although it may be better
             # to do this another way.
             self.propagate_value(node, node)
@@ -0,0 +1,375 @@
+"""
+Type and shape inference on IRGraphs.
+
+The abstract value of a node is one of:
+
+* ``None`` if nothing is known about it.
+* ``BOTTOM`` if it has no value yet (see ``GraphInferrer.call_graph``).
+* ``Shaped(type, shape)`` for a scalar or an array. Either field may
+  be None if it is unknown, and so may the dimensions of the shape.
+* A tuple of abstract values, for a tuple.
+* A frozenset of the functions the node may be: IRGraphs, builtin
+  Symbols and ``Partial`` applications of them.
+
+``InferencePass`` stores the types and shapes it finds in the
+``inferred`` property of the nodes.
+"""
+
+
+from collections import namedtuple
+from weakref import WeakKeyDictionary
+import numpy
+from ..impl.main import impl_bank
+from ..ir.opt import ElementwiseFusionPass, builtin_shape
+from ..lib import Primitive
+from ..symbols import builtins
+from ..util import Singleton
+from .types import Type, Array, Tuple, type_map, typeof
+
+
+class BOTTOM(Singleton):
+    pass
+
+
+BOTTOM = BOTTOM()  # type: ignore
+
+
+Shaped = namedtuple('Shaped', ['type', 'shape'])
+
+
+Partial = namedtuple('Partial', ['fn', 'args'])
+
+
+def join_shapes(s1, s2):
+    if s1 == s2:
+        return s1
+    elif s1 is None or s2 is None or len(s1) != len(s2):
+        return None
+    else:
+        return tuple(d1 if d1 == d2 else None for d1, d2 in zip(s1, s2))
+
+
+def join(v1, v2):
+    """
+    Abstract value that covers both v1 and v2.
+    """
+    if v1 is BOTTOM:
+        return v2
+    elif v2 is BOTTOM or v1 == v2:
+        return v1
+    elif isinstance(v1, Shaped) and isinstance(v2, Shaped):
+        return Shaped(v1.type if v1.type == v2.type else None,
+                      join_shapes(v1.shape, v2.shape))
+    elif isinstance(v1, tuple) and isinstance(v2, tuple) \
+            and len(v1) == len(v2):
+        return tuple(join(x1, x2) for x1, x2 in zip(v1, v2))
+    elif isinstance(v1, frozenset) and isinstance(v2, frozenset):
+        return v1 | v2
+    else:
+        return None
+
+
+def constant_value(value):
+    """
+    Abstract value of a constant.
+    """
+    if isinstance(value, tuple):
+        return tuple(constant_value(x) for x in value)
+    elif isinstance(value, (numpy.ndarray, numpy.generic,
+                            bool, int, float)):
+        try:
+            return Shaped(typeof(value), numpy.shape(value))
+        except TypeError:
+            return Shaped(None, numpy.shape(value))
+    else:
+        return None
+
+
+def element_type(t):
+    if isinstance(t, Type) and t.name == 'Array':
+        return t.elem_types[0]
+    return t
+
+
+def elementwise_type(types):
+    """
+    Type of the result of an elementwise operation on arguments of the
+    given types. Like numpy, the scalars take the element type of the
+    arrays they are combined with.
+    """
+    arrays = [t for t in types if element_type(t) is not t]
+    elems = {element_type(t) for t in arrays or types}
+    if len(elems) != 1 or None in elems or None in types:
+        return None
+    elem, = elems
+    return Array[elem] if arrays else elem
+
+
+def input_value(node):
+    """
+    Abstract value of an input of a graph, from its ``inferred``
+    property. ``MyiaFunction`` sets the dtype and shape of the arrays
+    it specializes a function for.
+    """
+    inferred = node.inferred
+    if 'dtype' in inferred:
+        elem = type_map.get(inferred['dtype'].name, None)
+        t = elem and Array[elem]
+    else:
+        t = inferred.get('type', None)
+    shape = inferred.get('shape', None)
+    if t is None and shape is None:
+        return None
+    return Shaped(t, shape)
+
+
+class GraphInferrer:
+    """
+    Infer the abstract values of the nodes of IRGraphs.
+
+    Calls are followed into the graphs they call, which are evaluated
+    on the abstract values of the arguments. The results are memoized
+    by graph and arguments, so a graph is only evaluated again for
+    arguments it was not seen with. Since the optimizations preserve
+    what a graph computes, these results remain valid after its nodes
+    are rewritten, and the inference of an optimized graph only
+    evaluates that graph again.
+
+    Builtins are inferred with the type projectors of
+    ``impl_bank['project']`` (see ``proj_type``) and the shape rules
+    of ``builtin_shape``.
+
+    Attributes:
+        max_contexts: Maximal number of distinct arguments a graph is
+            evaluated with. Beyond that, it is evaluated on unknown
+            arguments.
+        max_iterations: Maximal number of iterations to evaluate a
+            recursive call. Beyond that, its result is unknown.
+    """
+
+    def __init__(self, max_contexts=8, max_iterations=20):
+        self.max_contexts = max_contexts
+        self.max_iterations = max_iterations
+        self.summaries = WeakKeyDictionary()
+        self.type_cache = {}
+        # (graph, args) -> current result of the calls being evaluated
+        self.pending = {}
+        # Calls being evaluated, innermost last, and whether they saw
+        # the result of a pending call.
+        self.stack = []
+
+    def infer_type(self, sym, types):
+        key = (sym, tuple(types))
+        if key not in self.type_cache:
+            self.type_cache[key] = self._infer_type(sym, types)
+        return self.type_cache[key]
+
+    def _infer_type(self, sym, types):
+        from ..inference.avm import AbstractValue, WrappedException, load
+        load()
+        proj = impl_bank['project'][builtins.type] \
+            .get(impl_bank['abstract'].get(sym, None), None)
+        if isinstance(proj, Primitive) and None not in types:
+            try:
+                return proj(*[AbstractValue({builtins.type: t})
+                              for t in types])
+            except WrappedException:
+                # The projectors only accept arguments of the same
+                # types, e.g. not an array and a scalar, so fall back
+                # to the rules below.
+                pass
+        if sym in ElementwiseFusionPass.elementwise \
+                or sym == builtins.fused:
+            if sym == builtins.fused:
+                types = types[1:]
+            return elementwise_type(types)
+        elif sym in (builtins.dot, builtins.transpose):
+            t = elementwise_type(types)
+            return t and Array[element_type(t)]
+        elif sym == builtins.sum:
+            t, = types
+            return element_type(t)
+        else:
+            return None
+
+    def infer_builtin(self, sym, args, inputs=None):
+        if BOTTOM in args:
+            return BOTTOM
+        elif sym == builtins.mktuple:
+            return tuple(args)
+        elif sym == builtins.index:
+            tup, _ = args
+            idx = inputs and inputs[1].is_constant() and inputs[1].value
+            if isinstance(tup, tuple) and type(idx) is int \
+                    and -len(tup) <= idx < len(tup):
+                return tup[idx]
+            return None
+        elif sym == builtins.partial:
+            fns, *bound = args
+            if isinstance(fns, frozenset):
+                return frozenset(Partial(fn, tuple(bound)) for fn in fns)
+            return None
+        elif sym == builtins.switch:
+            _, t, f = args
+            return join(t, f)
+        elif sym == builtins.identity:
+            arg, = args
+            return arg
+        if sym in (builtins.fused, builtins.multi_dot):
+            # The first argument is the expression they compute
+            args = [None, *args[1:]]
+        if all(isinstance(arg, Shaped) or arg is None for arg in args):
+            types = [arg and arg.type for arg in args]
+            shapes = [arg and arg.shape for arg in args]
+            if sym == builtins.sum:
+                shape = ()
+            else:
+                shape = builtin_shape(sym, shapes, inputs)
+            t = self.infer_type(sym, types)
+            if t is None and shape is None:
+                return None
+            return Shaped(t, shape)
+        else:
+            return None
+
+    def call(self, fns, args, inputs=None):
+        """
+        Abstract value returned by calling the functions fns on args.
+        """
+        if not isinstance(fns, frozenset):
+            return BOTTOM if fns is BOTTOM else None
+        rval = BOTTOM
+        for fn in fns:
+            if isinstance(fn, Partial):
+                res = self.call(frozenset({fn.fn}), fn.args + tuple(args))
+            elif isinstance(fn, Primitive) or not hasattr(fn, 'inputs'):
+                res = self.infer_builtin(fn, args, inputs)
+            else:
+                res = self.call_graph(fn, tuple(args))
+            rval = join(rval, res)
+        return rval
+
+    def call_graph(self, graph, args):
+        """
+        Abstract value returned by graph on args.
+
+        A recursive call returns the result of the call it recurses
+        into as evaluated so far, starting with BOTTOM, and that call
+        is evaluated again until its result does not change. The
+        calls that depend on such a result are not memoized. A graph
+        that recurses with new arguments is evaluated on wider ones
+        (see ``widen``), so that the recursion terminates.
+        """
+        if len(args) != len(graph.inputs):
+            return None
+        memo = self.summaries.setdefault(graph, {})
+        if args not in memo and len(memo) >= self.max_contexts:
+            args = (None,) * len(args)
+        if args in memo:
+            return memo[args]
+        key = (graph, args)
+        if key not in self.pending:
+            args = self.widen(graph, args)
+            if args in memo:
+                return memo[args]
+            key = (graph, args)
+        if key in self.pending:
+            i = [k for k, _ in self.stack].index(key)
+            for entry in self.stack[i + 1:]:
+                entry[1] = True
+            return self.pending[key]
+
+        self.pending[key] = BOTTOM
+        entry = [key, False]
+        self.stack.append(entry)
+        try:
+            for _ in range(self.max_iterations):
+                res = join(self.pending[key],
+                           self.evaluate(graph, args)[graph.output])
+                if res == self.pending[key]:
+                    break
+                self.pending[key] = res
+            else:
+                res = None
+        finally:
+            self.stack.pop()
+            del self.pending[key]
+        if not entry[1]:
+            memo[args] = res
+        return res
+
+    def widen(self, graph, args):
+        """
+        Arguments to evaluate graph on, when it is called on args. If
+        graph is already being evaluated, they are joined with the
+        arguments of the innermost such call: the join of arguments
+        only goes up finitely many times, e.g. tuples that grow at
+        each recursive call become None.
+        """
+        for (g, prev), _ in reversed(self.stack):
+            if g is graph:
+                return tuple(join(p, a) for p, a in zip(prev, args))
+        return args
+
+    def value(self, node, values):
+        if node in values:
+            return values[node]
+        elif node.is_graph() or node.is_builtin():
+            return frozenset({node.value})
+        elif node.is_constant():
+            return constant_value(node.value)
+        else:
+            return None
+
+    def evaluate(self, graph, args):
+        """
+        Evaluate graph on args, and return the abstract values of its
+        nodes.
+        """
+        values = dict(zip(graph.inputs, args))
+        for node in graph.toposort():
+            fns = self.value(node.fn, values)
+            inputs = [self.value(i, values) for i in node.inputs]
+            values[node] = self.call(fns, inputs, node.inputs)
+        values[graph.output] = self.value(graph.output, values)
+        return values
+
+    def infer(self, graph):
+        """
+        Infer the nodes of graph, given the values of its inputs (see
+        ``input_value``), and store them in their ``inferred``
+        property.
+        """
+        args = tuple(input_value(inp) for inp in graph.inputs)
+        self.call_graph(graph, args)
+        for node, v in self.evaluate(graph, args).items():
+            if v is BOTTOM:
+                v = None
+            if isinstance(v, Shaped):
+                node.inferred.update(type=v.type, shape=v.shape)
+            elif isinstance(v, tuple):
+                node.inferred.update(type=Tuple[tuple(
+                    w.type if isinstance(w, Shaped) else None for w in v
+                )], shape=None)
+            else:
+                node.inferred.update(type=None, shape=None)
+
+
+class InferencePass:
+    """
+    Infer the types and shapes of the nodes of a graph, and store them
+    in ``node.inferred['type']`` and ``node.inferred['shape']``. They
+    are None when they cannot be determined.
+
+    The nodes of the graphs it calls are not annotated, since these
+    graphs may be called with other arguments, but they are inferred
+    when they go through the pass themselves. The pass may run several
+    times in a pipeline, e.g. before and after the optimizations: the
+    results of the calls it found are reused (see ``GraphInferrer``).
+    """
+
+    def __init__(self, inferrer=None):
+        self.inferrer = inferrer or GraphInferrer()
+
+    def __call__(self, universe, graph):
+        self.inferrer.infer(graph)
@@ -1,7 +1,10 @@
 
-from unification import Var, unifiable, unify as _unify, reify
+from unification import Var, unify as _unify, reify
 from unification import isvar  # type: ignore
 from unification.dispatch import dispatch
+from unification.core import _unify as unify_dispatch, \
+    _reify as reify_dispatch
+from typing import Any, Dict
 
 
 # TODO: use the typing module instead. Int8 etc. would have to be defined
@@ -84,11 +87,27 @@ def unify(a, b, U=None):
     return d
 
 
-@unifiable
 class Type:
-    def __init__(self, name, elem_types=None):
-        self.name = name
-        self.elem_types = elem_types
+    """
+    A type, e.g. ``Int64`` or ``Array[Float32]``.
+
+    Types are interned: there is only one Type with a given name and
+    element types, so they are compared by identity and their hash is
+    computed once.
+    """
+
+    _interned: Dict[Any, 'Type'] = {}
+
+    def __new__(cls, name, elem_types=None):
+        key = (name, elem_types)
+        t = cls._interned.get(key, None)
+        if t is None:
+            t = super().__new__(cls)
+            t.name = name
+            t.elem_types = elem_types
+            t._hash = hash(key)
+            cls._interned[key] = t
+        return t
 
     def __getitem__(self, elem_types):
         assert self.elem_types == ()
@@ -97,12 +116,10 @@ class Type:
         return Type(self.name, elem_types)
 
     def __hash__(self):
-        return hash(self.name) ^ hash(self.elem_types)
+        return self._hash
 
-    def __eq__(self, other):
-        return isinstance(other, Type) \
-            and other.name == self.name \
-            and other.elem_types == self.elem_types
+    def __reduce__(self):
+        return (Type, (self.name, self.elem_types))
 
     def __str__(self):
         if self.elem_types:
@@ -115,6 +132,25 @@ class Type:
         return str(self)
 
 
+# Types are unified on their name and element types. Reification builds
+# a new Type through the constructor so that it is interned.
+
+def unify_types(u, v, s):
+    if u.name != v.name:
+        return False
+    return _unify(u.elem_types, v.elem_types, s)
+
+
+def reify_type(t, s):
+    if not t.elem_types:
+        return t
+    return Type(t.name, reify(t.elem_types, s))
+
+
+unify_dispatch.add((Type, Type, dict), unify_types)
+reify_dispatch.add((Type, dict), reify_type)
+
+
 Bool = Type('Bool')
 Float32 = Type('Float32')
 Float64 = Type('Float64')
@@ -1,19 +1,23 @@
 from typing import Dict, Callable, List, Any, Union, Tuple as TupType, Optional
 
 import asyncio
+from sys import getrefcount
 from types import FunctionType
+from numpy import ndarray
 from ..stx import \
     MyiaASTNode, Location, Symbol, ValueNode, LambdaNode, \
     maptup2, python_universe, is_builtin
 from ..lib import \
     Closure, IdempotentMappable, StructuralMap, \
-    Universe, BackedUniverse, is_struct, StructuralMap
+    Universe, BackedUniverse, is_struct, StructuralMap, \
+    universe_map_dispatch
 from ..symbols import builtins
 from ..util import EventDispatcher, HReprBase, buche
 from functools import reduce
 from ..parse import parse_function
 from .vmutil import VMCode, Instruction, VMFunction, VMPrimitive
 from ..ir import IRGraph
+from ..transform import GradCache
 
 # The following two imports fill impl_bank['interp']
 # as a side-effect.
@@ -113,6 +117,22 @@ class VM:
         return self.result
 
 
+def free_buffers(args, candidates):
+    """
+    Return the indexes in ``candidates`` of the arrays in ``args``
+    that own their data and that nothing refers to besides ``args``,
+    so that they can be overwritten.
+    """
+    rval = set()
+    for i in candidates:
+        x = args[i]
+        # The references are args, x and getrefcount's argument.
+        if isinstance(x, ndarray) and x.flags.owndata \
+                and x.flags.writeable and getrefcount(x) <= 3:
+            rval.add(i)
+    return rval
+
+
 class VMFrame(HReprBase):
     """
     Computation frame. There is one frame for each Function
@@ -142,9 +162,14 @@ class VMFrame(HReprBase):
 
     def done(self) -> bool:
         """
-        Whether all instructions have been executed or not.
+        Whether all instructions have been executed or not. A jump
+        to the end counts as the end.
         """
-        return self.pc >= len(self.instructions)
+        n = len(self.instructions)
+        if self.pc >= n:
+            return True
+        instr = self.instructions[self.pc]
+        return instr.command == 'jump' and instr.args[0] >= n
 
     def top(self) -> Any:
         """
@@ -220,7 +245,8 @@ class VMFrame(HReprBase):
                 self.pc -= 1
                 raise
 
-    def instruction_reduce(self, node, nargs) -> Optional['VMFrame']:
+    def instruction_reduce(self, node, nargs, dead=()) \
+            -> Optional['VMFrame']:
         """
         * Pop ``nargs`` values from the stack, call them ``args``
         * Pop the next value, call it ``fn``
@@ -228,16 +254,24 @@ class VMFrame(HReprBase):
           Make a new VMFrame for it and return it. This is important
           because we don't want to grow the Python stack.
         * Otherwise, it's a primitive. Call ``fn(*args)`` and push
-          the result.
+          the result. If the primitive can work in place and some
+          of the arguments at the indexes in ``dead`` are arrays
+          nothing else refers to, it may use them as output buffers.
         """
         fn, *args = self.take(nargs + 1)
         if isinstance(fn, Closure):
             self.push(fn.fn, *fn.args, *args)
-            return self.instruction_reduce(node, nargs + len(fn.args))
+            dead = tuple(i + len(fn.args) for i in dead)
+            return self.instruction_reduce(node, nargs + len(fn.args), dead)
         elif isinstance(fn, VMFunction):
             return self.__class__(self.vm, fn.code, args, self.universe)
         elif callable(fn):
-            value = fn(*args)
+            buffers = dead and getattr(fn, 'inplace', None) \
+                and free_buffers(args, dead)
+            if buffers:
+                value = fn.inplace(buffers, *args)
+            else:
+                value = fn(*args)
             self.push(value)
             return None
         else:
@@ -282,6 +316,27 @@ class VMFrame(HReprBase):
         """
         self.push(self.stack[i])
 
+    def instruction_jump(self, node, target) -> None:
+        """
+        Continue execution at instruction ``target``.
+        """
+        self.pc = target
+
+    def instruction_jump_if(self, node, target) -> None:
+        """
+        Pop a condition. If it is true, continue execution at
+        instruction ``target``.
+        """
+        if self.pop():
+            self.pc = target
+
+    def instruction_drop(self, node, i) -> None:
+        """
+        Release the ith element in the stack, which will not be
+        used anymore.
+        """
+        self.stack[i] = None
+
     def instruction_push(self, node, value) -> None:
         """
         Push ``value`` on the stack.
@@ -307,10 +362,31 @@ class VMFrame(HReprBase):
 
 
 class VMUniverse(BackedUniverse):
-    def __init__(self, parent, primitives, vm_config={}):
+    """
+    Maps graphs to VMFunctions and builtins to VMPrimitives.
+
+    The gradients that are computed while running functions of this
+    universe are stored in ``grad_cache``, which holds at most
+    grad_cache_size entries (no limit if None). The entries it evicts
+    are forgotten by this universe and its parents.
+
+    If memory_budget is given, these gradients are computed with that
+    ``memory_budget`` (see ``Grad``). It is a number of function
+    applications, not of bytes.
+    """
+    def __init__(self, parent, primitives, inplace_primitives={},
+                 vm_config={}, grad_cache_size=1024, memory_budget=None):
         super().__init__(parent)
         self.primitives = primitives
+        self.inplace_primitives = inplace_primitives
         self.vm_config = vm_config
+        self.memory_budget = memory_budget
+        self.grad_cache = GradCache(grad_cache_size, self.forget_grad)
+
+    def forget_grad(self, grad):
+        self.forget(grad)
+        if isinstance(grad, LambdaNode):
+            self.forget(grad.ref)
 
     def acquire(self, x):
         x = self.parent[x]
@@ -320,12 +396,16 @@ class VMUniverse(BackedUniverse):
             return x.__myia_vmfunction__
         elif is_builtin(x):
             prim = self.primitives[x]
-            return VMPrimitive(prim.fn, prim.name, self)
+            return VMPrimitive(prim.fn, prim.name, self,
+                               self.inplace_primitives.get(x))
         elif is_struct(x):
-            return StructuralMap(self.acquire)(x)
+            return StructuralMap(self.acquire, universe_map_dispatch)(x)
         else:
             return x
 
     def run(self, fn, args):
         newargs = [self[arg] for arg in args]
-        return VM(fn.code, newargs, self).run()
+        return self.call(fn, newargs)
+
+    def call(self, fn, args):
+        return VM(fn.code, list(args), self).run()
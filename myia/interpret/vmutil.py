@@ -1,5 +1,6 @@
 
 from typing import Any, List, Callable
+from itertools import count
 from types import FunctionType
 from numpy import ndarray
 from ..util import EventDispatcher, HReprBase
@@ -20,23 +21,37 @@ from ..ir.convert import lambda_to_ir
 
 
 class VMPrimitive(Primitive):
-    def __init__(self, fn, name, universe):
+    def __init__(self, fn, name, universe, inplace=None):
         super().__init__(fn, name)
         self.universe = universe
+        # Variant of fn that may write its result in some of its
+        # arguments, called as inplace(buffers, *args) where buffers
+        # is the set of indexes of the arguments it may overwrite.
+        self.inplace = inplace
 
 
 class VMFunction(Function):
     def __init__(self, graph, universe):
         ast = graph.lbda
         self.ast = ast
-        self.argnames = [a.label for a in ast.args]
+        if ast:
+            self.argnames = [a.label for a in ast.args]
+            self.primal_sym = ast.primal
+        else:
+            # Graphs produced by transformations, e.g. graph_grad
+            self.argnames = [n.tag.label for n in graph.inputs]
+            self.primal_sym = None
         self.args = [n.tag for n in graph.inputs]
         self.graph = graph
         self.universe = universe
         self.code = VMCode(graph)
-        self.primal_sym = ast.primal
         self.__myia_graph__ = graph
 
+    def __call__(self, *args):
+        # Primitives that take functions, e.g. checkpoint, call them
+        # directly.
+        return self.universe.call(self, args)
+
     def __str__(self):
         return f'VMFunc({self.graph.tag or self.graph})'
 
@@ -97,15 +112,58 @@ def make_instructions(graph):
 
     order = [node for node in graph.toposort()
              if len(node.users) > 1]
+    labels = count()
 
     def instr(name, node, *args):
         instrs.append(Instruction(name, node, *args))
 
+    def is_app(node, sym):
+        return node.is_computation() and node.fn.is_builtin() \
+            and node.fn.value == sym and node not in assoc
+
+    def is_switch_call(node):
+        # (switch(cond, f, g))(...) where the switch is only used here
+        sw = node.fn
+        return is_app(sw, builtins.switch) and len(sw.users) == 1
+
+    def call_branch(node, branch):
+        # Call branch on the inputs of node. If branch is a partial
+        # application, call its function directly instead of making
+        # a closure.
+        nonlocal stack_size
+        if is_app(branch, builtins.partial) and len(branch.users) == 1:
+            fn, *args = branch.inputs
+        else:
+            fn, args = branch, []
+        succ = [fn, *args, *node.inputs]
+        for x in succ:
+            convert(x)
+        nargs = len(succ) - 1
+        instr('reduce', node, nargs)
+        stack_size -= nargs
+
     def convert(node, top=False):
         nonlocal stack_size
         if node in assoc:
             instr('dup', node, assoc[node])
             stack_size += 1
+        elif node.is_computation() and is_switch_call(node):
+            # Only evaluate the branch that is taken. The true branch
+            # comes last, so that a call in tail position remains a
+            # tail call.
+            cond, iftrue, iffalse = node.fn.inputs
+            then_label, end_label = next(labels), next(labels)
+            convert(cond)
+            instr('jump_if', node, then_label)
+            stack_size -= 1
+            call_branch(node, iffalse)
+            instr('jump', node, end_label)
+            stack_size -= 1
+            instr('label', node, then_label)
+            call_branch(node, iftrue)
+            instr('label', node, end_label)
+            if len(node.users) > 1:
+                assert top
         elif node.is_computation():
             succ = node.sexp()
             assert all(node for node in succ)
@@ -126,7 +184,7 @@ def make_instructions(graph):
             instr('fetch', node, node.value)
             stack_size += 1
         elif node.is_graph():
-            instr('fetch', node, node.tag)
+            instr('fetch', node, node.value)
             stack_size += 1
         elif node.is_constant():
             instr('push', node, node.value)
@@ -145,7 +203,72 @@ def make_instructions(graph):
 
     convert(graph.output, True)
 
-    return instrs
+    return resolve_labels(plan_memory(instrs, len(graph.inputs)))
+
+
+def resolve_labels(instrs):
+    """
+    Remove the ``label`` pseudo-instructions and replace the labels
+    in jumps by the index of the instruction they point to.
+    """
+    rval = []
+    positions = {}
+    for instr in instrs:
+        if instr.command == 'label':
+            positions[instr.args[0]] = len(rval)
+        else:
+            rval.append(instr)
+    for instr in rval:
+        if instr.command in ('jump', 'jump_if'):
+            instr.args = (positions[instr.args[0]],)
+    return rval
+
+
+def plan_memory(instrs, ninputs):
+    """
+    Liveness analysis for the values held in the stack slots of a
+    frame, i.e. its inputs and the nodes that have several users.
+
+    A ``drop`` instruction is inserted after the last ``dup`` of each
+    slot, so that its value can be freed before the frame ends. Each
+    ``reduce`` instruction is given the indexes of the arguments that
+    are not held by the frame anymore when it executes, so that
+    primitives may reuse them as output buffers.
+    """
+    last_use = {}
+    for i, instr in enumerate(instrs):
+        if instr.command == 'dup':
+            last_use[instr.args[0]] = i
+
+    rval = []
+    # For each value on the stack, whether the stack is the only
+    # place where the frame holds it.
+    stack = [False] * ninputs
+    for i, instr in enumerate(instrs):
+        if instr.command == 'dup':
+            slot, = instr.args
+            stack.append(last_use[slot] == i)
+            rval.append(instr)
+            if last_use[slot] == i:
+                rval.append(Instruction('drop', instr.node, slot))
+        elif instr.command in ('jump', 'jump_if'):
+            # jump_if consumes the condition. The value pushed by the
+            # branch before a jump is pushed by the other branch too.
+            stack.pop()
+            rval.append(instr)
+        elif instr.command == 'label':
+            rval.append(instr)
+        elif instr.command == 'reduce':
+            nargs, = instr.args
+            free = stack[len(stack) - nargs:]
+            del stack[len(stack) - nargs - 1:]
+            dead = tuple(j for j, f in enumerate(free) if f)
+            rval.append(Instruction('reduce', instr.node, nargs, dead))
+            stack.append(len(instr.node.users) <= 1)
+        else:
+            stack.append(False)
+            rval.append(instr)
+    return rval
 
 
 class VMCode(HReprBase):
@@ -166,7 +289,8 @@ class VMCode(HReprBase):
                  instructions: List[Instruction] = None) -> None:
         self.graph = graph
         self.lbda = graph.lbda
-        self.node = None if instructions else self.lbda.body
+        self.node = None if instructions or not self.lbda \
+            else self.lbda.body
         if instructions is None:
             self.instructions: List[Instruction] = []
             self.instructions = make_instructions(self.graph)
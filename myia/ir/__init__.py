@@ -3,3 +3,4 @@ from .graph import *
 from .convert import *
 from .opt import *
 from .pattern import *
+from .grad import *
@@ -8,7 +8,7 @@ from ..parse import parse_function
 from ..transform import a_normal
 from .graph import IRNode, IRGraph
 from ..symbols import builtins
-from ..lib import StructuralMap
+from ..lib import StructuralMap, universe_map_dispatch
 
 
 gen = GenSym(':value')
@@ -83,6 +83,15 @@ def lambda_to_ir(orig_lbda):
     for k, v in let.bindings:
         assign(k, v)
 
+    # Bindings that are never used (e.g. dummies in destructuring
+    # assignments) must not remain registered as users of their
+    # inputs, otherwise these inputs look like they are shared.
+    live = set(g.iternodes())
+    for node in assoc.values():
+        if node.graph is g and node not in live:
+            for role, succ in node.edges():
+                succ.users.discard((role, node))
+
     return rval
 
 
@@ -106,7 +115,7 @@ class SymbolicUniverse(BackedUniverse):
         elif isinstance(x, MyiaASTNode):
             return x
         elif is_struct(x):
-            return StructuralMap(self.acquire)(x)
+            return StructuralMap(self.acquire, universe_map_dispatch)(x)
         try:
             return self.object_map[x]
         except (KeyError, TypeError, ValueError):
@@ -122,6 +131,6 @@ class IRUniverse(BackedUniverse):
         if isinstance(x, LambdaNode):
             return lambda_to_ir(x).value
         elif is_struct(x):
-            return StructuralMap(self.acquire)(x)
+            return StructuralMap(self.acquire, universe_map_dispatch)(x)
         else:
             return x
@@ -0,0 +1,418 @@
+"""
+Reverse-mode automatic differentiation of IRGraphs.
+
+This is the graph counterpart of ``myia.transform.grad``. It follows
+the same conventions, so that graphs and Lambdas transformed either
+way can call each other:
+
+* ``↑G`` takes the J-transformed arguments of ``G`` and returns a
+  tuple ``(↑out, ♢out)``, where ``♢out`` is the backpropagator.
+* ``♢out`` is a closure over the graph ``♦G``. Given the sensitivity
+  of the output, it returns ``(closure_grads, *arg_grads)``, where
+  ``closure_grads`` is the tuple of the sensitivities of the first
+  ``nargs_closure`` arguments.
+"""
+
+
+from typing import Any, Dict, List, Tuple
+from ..stx import GenSym, JTAG, BPROP, BPROP_CLOS, SENS
+from ..symbols import builtins
+from ..transform import find_grad, grad_cache, GradCache
+from .graph import IRGraph, IRNode
+from .opt import is_app
+
+
+agen = GenSym('::grad')
+
+
+def graph_grad(graph: IRGraph, nargs_closure: int = 0,
+               cache: GradCache = None) -> IRGraph:
+    """
+    Return the graph ``↑graph`` for the forward pass of ``graph``,
+    where the first ``nargs_closure`` inputs of ``graph`` are closure
+    arguments. The result is stored in cache (``grad_cache`` if it is
+    None).
+    """
+    if cache is None:
+        cache = grad_cache
+    key = (graph, nargs_closure)
+    fwd = cache.get(key)
+    if fwd is None:
+        # The graph is cached before it is filled in, so that
+        # recursive calls can refer to it.
+        fwd = IRGraph(None, agen(graph.tag, JTAG), graph.gen)
+        cache[key] = fwd
+        try:
+            GraphGrad(graph, nargs_closure, cache).transform(fwd)
+        except Exception:
+            if key in cache:
+                del cache[key]
+            raise
+    return fwd
+
+
+def expand_fused(graph: IRGraph) -> IRGraph:
+    """
+    Return a version of graph where the applications of ``fused`` and
+    ``multi_dot`` are expanded back to the trees of elementwise
+    operations and dot products they evaluate, which have gradients.
+    If there are none, graph is returned as is.
+    """
+    def fused_nodes(g):
+        return [node for node in g.iternodes()
+                if is_app(node, builtins.fused)
+                or is_app(node, builtins.multi_dot)]
+
+    if not fused_nodes(graph):
+        return graph
+
+    g, _, _ = graph.dup(no_mangle=True)
+    for node in fused_nodes(g):
+        treen, *xs = node.inputs
+        multi = is_app(node, builtins.multi_dot)
+
+        def expand(tree, target=None):
+            if isinstance(tree, int):
+                if target is None:
+                    return xs[tree]
+                fn, args = builtins.identity, [xs[tree]]
+            elif not multi:
+                op, *subtrees = tree
+                fn = getattr(builtins, op)
+                args = [expand(t) for t in subtrees]
+            elif tree[0] == 'T':
+                fn, args = builtins.transpose, [expand(tree[1])]
+            else:
+                fn, args = builtins.dot, [expand(t) for t in tree]
+            target = target or IRNode(g, agen(node.tag, '+'))
+            target.set_sexp(IRNode(None, fn, fn), args)
+            return target
+
+        expand(treen.value, node)
+    return g
+
+
+class GraphGrad:
+    """
+    Transform an IRGraph into the graph of its forward pass, which
+    returns its output along with a backpropagator. Use through
+    ``graph_grad``, which caches the results.
+
+    Arguments:
+        primal: The IRGraph to transform. It must not have free
+            variables.
+        nargs_closure: The number of leading inputs of primal that
+            are closure arguments.
+        cache: The GradCache to store the transforms of the functions
+            primal refers to.
+    """
+    def __init__(self, primal: IRGraph, nargs_closure: int = 0,
+                 cache: GradCache = None) -> None:
+        self.primal = primal
+        self.nargs_closure = nargs_closure
+        self.cache = cache
+        self.graph = expand_fused(primal)
+        # node -> ↑node
+        self.tagged_map: Dict[IRNode, IRNode] = {}
+        # node -> ↑f(↑y), for node = f(y)
+        self.result_map: Dict[IRNode, IRNode] = {}
+        # node -> ♢node
+        self.backpropagator_map: Dict[IRNode, IRNode] = {}
+        # node -> contributions to ∇node. A contribution (i, value)
+        # only adds value to the ith element of ∇node.
+        self.contributions: Dict[IRNode, List[Any]] = {}
+        # node -> ∇node
+        self.sensitivity_map: Dict[IRNode, IRNode] = {}
+        # Node in ↑G -> input of ♦G it is passed as
+        self.captures: Dict[IRNode, IRNode] = {}
+
+    def transform(self, fwd: IRGraph = None) -> IRGraph:
+        """
+        Fill in and return fwd, the graph for the forward pass, and
+        the graph for the backward pass it returns a closure on.
+        """
+        g = self.graph
+        self.fwd = fwd or IRGraph(None, agen(g.tag, JTAG), g.gen)
+        self.fwd.primal = self.primal
+        # The Lambdas fwd refers to by symbol, which it keeps alive.
+        self.fwd.pinned = []
+        self.bwd = IRGraph(None, agen(g.tag, BPROP), g.gen)
+
+        self.fwd.inputs = tuple(self.tagged(i) for i in g.inputs)
+        order = g.toposort()
+        for node in order:
+            self.phi(node)
+        out = self.tagged(g.output)
+
+        self.active = self.active_nodes()
+        dout = IRNode(self.bwd, agen(g.output.tag, SENS))
+        self.accum(g.output, dout)
+        for node in reversed(order):
+            if node in self.contributions:
+                self.rho(node)
+
+        n = self.nargs_closure
+        grads = [self.input_sensitivity(i) for i in g.inputs]
+        self.bwd.output = self.app(
+            self.bwd, agen(g.tag, SENS), builtins.mktuple,
+            self.app(self.bwd, agen(g.tag, SENS), builtins.mktuple,
+                     *grads[:n]),
+            *grads[n:]
+        )
+        self.bwd.inputs = tuple(self.captures.values()) + (dout,)
+
+        bprop = self.app(self.fwd, agen(g.output.tag, BPROP_CLOS),
+                         builtins.partial,
+                         IRNode(None, self.bwd.tag, self.bwd),
+                         *self.captures.keys())
+        self.fwd.output = self.app(self.fwd, agen(g.tag, JTAG),
+                                   builtins.mktuple, out, bprop)
+        return self.fwd
+
+    def app(self, graph, tag, fn, *args):
+        """
+        Create a node in graph for the application of fn, which is
+        either an IRNode or a builtin, on args.
+        """
+        if not isinstance(fn, IRNode):
+            fn = IRNode(None, fn, fn)
+        node = IRNode(graph, tag)
+        node.set_sexp(fn, list(args))
+        return node
+
+    def tagged(self, node: IRNode) -> IRNode:
+        """
+        Return ``↑node``:
+
+        * For an input of the graph, a new input.
+        * For another graph or a global, ``J(node)``.
+        * For any other constant, the constant itself.
+        * For a computation, the result of ``phi``.
+        """
+        if node in self.tagged_map:
+            return self.tagged_map[node]
+        elif node.is_graph() or node.is_global():
+            rval = self.app(self.fwd, agen(node.tag, JTAG),
+                            builtins.J, node)
+        elif node.is_constant():
+            rval = node
+        elif node.is_input() and node.graph is self.graph:
+            rval = IRNode(self.fwd, agen(node.tag, JTAG))
+        else:
+            raise Exception(f'Cannot differentiate {self.graph.tag}:'
+                            f' {node.tag} is a free variable.')
+        self.tagged_map[node] = rval
+        return rval
+
+    def phi(self, node: IRNode) -> None:
+        """
+        Compute ``↑node`` and ``♢node`` in the forward graph.
+        """
+        fn, *args = node.sexp()
+        tag = agen(node.tag, JTAG)
+        if is_app(node, builtins.mktuple):
+            # Original:     x = mktuple(y, z)
+            # Transformed:  ↑x = mktuple(↑y, ↑z)
+            rval = self.app(self.fwd, tag, builtins.mktuple,
+                            *[self.tagged(a) for a in args])
+
+        elif self.is_constant_index(node):
+            # Original:     x = index(y, 0)
+            # Transformed:  ↑x = index(↑y, 0)
+            tup, idx = args
+            rval = self.app(self.fwd, tag, builtins.index,
+                            self.tagged(tup), idx)
+
+        elif is_app(node, builtins.partial):
+            # Original:     x = partial(f, y, z)
+            # Transformed:  ↑x = partial(↑f_2, ↑y, ↑z)
+            # where ↑f_2 is the transform of f with 2 closure
+            # arguments.
+            f, *cargs = args
+            if f.is_graph():
+                jg = graph_grad(f.value, len(cargs), self.cache)
+                jf = IRNode(None, jg.tag, jg)
+            elif f.is_global():
+                jlbda = find_grad(f.value, len(cargs), cache=self.cache)
+                self.fwd.pinned.append(jlbda)
+                jf = IRNode(None, jlbda.ref, jlbda.ref)
+            else:
+                raise Exception(
+                    'First argument to partial'
+                    ' should always be a constant function.'
+                )
+            rval = self.app(self.fwd, tag, builtins.partial, jf,
+                            *[self.tagged(a) for a in cargs])
+
+        else:
+            # Original:     x = f(y)
+            # Transformed:  ↑x, ♢x = ↑f(↑y)
+            res = self.app(self.fwd, agen(node.tag, '*'),
+                           self.tagged(fn),
+                           *[self.tagged(a) for a in args])
+            rval = self.app(self.fwd, tag, builtins.index,
+                            res, IRNode(None, agen('idx'), 0))
+            self.result_map[node] = res
+
+        self.tagged_map[node] = rval
+
+    def rho(self, node: IRNode) -> None:
+        """
+        Accumulate the contributions of ``∇node`` to the sensitivities
+        of the nodes node depends on, in the backward graph.
+        """
+        fn, *args = node.sexp()
+        sen = self.sensitivity(node)
+        if is_app(node, builtins.mktuple):
+            # Original:     x = mktuple(y, z)
+            # Transformed:  ∇y, ∇z += ∇x
+            self.accum_multi(args, sen)
+
+        elif self.is_constant_index(node):
+            # Original:     x = index(y, 0)
+            # Transformed:  ∇y[0] += ∇x
+            tup, idx = args
+            self.accum(tup, (idx, sen))
+
+        elif is_app(node, builtins.partial):
+            # Original:     x = partial(f, y, z)
+            # Transformed:  ∇y, ∇z += ∇x
+            self.accum_multi(args[1:], sen)
+
+        else:
+            # Original:     x = f(y)
+            # Transformed:  ∇f, ∇y += ♢x(∇x)
+            bprop = self.capture(self.backpropagator(node))
+            increment = self.app(self.bwd, agen(node.tag, SENS),
+                                 bprop, sen)
+            self.accum_multi([fn, *args], increment)
+
+    def is_constant_index(self, node: IRNode) -> bool:
+        """
+        Whether node indexes a tuple with a constant. Tuples are
+        destructured this way, so we do not go through the gradient
+        of ``index``, which builds a whole tuple of zeros for each
+        element. Negative indexes do go through it, since the length
+        of the tuple is needed to find the element they refer to.
+        """
+        return is_app(node, builtins.index) \
+            and node.inputs[1].is_constant() \
+            and isinstance(node.inputs[1].value, int) \
+            and node.inputs[1].value >= 0
+
+    def backpropagator(self, node: IRNode) -> IRNode:
+        """
+        Return ``♢node``. It is only extracted from the result of
+        ``↑f(↑y)`` when it is needed, which is not the case if node
+        does not depend on the inputs.
+        """
+        if node not in self.backpropagator_map:
+            self.backpropagator_map[node] = self.app(
+                self.fwd, agen(node.tag, BPROP_CLOS), builtins.index,
+                self.result_map[node], IRNode(None, agen('idx'), 1)
+            )
+        return self.backpropagator_map[node]
+
+    def active_nodes(self):
+        """
+        Return the nodes that depend on the inputs of the graph. The
+        other nodes have no sensitivity.
+        """
+        active = set()
+        to_visit = list(self.graph.inputs)
+        while to_visit:
+            node = to_visit.pop()
+            if node in active:
+                continue
+            active.add(node)
+            to_visit.extend(user for _, user in node.users
+                            if isinstance(user, IRNode)
+                            and user.graph is self.graph)
+        return active
+
+    def accum(self, node: IRNode, value: Any) -> None:
+        """
+        Add value to the contributions to ``∇node``. value is either
+        a node, or a tuple ``(i, v)`` to add ``v`` to ``∇node[i]``.
+        """
+        if node in self.active:
+            self.contributions.setdefault(node, []).append(value)
+
+    def accum_multi(self, nodes: List[IRNode], value: IRNode) -> None:
+        """
+        Add each element of the tuple value to the contributions to
+        the sensitivity of the corresponding node.
+        """
+        for i, node in enumerate(nodes):
+            if node in self.active:
+                self.accum(node, self.app(
+                    self.bwd, agen(node.tag, SENS), builtins.index,
+                    value, IRNode(None, agen('idx'), i)
+                ))
+
+    def sensitivity(self, node: IRNode) -> IRNode:
+        """
+        Return ``∇node``, the sum of its contributions. All of them
+        must have been accumulated.
+        """
+        if node in self.sensitivity_map:
+            return self.sensitivity_map[node]
+
+        def sens(fn, *args):
+            return self.app(self.bwd, agen(node.tag, SENS), fn, *args)
+
+        # A contribution (i, v) to ∇node is the Sparse sensitivity
+        # sparse(i, v), so ∇node is only made dense if node is an
+        # input (see input_sensitivity).
+        contributions = [c if isinstance(c, IRNode)
+                         else sens(builtins.sparse, *c)
+                         for c in self.contributions.pop(node)]
+        rval, *rest = contributions
+        for value in rest:
+            rval = sens(builtins.add, rval, value)
+        self.sensitivity_map[node] = rval
+        return rval
+
+    def primal_value(self, node: IRNode) -> IRNode:
+        """
+        Return ``Jinv(↑node)`` in the backward graph.
+        """
+        return self.app(self.bwd, agen(node.tag, '*'), builtins.Jinv,
+                        self.capture(self.tagged(node)))
+
+    def zeros(self, node: IRNode) -> IRNode:
+        """
+        Return ``zeros_like(Jinv(↑node))``, a zero sensitivity for
+        node.
+        """
+        return self.app(self.bwd, agen(node.tag, SENS),
+                        builtins.zeros_like, self.primal_value(node))
+
+    def conformant(self, node: IRNode, sen: IRNode) -> IRNode:
+        """
+        Return ``fill_zeros(sen, Jinv(↑node))``, which replaces the
+        symbolic ``ZERO`` sensitivities in sen by actual zeros.
+        """
+        return self.app(self.bwd, agen(node.tag, SENS),
+                        builtins.fill_zeros, sen, self.primal_value(node))
+
+    def input_sensitivity(self, node: IRNode) -> IRNode:
+        """
+        Return ``∇node`` for an input of the graph, made conformant
+        with it, or a zero if it has no sensitivity.
+        """
+        if node in self.contributions:
+            return self.conformant(node, self.sensitivity(node))
+        return self.zeros(node)
+
+    def capture(self, node: IRNode) -> IRNode:
+        """
+        Return the node to use in the backward graph for node, which
+        is in the forward graph. Unless it is a constant, it is passed
+        to the backward graph as a closure argument.
+        """
+        if node.is_constant():
+            return node
+        if node not in self.captures:
+            self.captures[node] = IRNode(self.bwd, node.tag)
+        return self.captures[node]
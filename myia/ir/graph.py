@@ -1,6 +1,7 @@
 
 from buche import buche
 from ..util import Singleton
+from ..lib import Universe
 from ..stx import top as about_top, is_builtin, is_global, Symbol, TMP
 import json
 import os
@@ -102,7 +103,8 @@ class IRNode(AbstractNode):
         users: Set of incoming edges. Each edge is a (role, node)
             tuple where role is FN or IN(i)
         value: Value taken by this node.
-        inferred: TODO
+        inferred: Information inferred about the node, e.g. its
+            ``type`` and ``shape`` (see ``InferencePass``).
         about: Tracks source code location and sequence of
             transformations and optimizations for this node.
     """
@@ -289,6 +291,8 @@ class IRGraph(AbstractNode):
             graph.
         inputs: A tuple of input IRNodes for this graph.
         output: The IRNode representing the output of this graph.
+        primal: If this graph was obtained by differentiating another
+            graph (see ``graph_grad``), that graph. Otherwise, None.
     """
     def __init__(self, parent, tag, gen):
         self.parent = parent
@@ -296,6 +300,7 @@ class IRGraph(AbstractNode):
         self.inputs = []
         self._output = None
         self.gen = gen
+        self.primal = None
         # Legacy
         self.lbda = None
 
@@ -331,10 +336,11 @@ class IRGraph(AbstractNode):
             self._output = None
         node.users.remove((role, self))
 
-    def dup(self, g=None, no_mangle=False):
+    def dup(self, g=None, no_mangle=False, mapping=None):
         """
         Duplicate this graph, optionally setting g as the parent of
-        every node in the graph.
+        every node in the graph. If mapping is given, each node of
+        this graph is mapped to its copy in it.
 
         Return the new graph (or g), a list of inputs, and the output
         node.
@@ -342,7 +348,9 @@ class IRGraph(AbstractNode):
         set_io = g is None
         if not g:
             g = IRGraph(self.parent, self.tag, self.gen)
-        mapping = {}
+            g.primal = self.primal
+        if mapping is None:
+            mapping = {}
         for node in self.inputs + tuple(self.iternodes()):
             if no_mangle:
                 mapping[node] = IRNode(g, node.tag, node.value)
@@ -409,6 +417,23 @@ class IRGraph(AbstractNode):
     def iterboundary(self):
         return self.iternodes(True)
 
+    def itergraphs(self):
+        """
+        Iterate over this graph and every graph it refers to,
+        directly or indirectly.
+        """
+        to_visit = [self]
+        seen = set()
+        while to_visit:
+            g = to_visit.pop()
+            if g in seen:
+                continue
+            seen.add(g)
+            yield g
+            for node in g.iterboundary():
+                if node.is_graph():
+                    to_visit.append(node.value)
+
     def iterparents(self, stop=None):
         g = self
         while g and g is not stop:
@@ -440,6 +465,9 @@ class IRGraph(AbstractNode):
         return rval
 
 
+Universe.__cachable__ += (IRGraph,)  # type: ignore
+
+
 class GraphPrinter:
     """
     Helper class to print Myia graphs.
@@ -1,8 +1,14 @@
 
-from ..lib import BackedUniverse, is_struct, StructuralMap, Primitive
-from .graph import IRGraph, IRNode
+import numpy
+from functools import reduce
+from ..lib import BackedUniverse, is_struct, StructuralMap, Primitive, \
+    universe_map_dispatch
+from .graph import IRGraph, IRNode, FN, IN, commit
+from .pattern import EquilibriumTransformer, inline, is_recursive, rules, \
+    effectful_builtins
 from ..symbols import builtins
 from ..stx import GenSym, is_builtin
+from ..impl.impl_interp import matrix_chain_order, dot_tree_flatten
 from buche import buche
 
 
@@ -23,10 +29,13 @@ class OptimizedUniverse(BackedUniverse):
                 g.lbda = x.lbda
                 x = g
             self.cache[orig_x] = x
+            # Graphs may be acquired again from the constants that
+            # refer to them.
+            self.cache[x] = x
             self.optimize(x)
             return x
         elif is_struct(x):
-            return StructuralMap(self.acquire)(x)
+            return StructuralMap(self.acquire, universe_map_dispatch)(x)
         else:
             return x
 
@@ -97,3 +106,685 @@ class ClosureUnconversionPass:
                     pool.add(node.value)
                 elif node.fn and isinstance(node.fn.value, IRGraph):
                     pool.add(node.fn.value)
+
+
+class DotChainPass:
+    """
+    Collapse chains of ``dot`` and ``transpose`` applications into a
+    single ``multi_dot``, which chooses the cheapest order of the
+    products given the shapes of its operands.
+
+    Only the nodes that are used once, by the chain itself, are
+    collapsed. Chains with a single product are left alone.
+    """
+
+    def is_op(self, node, sym):
+        return node.fn is not None and node.fn.is_builtin() \
+            and node.fn.value == sym
+
+    def is_chain(self, node):
+        return self.is_op(node, builtins.dot) \
+            or (self.is_op(node, builtins.transpose)
+                and self.is_op(node.inputs[0], builtins.dot))
+
+    def collapse(self, node, leaves, inner):
+        # Returns the product tree for node, accumulating operands
+        # in leaves and collapsed nodes in inner.
+        def sub(n):
+            if n.graph is node.graph and len(n.users) == 1 \
+                    and (self.is_chain(n)
+                         or self.is_op(n, builtins.transpose)):
+                inner.append(n)
+                return self.collapse(n, leaves, inner)
+            leaves.append(n)
+            return len(leaves) - 1
+
+        if self.is_op(node, builtins.dot):
+            return tuple(sub(inp) for inp in node.inputs)
+        else:
+            return ('T', sub(node.inputs[0]))
+
+    def __call__(self, universe, graph):
+        for g in graph.itergraphs():
+            done = set()
+            for node in reversed(g.toposort()):
+                if node in done or not self.is_chain(node):
+                    continue
+                leaves = []
+                inner = []
+                tree = self.collapse(node, leaves, inner)
+                done.update(inner)
+                if len(leaves) < 3:
+                    continue
+                fn = IRNode(None, builtins.multi_dot, builtins.multi_dot)
+                treen = IRNode(None, ogen(node.tag, '@'), tree)
+                node.set_sexp(fn, [treen] + leaves)
+                # The collapsed nodes are not used anymore.
+                for n in inner:
+                    for role, succ in n.edges():
+                        succ.users.discard((role, n))
+
+
+class ElementwiseFusionPass:
+    """
+    Fuse connected regions of elementwise operations into a single
+    ``fused`` call, which evaluates the whole region with NumPy ufuncs
+    and reuses its intermediate arrays as output buffers.
+
+    An operation is fused into its consumer when the consumer is its
+    only user. Regions with a single operation are left alone.
+    """
+
+    elementwise = {builtins.add, builtins.subtract, builtins.multiply,
+                   builtins.divide, builtins.power, builtins.unary_subtract,
+                   builtins.exp, builtins.log}
+
+    def op(self, node):
+        if node.fn is not None and node.fn.is_builtin() \
+                and node.fn.value in self.elementwise:
+            return node.fn.value
+        else:
+            return None
+
+    def collapse(self, node, leaves, inner):
+        # Returns the expression tree for node, accumulating operands
+        # in leaves and fused nodes in inner.
+        def sub(n):
+            if n.graph is node.graph and len(n.users) == 1 and self.op(n):
+                inner.append(n)
+                return self.collapse(n, leaves, inner)
+            if n not in leaves:
+                leaves.append(n)
+            return leaves.index(n)
+
+        return (self.op(node).label,) + tuple(sub(i) for i in node.inputs)
+
+    def __call__(self, universe, graph):
+        for g in graph.itergraphs():
+            done = set()
+            for node in reversed(g.toposort()):
+                if node in done or not self.op(node):
+                    continue
+                leaves = []
+                inner = []
+                tree = self.collapse(node, leaves, inner)
+                done.update(inner)
+                if not inner:
+                    continue
+                fn = IRNode(None, builtins.fused, builtins.fused)
+                treen = IRNode(None, ogen(node.tag, '@'), tree)
+                node.set_sexp(fn, [treen] + leaves)
+                # The fused nodes are not used anymore.
+                for n in inner:
+                    for role, succ in n.edges():
+                        succ.users.discard((role, n))
+
+
+def broadcast_shape(shapes):
+    """
+    Shape of the result of an elementwise operation on arguments of
+    the given shapes, or None if it cannot be determined.
+    """
+    if any(s is None or None in s for s in shapes):
+        return None
+    n = max(len(s) for s in shapes)
+    rval = []
+    for dims in zip(*[(1,) * (n - len(s)) + tuple(s) for s in shapes]):
+        ds = {d for d in dims if d != 1}
+        if len(ds) > 1:
+            return None
+        rval.append(ds.pop() if ds else 1)
+    return tuple(rval)
+
+
+def dot_shape(s1, s2):
+    """
+    Shape of the result of ``dot`` on arguments of the given shapes,
+    or None if it cannot be determined.
+    """
+    if s1 is None or s2 is None or len(s1) not in (1, 2) \
+            or len(s2) not in (1, 2) or s1[-1] != s2[0] or s1[-1] is None:
+        return None
+    return s1[:-1] + s2[1:]
+
+
+def node_shape(node):
+    """
+    Shape of the value of node, as found in its ``inferred`` property
+    or from its value if it is a constant, or None if unknown.
+    """
+    if node.is_constant():
+        if isinstance(node.value, (numpy.ndarray, numpy.generic,
+                                   int, float, bool)):
+            return numpy.shape(node.value)
+        return None
+    return node.inferred.get('shape', None)
+
+
+def builtin_shape(sym, shapes, inputs=None):
+    """
+    Shape of the result of the builtin sym on arguments of the given
+    shapes, or None if it cannot be determined. inputs are the nodes
+    of the arguments, if they are known, to read the constant ones.
+    """
+    if sym in ElementwiseFusionPass.elementwise:
+        return broadcast_shape(shapes)
+    elif sym == builtins.fused:
+        return broadcast_shape(shapes[1:])
+    elif sym == builtins.transpose:
+        s, = shapes
+        return s and tuple(reversed(s))
+    elif sym == builtins.dot:
+        return dot_shape(*shapes)
+    elif sym == builtins.multi_dot:
+        if not inputs or not inputs[0].is_constant():
+            return None
+        chain = dot_tree_flatten(inputs[0].value)
+        leaves = shapes[1:]
+        if any(leaves[i] is None for i, _ in chain):
+            return None
+        return reduce(dot_shape, [tuple(reversed(leaves[i])) if t
+                                  else leaves[i] for i, t in chain])
+    else:
+        return None
+
+
+class StaticDotChainPass:
+    """
+    Replace the ``multi_dot`` calls (see ``DotChainPass``) whose
+    operand shapes are known (see ``InferencePass``) by ``dot``
+    products in the cheapest order, so that it does not need to be
+    computed on each call.
+    """
+
+    def __call__(self, universe, graph):
+        for node in graph.toposort():
+            if not (node.fn.is_builtin()
+                    and node.fn.value == builtins.multi_dot):
+                continue
+            tree, *leaves = node.inputs
+            chain = dot_tree_flatten(tree.value)
+            shapes = [node_shape(leaves[i]) for i, _ in chain]
+            if any(s is None or None in s or len(s) not in (1, 2)
+                   for s in shapes) \
+                    or any(len(s) != 2 for s in shapes[1:-1]):
+                continue
+
+            mats = []
+            for i, t in chain:
+                leaf = leaves[i]
+                if t:
+                    leaf = IRNode(graph, ogen(leaf.tag, '\''))
+                    leaf.set_sexp(IRNode(None, builtins.transpose,
+                                         builtins.transpose),
+                                  [leaves[i]])
+                mats.append(leaf)
+            dims = [shapes[0][0] if len(shapes[0]) == 2 else 1] \
+                + [s[-1] for s in shapes[:-1]] \
+                + [shapes[-1][1] if len(shapes[-1]) == 2 else 1]
+            split = matrix_chain_order(dims)
+            dot = IRNode(None, builtins.dot, builtins.dot)
+
+            def product(i, j, n=None):
+                if i == j:
+                    return mats[i]
+                k = split[i][j]
+                n = n or IRNode(graph, ogen(node.tag, '@'))
+                n.set_sexp(dot, [product(i, k), product(k + 1, j)])
+                return n
+
+            product(0, len(mats) - 1, node)
+
+
+def is_app(node, sym):
+    """
+    Whether node is an application of the builtin sym.
+    """
+    return node.fn is not None and node.fn.is_builtin() \
+        and node.fn.value == sym
+
+
+def discard(node):
+    """
+    Remove node from the users of its inputs if it has no users
+    itself, and do the same for these inputs.
+    """
+    if node.users or not node.is_computation():
+        return
+    edges = node.edges()
+    for role, succ in edges:
+        succ.users.discard((role, node))
+    for _, succ in edges:
+        discard(succ)
+
+
+def only_called(node):
+    """
+    Whether the closure node is only ever called, either directly or
+    after being selected by a switch.
+
+    A closure that is passed elsewhere may be inspected (e.g. its
+    gradient mirrors its arguments), so its arguments must be left
+    alone.
+    """
+    for role, user in node.users:
+        if role is FN:
+            continue
+        elif role in (IN(1), IN(2)) and is_app(user, builtins.switch) \
+                and all(r is FN for r, _ in user.users):
+            continue
+        return False
+    return True
+
+
+def callee(node):
+    """
+    The graph that node calls or partially applies, if any.
+    """
+    if node.fn and node.fn.is_graph():
+        return node.fn.value
+    elif is_app(node, builtins.partial) and node.inputs[0].is_graph():
+        return node.inputs[0].value
+    return None
+
+
+def call_args(node):
+    """
+    The arguments given to the callee of node.
+    """
+    return node.inputs[1:] if is_app(node, builtins.partial) \
+        else node.inputs
+
+
+def set_callee(node, graph, args):
+    """
+    Make node call or partially apply graph on args instead.
+    """
+    fn = IRNode(None, graph.tag, graph)
+    if is_app(node, builtins.partial):
+        node.set_sexp(node.fn, [fn, *args])
+    else:
+        node.set_sexp(fn, args)
+
+
+def call_sites(graphs):
+    """
+    Map each graph referred to in graphs to the list of (node, args)
+    where it is called or partially applied, or to None if it is also
+    used in another way.
+    """
+    sites = {}
+    for g in graphs:
+        if g.output.is_graph():
+            sites[g.output.value] = None
+        for node in g.iternodes():
+            for role, succ in node.edges():
+                if not succ.is_graph():
+                    continue
+                entries = sites.setdefault(succ.value, [])
+                if entries is None:
+                    continue
+                elif role is FN or role == IN(0) \
+                        and is_app(node, builtins.partial) \
+                        and only_called(node):
+                    entries.append((node, call_args(node)))
+                else:
+                    sites[succ.value] = None
+    return sites
+
+
+def copy_graph(universe, graph, mapping=None):
+    """
+    Copy graph under a fresh tag. If mapping is given, each node of
+    graph is mapped to its copy in it.
+    """
+    g, _, _ = graph.dup(no_mangle=True, mapping=mapping)
+    g.lbda = graph.lbda
+    g.tag = ogen(graph.tag, '*')
+    return g
+
+
+class TupleFlatteningPass:
+    """
+    Pass tuples to the internal graphs of a program as separate
+    arguments.
+
+    A graph is internal if it is only called directly, or partially
+    applied, by the graphs the pass runs on. When every call to an
+    internal graph gives it a tuple of the same length for some
+    parameter, the graph is replaced by a copy that takes the elements
+    of that tuple as separate parameters. Calls to graphs that are not
+    recursive and return a tuple which is only indexed are inlined.
+
+    The structural rules then remove the tuples that were only built
+    to be indexed. As a result, the state of loops is carried in
+    separate parameters instead of a tuple built at each iteration.
+    """
+
+    def arities(self, root, graphs, sites):
+        # Length of the tuple passed to each parameter of each graph
+        # (None if it is not always a tuple of the same length), and
+        # returned by each graph. This is an optimistic fixpoint:
+        # TOP means that nothing contradicted any length yet.
+        TOP = object()
+
+        def meet(a, b):
+            if a is TOP:
+                return b
+            elif b is TOP or a == b:
+                return a
+            else:
+                return None
+
+        def thunk(node):
+            # Length of the tuple returned by calling node.
+            if node.is_graph():
+                return out[node.value]
+            elif is_app(node, builtins.partial):
+                f = node.inputs[0]
+                if f.is_graph():
+                    return out[f.value]
+                elif f.is_builtin() and f.value == builtins.identity \
+                        and len(node.inputs) == 2:
+                    return arity(node.inputs[1])
+            return None
+
+        def arity(node):
+            if node.is_constant():
+                return len(node.value) \
+                    if isinstance(node.value, tuple) else None
+            elif node.is_input():
+                return params.get(node, None)
+            elif is_app(node, builtins.mktuple):
+                return len(node.inputs)
+            elif is_app(node, builtins.identity):
+                return arity(node.inputs[0])
+            elif is_app(node.fn, builtins.switch):
+                _, iftrue, iffalse = node.fn.inputs
+                return meet(thunk(iftrue), thunk(iffalse))
+            else:
+                return thunk(node.fn)
+
+        out = {g: TOP for g in graphs}
+        params = {inp: TOP for g in graphs
+                  if g is not root and sites.get(g, None)
+                  for inp in g.inputs}
+        changed = True
+        while changed:
+            changed = False
+            for g in graphs:
+                a = arity(g.output)
+                changed |= a != out[g]
+                out[g] = a
+            for g in graphs:
+                if g is root or not sites.get(g, None):
+                    continue
+                for i, inp in enumerate(g.inputs):
+                    a = TOP
+                    for _, args in sites[g]:
+                        a = meet(a, arity(args[i]) if i < len(args)
+                                 else None)
+                    changed |= a != params[inp]
+                    params[inp] = a
+        return {inp: a for inp, a in params.items()
+                if isinstance(a, int) and a > 0}
+
+    def flatten(self, universe, g, arities):
+        # Copy g, with the parameters in arities split in as many
+        # parameters as there are elements in their tuple.
+        g2 = copy_graph(universe, g)
+        inputs = g2.inputs
+        mktuple = IRNode(None, builtins.mktuple, builtins.mktuple)
+        new_inputs = []
+        for inp, inp2 in zip(g.inputs, inputs):
+            if inp in arities:
+                parts = [IRNode(g2, ogen(inp.tag, f'[{i}]'))
+                         for i in range(arities[inp])]
+                if inp2.users:
+                    tup = IRNode(g2, inp2.tag)
+                    tup.set_sexp(mktuple, parts)
+                    inp2.redirect(tup)
+                new_inputs += parts
+            else:
+                new_inputs.append(inp2)
+        g2.inputs = tuple(new_inputs)
+        return g2
+
+    def expand(self, node, args, g, arities):
+        # Arguments to give to the flattened copy of g instead of args.
+        index = IRNode(None, builtins.index, builtins.index)
+        rval = []
+        for arg, inp in zip(args, g.inputs):
+            if inp not in arities:
+                rval.append(arg)
+            elif is_app(arg, builtins.mktuple):
+                rval += arg.inputs
+            else:
+                for i in range(arities[inp]):
+                    n = IRNode(node.graph, ogen(arg.tag, f'[{i}]'))
+                    n.set_sexp(index, [arg, IRNode(None, ogen('idx'), i)])
+                    rval.append(n)
+        return rval + list(args[len(g.inputs):])
+
+    def returns_tuple(self, g):
+        out = g.output
+        while is_app(out, builtins.identity):
+            out = out.inputs[0]
+        return is_app(out, builtins.mktuple)
+
+    def __call__(self, universe, root):
+        graphs = list(root.itergraphs())
+        sites = call_sites(graphs)
+        arities = self.arities(root, graphs, sites)
+
+        copies = {}
+        for g in graphs:
+            if any(inp in arities for inp in g.inputs):
+                copies[g] = self.flatten(universe, g, arities)
+
+        for g in graphs + list(copies.values()):
+            for node in list(g.iternodes()):
+                orig = callee(node)
+                if orig not in copies:
+                    continue
+                old = list(node.inputs)
+                args = self.expand(node, call_args(node), orig, arities)
+                set_callee(node, copies[orig], args)
+                for arg in old:
+                    discard(arg)
+
+        for g in list(root.itergraphs()):
+            for node in list(g.iternodes()):
+                if node.fn and node.fn.is_graph() \
+                        and self.returns_tuple(node.fn.value) \
+                        and not is_recursive(node.fn.value) \
+                        and node.users \
+                        and all(role == IN(0) and is_app(user, builtins.index)
+                                for role, user in node.users):
+                    commit(inline.handler(universe, node,
+                                          node.fn, node.inputs))
+                    discard(node)
+
+        eq = EquilibriumTransformer(universe, [root],
+                                    rules('structural', 'calls'))
+        eq.run()
+
+
+class LoopInvariantPass:
+    """
+    Hoist the computations of loops that only depend on values that
+    are the same at every iteration.
+
+    Loops are groups of mutually recursive graphs with a single entry,
+    which are only ever called, directly or through partial
+    application. A parameter is invariant if every recursive call
+    gives it back the value it had on entry. Applications of pure
+    builtins on invariant parameters and constants are computed once,
+    and the results are passed down to every graph of the loop as
+    extra parameters.
+
+    Since these computations may fail, e.g. a division by zero, they
+    must not be performed if the loop would not perform them. The
+    first iteration of the loop is thus peeled: the call sites of the
+    entry call a copy of the loop which computes everything, and
+    whose recursive calls compute the hoisted values and enter the
+    optimized loop. Only the computations of the entry, and of the
+    graph that makes all the recursive calls to it, are hoisted: the
+    first iteration went through them before the recursive calls.
+    """
+
+    control = {builtins.switch, builtins.partial}
+
+    def loops(self, graphs):
+        # Groups of mutually recursive graphs.
+        reach = {g: set(g.itergraphs()) for g in graphs}
+        loops = []
+        for g in graphs:
+            scc = {h for h in reach[g] if g in reach.get(h, ())}
+            if is_recursive(g) and scc not in loops:
+                loops.append(scc)
+        return loops
+
+    def origins(self, entry, loop, outside, inside):
+        # Map each invariant parameter of the graphs in the loop to the
+        # index of the parameter of the entry it is equal to. Like in
+        # TupleFlatteningPass, this is an optimistic fixpoint.
+        TOP = object()
+        nknown = min(len(args) for _, args in outside)
+        origins = {inp: i if i < nknown else None
+                   for i, inp in enumerate(entry.inputs)}
+        for g in loop:
+            if g is not entry:
+                origins.update((inp, TOP) for inp in g.inputs)
+
+        changed = True
+        while changed:
+            changed = False
+            for g in loop:
+                for i, inp in enumerate(g.inputs):
+                    o = origins[inp] if g is entry else TOP
+                    for _, args in inside[g]:
+                        arg = args[i] if i < len(args) else None
+                        a = origins.get(arg, None)
+                        o = a if o is TOP else o if a is TOP or a == o \
+                            else None
+                    changed |= o is not origins[inp]
+                    origins[inp] = o
+        return {inp: o for inp, o in origins.items()
+                if isinstance(o, int)}
+
+    def invariant(self, node, origins, cache):
+        if node not in cache:
+            if node.is_input():
+                cache[node] = node in origins
+            elif node.is_constant():
+                cache[node] = not node.is_graph()
+            else:
+                cache[node] = node.fn.is_builtin() \
+                    and node.fn.value not in effectful_builtins \
+                    and node.fn.value not in self.control \
+                    and all(self.invariant(i, origins, cache)
+                            for i in node.inputs)
+        return cache[node]
+
+    def hoistable(self, loop, origins):
+        # The largest invariant computations of each graph in loop.
+        rval = []
+        cache = {}
+        for g in loop:
+            for node in g.iternodes():
+                if node.is_computation() \
+                        and self.invariant(node, origins, cache) \
+                        and (node is g.output or not all(
+                            self.invariant(user, origins, cache)
+                            for _, user in node.users)):
+                    rval.append(node)
+        return rval
+
+    def rebuild(self, node, origins, args, graph, cache):
+        # Copy the expression of node in graph, where the parameters of
+        # the loop are replaced by the args given to the entry.
+        if node not in cache:
+            if node.is_input():
+                cache[node] = args[origins[node]]
+            elif node.is_constant():
+                cache[node] = node
+            else:
+                n = IRNode(graph, node.tag)
+                n.set_sexp(node.fn, [self.rebuild(i, origins, args,
+                                                  graph, cache)
+                                     for i in node.inputs])
+                cache[node] = n
+        return cache[node]
+
+    def hoist(self, universe, loop, graphs):
+        outside = call_sites(g for g in graphs if g not in loop)
+        entries = [g for g in loop if g in outside]
+        if len(entries) != 1 or not outside[entries[0]]:
+            return False
+        entry, = entries
+        inside = call_sites(loop)
+        if any(inside.get(g, None) is None for g in loop):
+            return False
+
+        originals = {}
+        copies = {g: copy_graph(universe, g, originals) for g in loop}
+        originals = {n2: n for n, n2 in originals.items()}
+        for g2 in copies.values():
+            for node in list(g2.iternodes()):
+                if callee(node) in copies:
+                    set_callee(node, copies[callee(node)], call_args(node))
+        loop2 = list(copies.values())
+        entry2 = copies[entry]
+        inside2 = call_sites(loop2)
+        origins = self.origins(entry2, loop2, outside[entry], inside2)
+        recursing = {node.graph for node, _ in inside2[entry2]}
+        safe = [entry2, *recursing] if len(recursing) == 1 else [entry2]
+        hoisted = self.hoistable(safe, origins)
+        if not hoisted:
+            return False
+
+        # The peeled first iteration. Its recursive calls reuse the
+        # hoisted nodes of their own graph, and compute those of the
+        # entry.
+        first = {}
+        peeled = {g: copy_graph(universe, g, first) for g in loop}
+        for g2 in peeled.values():
+            for node in list(g2.iternodes()):
+                if callee(node) is entry:
+                    args = call_args(node)
+                    cache = {}
+                    values = [first[originals[h]]
+                              if first[originals[h]].graph is g2
+                              else self.rebuild(h, origins, args, g2, cache)
+                              for h in hoisted]
+                    set_callee(node, entry2, values + list(args))
+                elif callee(node) in peeled:
+                    set_callee(node, peeled[callee(node)], call_args(node))
+        for node, args in outside[entry]:
+            set_callee(node, peeled[entry], args)
+
+        params = {g2: [IRNode(g2, ogen(h.tag, '^')) for h in hoisted]
+                  for g2 in loop2}
+        for g2 in loop2:
+            for node in list(g2.iternodes()):
+                if callee(node) in params:
+                    set_callee(node, callee(node),
+                               params[g2] + list(call_args(node)))
+        for i, h in enumerate(hoisted):
+            p = params[h.graph][i]
+            if h is h.graph.output:
+                h.graph.output = p
+            h.redirect(p)
+            discard(h)
+        for g2 in loop2:
+            g2.inputs = tuple(params[g2]) + g2.inputs
+        return True
+
+    def __call__(self, universe, root):
+        changed = True
+        while changed:
+            graphs = list(root.itergraphs())
+            changed = any(self.hoist(universe, loop, graphs)
+                          for loop in self.loops(graphs)
+                          if root not in loop)
@@ -1,10 +1,13 @@
 
-from ..lib import Closure
+import numpy
+from ..lib import Closure, ZERO
 from ..stx import is_global, is_builtin, GenSym
-from ..inference.types import var, unify, isvar
+from ..inference.types import var, unify, isvar, typeof, type_map, \
+    Bool, Float32, Float64, Number
 from ..symbols import builtins
 from .graph import IRNode, IRGraph, NO_VALUE
 from collections import defaultdict
+from typing import Any, Dict, List
 from buche import buche
 
 
@@ -21,6 +24,22 @@ def fnvar(name):
     return var(name, lambda x: x.is_graph())
 
 
+def constvar(name, *values):
+    """
+    Variable that only matches scalar constants equal to one of the
+    given values. Arrays and other structures never match, which
+    means the test never has to compare them elementwise, and neither
+    do booleans, although ``True == 1``.
+    """
+    def check(node):
+        v = node.value
+        return node.is_constant() \
+            and isinstance(v, (int, float)) \
+            and not isinstance(v, bool) \
+            and v in values
+    return var(name, check)
+
+
 def globalvar(name):
     return var(name, lambda x: x.is_constant() and
                is_global(x.value) and
@@ -35,6 +54,57 @@ V1 = valuevar('V1')
 V2 = valuevar('V2')
 GV = globalvar('GV')
 L = fnvar('L')
+ZERO_V = constvar('ZERO_V', 0)
+ONE_V = constvar('ONE_V', 1)
+TWO_V = constvar('TWO_V', 2)
+SZ = var('SZ', lambda x: x.is_constant() and x.value is ZERO)
+SZ2 = var('SZ2', lambda x: x.is_constant() and x.value is ZERO)
+
+
+float_types = {Float32, Float64}
+int_types = Number - float_types
+
+
+def elem_type(node):
+    """
+    Type of the value of node, or of its elements if it is an array,
+    from its value if it is a constant or else from its ``inferred``
+    property (see ``InferencePass``). None if it is unknown.
+    """
+    if node.is_constant():
+        try:
+            t = typeof(node.value)
+        except TypeError:
+            return None
+    elif 'dtype' in node.inferred:
+        return type_map.get(node.inferred['dtype'].name, None)
+    else:
+        t = node.inferred.get('type', None)
+    if t is not None and t.name == 'Array':
+        t, = t.elem_types
+    return t
+
+
+def keeps_type(const, X):
+    """
+    Whether an arithmetic operation between the constant node const
+    and X has the type of X, so that a rule may rewrite it to an
+    expression of X alone. An int constant leaves the type of numbers
+    and arrays unchanged (though not of booleans), whereas a float
+    constant only does if X is known to hold floats: with an int x,
+    ``x + 0.0`` is a float.
+    """
+    t = elem_type(X)
+    if type(const.value) is int:
+        return t is not Bool
+    return t in float_types
+
+
+def builtin_node(sym):
+    """
+    Create a constant node for the given builtin.
+    """
+    return IRNode(None, sym, sym)
 
 
 class PatternOpt:
@@ -42,6 +112,18 @@ class PatternOpt:
         self.pattern = pattern
         self.handler = handler
 
+    @property
+    def head(self):
+        """
+        The function a node must apply for the pattern to match it,
+        or None if the pattern may match any node.
+        """
+        p = self.pattern
+        if isinstance(p, tuple) and p and not isvar(p[0]) \
+                and not isinstance(p[0], tuple):
+            return p[0]
+        return None
+
     def _match(self, node, pattern, U):
         if isinstance(node, IRNode):
             touches = {node}
@@ -93,7 +175,7 @@ class PatternOpt:
             if isinstance(repl, list):
                 return touches, repl
             elif isinstance(repl, tuple):
-                return touches, node.set_app_operations(repl[0], repl[1:])
+                return touches, node.set_sexp_operations(repl[0], repl[1:])
             elif isinstance(repl, IRNode):
                 return touches, node.redirect_operations(repl)
         return touches, []
@@ -113,16 +195,6 @@ def pattern_opt(*pattern):
     return wrap
 
 
-@pattern_opt(builtins.multiply, 1.0, X)
-def multiply_by_one_l(univ, node, X):
-    return X
-
-
-@pattern_opt(builtins.multiply, X, 1.0)
-def multiply_by_one_r(univ, node, X):
-    return X
-
-
 @pattern_opt(builtins.identity, X)
 def drop_copy(univ, node, X):
     return X
@@ -174,7 +246,7 @@ def inline(univ, node, L, X):
     idn = IRNode(None, builtins.identity, builtins.identity)
     chgs = []
     for arg, inp in zip(args, inputs):
-        chgs += inp.set_app_operations(idn, [arg])
+        chgs += inp.set_sexp_operations(idn, [arg])
     chgs += node.redirect_operations(output)
     return chgs
 
@@ -184,7 +256,7 @@ def expand_partial_app(univ, node, X, Y, Z):
     f = X
     args = Y + Z
     node2 = IRNode(node.graph, node.tag, node.value)
-    ops = node2.set_app_operations(f, args)
+    ops = node2.set_sexp_operations(f, args)
     ops += node.redirect_operations(node2)
     return ops
 
@@ -194,11 +266,356 @@ def index_into_tuple(univ, node, X, V):
     return X[int(V.value)]
 
 
-# TODO: (a, b, c) + (d, e, f) => (a+d, b+e, c+f)
-# TODO: cancel J/Jinv
+@pattern_opt(builtins.add,
+             (builtins.mktuple, X, ...),
+             (builtins.mktuple, Y, ...))
+def add_tuples(univ, node, X, Y):
+    """
+    (a, b, c) + (d, e, f) => (a + d, b + e, c + f)
+    """
+    if len(X) != len(Y):
+        return False
+    adds = []
+    for x, y in zip(X, Y):
+        n = IRNode(node.graph, ogen(node.tag, '+'))
+        n.set_sexp(builtin_node(builtins.add), [x, y])
+        adds.append(n)
+    return (builtin_node(builtins.mktuple), *adds)
+
+
+@pattern_opt(builtins.index, (builtins.add, (builtins.mktuple, X, ...), Y), V)
+def index_add_tuple(univ, node, X, Y, V):
+    """
+    ((a, b, c) + y)[1] => b + y[1]
+
+    Grad accumulates sensitivities this way, so this avoids building
+    and adding whole tuples only to extract one of their elements.
+    """
+    idx = IRNode(node.graph, ogen(node.tag, '+'))
+    idx.set_sexp(builtin_node(builtins.index), [Y, V])
+    return (builtin_node(builtins.add), X[int(V.value)], idx)
+
+
+#########################
+# Arithmetic identities #
+#########################
+
+
+# These rules only apply if they do not change the type of the
+# result (see keeps_type).
+
+
+@pattern_opt(builtins.add, ZERO_V, X)
+def add_zero_l(univ, node, ZERO_V, X):
+    return keeps_type(ZERO_V, X) and X
+
+
+@pattern_opt(builtins.add, X, ZERO_V)
+def add_zero_r(univ, node, X, ZERO_V):
+    return keeps_type(ZERO_V, X) and X
+
+
+@pattern_opt(builtins.subtract, X, ZERO_V)
+def subtract_zero(univ, node, X, ZERO_V):
+    return keeps_type(ZERO_V, X) and X
+
+
+@pattern_opt(builtins.subtract, ZERO_V, X)
+def subtract_from_zero(univ, node, ZERO_V, X):
+    return keeps_type(ZERO_V, X) \
+        and (builtin_node(builtins.unary_subtract), X)
+
+
+@pattern_opt(builtins.multiply, ONE_V, X)
+def multiply_by_one_l(univ, node, ONE_V, X):
+    return keeps_type(ONE_V, X) and X
+
+
+@pattern_opt(builtins.multiply, X, ONE_V)
+def multiply_by_one_r(univ, node, X, ONE_V):
+    return keeps_type(ONE_V, X) and X
+
+
+def multiply_by_zero(ZERO_V, X):
+    # X may be an array, so the result must be a conformant zero. If
+    # X holds floats, it may be inf or NaN and the product NaN, so X
+    # must be known to hold integers.
+    if type(ZERO_V.value) is int and elem_type(X) in int_types:
+        return (builtin_node(builtins.zeros_like), X)
+    return False
+
+
+@pattern_opt(builtins.multiply, ZERO_V, X)
+def multiply_by_zero_l(univ, node, ZERO_V, X):
+    return multiply_by_zero(ZERO_V, X)
+
+
+@pattern_opt(builtins.multiply, X, ZERO_V)
+def multiply_by_zero_r(univ, node, X, ZERO_V):
+    return multiply_by_zero(ZERO_V, X)
+
+
+@pattern_opt(builtins.divide, X, ONE_V)
+def divide_by_one(univ, node, X, ONE_V):
+    # The quotient of integers is a float.
+    return elem_type(X) in float_types and X
+
+
+@pattern_opt(builtins.power, X, ONE_V)
+def power_one(univ, node, X, ONE_V):
+    return keeps_type(ONE_V, X) and X
+
+
+@pattern_opt(builtins.power, X, TWO_V)
+def power_two(univ, node, X, TWO_V):
+    return keeps_type(TWO_V, X) and (builtin_node(builtins.multiply), X, X)
+
+
+#################
+# Inverse pairs #
+#################
+
+
+@pattern_opt(builtins.unary_subtract, (builtins.unary_subtract, X))
+def double_negation(univ, node, X):
+    return X
+
+
+@pattern_opt(builtins.transpose, (builtins.transpose, X))
+def transpose_transpose(univ, node, X):
+    return X
+
+
+@pattern_opt(builtins.log, (builtins.exp, X))
+def log_exp(univ, node, X):
+    return X
+
+
+@pattern_opt(builtins.Jinv, (builtins.J, X))
+def Jinv_J(univ, node, X):
+    return X
+
+
+####################
+# ZERO propagation #
+####################
+
+# ZERO is the generic zero produced by Grad (see myia.lib.ZERO). It is
+# the neutral element of add for any structure, and anything derived
+# from it is also zero.
+
+
+@pattern_opt(builtins.add, SZ, X)
+def add_ZERO_l(univ, node, SZ, X):
+    return X
+
+
+@pattern_opt(builtins.add, X, SZ)
+def add_ZERO_r(univ, node, X, SZ):
+    return X
+
+
+@pattern_opt(builtins.multiply, SZ, X)
+def multiply_ZERO_l(univ, node, SZ, X):
+    return SZ
+
+
+@pattern_opt(builtins.multiply, X, SZ)
+def multiply_ZERO_r(univ, node, X, SZ):
+    return SZ
+
+
+@pattern_opt(builtins.index, SZ, X)
+def index_ZERO(univ, node, SZ, X):
+    return SZ
+
+
+@pattern_opt(builtins.J, SZ)
+def J_ZERO(univ, node, SZ):
+    return SZ
+
+
+@pattern_opt(builtins.Jinv, SZ)
+def Jinv_ZERO(univ, node, SZ):
+    return SZ
+
+
+@pattern_opt(builtins.zeros_like, SZ)
+def zeros_like_ZERO(univ, node, SZ):
+    return SZ
+
+
+@pattern_opt(builtins.mktuple, SZ, ...)
+def mktuple_ZERO(univ, node, SZ):
+    # A tuple of zeros is a zero. The empty tuple is left alone.
+    if SZ:
+        return SZ[0]
+
+
+# Backpropagators only apply linear operations to their sensitivity,
+# and these map ZERO to ZERO.
+
+
+@pattern_opt(builtins.unary_subtract, SZ)
+def unary_subtract_ZERO(univ, node, SZ):
+    return SZ
+
+
+@pattern_opt(builtins.transpose, SZ)
+def transpose_ZERO(univ, node, SZ):
+    return SZ
+
+
+@pattern_opt(builtins.divide, SZ, X)
+def divide_ZERO(univ, node, SZ, X):
+    return SZ
+
+
+@pattern_opt(builtins.dot, SZ, X)
+def dot_ZERO_l(univ, node, SZ, X):
+    return SZ
+
+
+@pattern_opt(builtins.dot, X, SZ)
+def dot_ZERO_r(univ, node, X, SZ):
+    return SZ
+
+
+@pattern_opt(builtins.fit, SZ, X)
+def fit_ZERO(univ, node, SZ, X):
+    return SZ
+
+
+@pattern_opt(builtins.getattr, SZ, X)
+def getattr_ZERO(univ, node, SZ, X):
+    return SZ
+
+
+@pattern_opt(builtins.setslice, SZ, X, Y)
+def setslice_ZERO(univ, node, SZ, X, Y):
+    return SZ
+
+
+@pattern_opt(builtins.switch, X, SZ, SZ2)
+def switch_ZERO(univ, node, X, SZ, SZ2):
+    return SZ
+
+
+@pattern_opt(builtins.fill_zeros, SZ, X)
+def fill_zeros_ZERO(univ, node, SZ, X):
+    return (builtin_node(builtins.zeros_like), X)
+
+
+########################
+# Sparse sensitivities #
+########################
+
+
+@pattern_opt(builtins.index, (builtins.sparse, V1, X), V2)
+def index_sparse(univ, node, V1, X, V2):
+    """
+    sparse(i, x)[i] => x
+    sparse(i, x)[j] => ZERO
+
+    Indexes of opposite signs are left alone, since -1 may refer to
+    the same element as j (see ``Sparse``).
+    """
+    i, j = V1.value, V2.value
+    if i == j:
+        return X
+    elif (i < 0) == (j < 0):
+        return IRNode(None, ogen(node.tag, '@'), ZERO)
+    return False
+
+
+@pattern_opt(builtins.getattr, (builtins.sparse, V1, X), V2)
+def getattr_sparse(univ, node, V1, X, V2):
+    if V1.value == V2.value:
+        return X
+    return IRNode(None, ogen(node.tag, '@'), ZERO)
+
+
 # TODO: J(switch)?
 
 
+####################
+# Constant folding #
+####################
+
+
+# Builtins that are not evaluated at compile time because of their
+# side effects.
+effectful_builtins = {builtins.print, builtins.raise_exception,
+                      builtins.breakpoint}
+
+
+def is_data(value):
+    """
+    Whether value is plain data that can be folded into a constant.
+    """
+    if isinstance(value, (tuple, list)):
+        return all(is_data(v) for v in value)
+    return isinstance(value, (int, float, bool, str, type(None),
+                              numpy.ndarray, numpy.generic))
+
+
+@pattern_opt(V1, V2, ...)
+def fold_constant(univ, node, V1, V2):
+    if not is_builtin(V1.value) or V1.value in effectful_builtins \
+            or not all(is_data(arg.value) for arg in V2):
+        return False
+    univ = univ.universes['const_prop']
+    try:
+        res = univ[V1.value](*[arg.value for arg in V2])
+    except Exception:
+        # Let the error happen at runtime, if it does.
+        return False
+    if not is_data(res):
+        return False
+    return IRNode(None, ogen(node.tag, '@'), res)
+
+
+@pattern_opt(builtins.switch, V, X, Y)
+def switch_constant(univ, node, V, X, Y):
+    if isinstance(V.value, (bool, numpy.bool_)):
+        return X if V.value else Y
+    return False
+
+
+#############
+# Rule sets #
+#############
+
+
+rule_sets = {
+    'structural': [drop_copy, index_into_tuple, add_tuples,
+                   index_add_tuple],
+    'arithmetic': [add_zero_l, add_zero_r,
+                   subtract_zero, subtract_from_zero,
+                   multiply_by_one_l, multiply_by_one_r,
+                   multiply_by_zero_l, multiply_by_zero_r,
+                   divide_by_one, power_one, power_two],
+    'inverses': [double_negation, transpose_transpose, log_exp, Jinv_J],
+    'zero': [add_ZERO_l, add_ZERO_r, multiply_ZERO_l, multiply_ZERO_r,
+             index_ZERO, J_ZERO, Jinv_ZERO, zeros_like_ZERO, mktuple_ZERO,
+             unary_subtract_ZERO, transpose_ZERO, divide_ZERO,
+             dot_ZERO_l, dot_ZERO_r, fit_ZERO, getattr_ZERO,
+             setslice_ZERO, switch_ZERO, fill_zeros_ZERO,
+             index_sparse, getattr_sparse],
+    'constants': [fold_constant, switch_constant],
+    'calls': [expand_partial_app]
+}
+
+
+def rules(*names):
+    """
+    Return the patterns in the named rule sets, in order. With no
+    argument, return the patterns from every rule set.
+    """
+    names = names or tuple(rule_sets)
+    return [opt for name in names for opt in rule_sets[name]]
+
+
 class EquilibriumTransformer:
     def __init__(self,
                  universe,
@@ -213,6 +630,27 @@ class EquilibriumTransformer:
         self.follow = follow
         self.repools = defaultdict(set)
         self.follow_references = follow_references
+        # function -> the transformers that may apply to a call to it,
+        # in order.
+        self.dispatch: Dict[Any, List] = {}
+
+    def candidates(self, node):
+        """
+        Return the transformers that may apply to node. Patterns that
+        require a specific function are skipped if node calls another.
+        """
+        fn = node.fn
+        head = fn.value if fn is not None and fn.is_constant() else None
+        try:
+            return self.dispatch[head]
+        except KeyError:
+            rval = [t for t in self.transformers
+                    if getattr(t, 'head', None) in (None, head)]
+            self.dispatch[head] = rval
+            return rval
+        except TypeError:
+            # Unhashable function
+            return self.transformers
 
     def mark_change(self, node):
         assert node
@@ -225,7 +663,7 @@ class EquilibriumTransformer:
         if len(node.users) > 0:
             return
 
-        edges = node.edges()
+        edges = {(r, s) for r, s in node.edges() if (r, node) in s.users}
         for r, s in edges:
             s.users.remove((r, node))
         for _, s in edges:
@@ -233,6 +671,9 @@ class EquilibriumTransformer:
 
     def process(self, node):
         assert isinstance(node, IRNode)
+        if not node.users:
+            # The node was eliminated after it was added to the pool.
+            return
         # Whenever a node changes in the touches set, patterns that
         # failed to run on the current node might now succeed.
         touches = set()
@@ -242,7 +683,7 @@ class EquilibriumTransformer:
             self.graphs.add(graph)
             self.pool.add(graph.output)
             return
-        for transformer in self.transformers:
+        for transformer in self.candidates(node):
             # Transformer returns the nodes it has touched, and a
             # list of operations.
             ts, changes = transformer(self.universe, node)
@@ -253,8 +694,20 @@ class EquilibriumTransformer:
                     # node but failed to change anything.
                     self.mark_change(node1)
                     node1.process_operation(op, node2, role)
+                for op, node1, node2, role in changes:
+                    if op == 'link':
+                        # New successors may be open to optimization.
+                        self.pool.add(node2)
+                    else:
+                        # Old successors may now be dead.
+                        self.check_eliminate(node2)
                 # Check if this node should be eliminated
                 self.check_eliminate(node)
+                if node.users:
+                    # The node was modified in place, so we look at
+                    # it again.
+                    self.processed.discard(node)
+                    self.pool.add(node)
                 # Done with this node
                 break
             touches |= ts
@@ -282,3 +735,53 @@ class EquilibriumPass:
     def __call__(self, universe, graph):
         eq = EquilibriumTransformer(universe, [graph], self.patterns)
         eq.run()
+
+
+def is_recursive(graph):
+    """
+    Whether graph may call itself, directly or indirectly.
+    """
+    return any(node.is_graph() and node.value is graph
+               for g in graph.itergraphs()
+               for node in g.iterboundary())
+
+
+class PartialEvaluationPass:
+    """
+    Simplify a graph as much as possible given the constants it
+    contains: fold builtins applied on constants, eliminate switches
+    on constant conditions and inline the graphs it calls, which
+    unrolls loops with a constant trip count.
+
+    Only the given graph is transformed, the graphs it refers to are
+    left intact.
+
+    Arguments:
+        max_unroll: Maximal number of calls to recursive graphs to
+            inline, i.e. maximal number of loop iterations to unroll.
+    """
+    def __init__(self, max_unroll=64):
+        self.max_unroll = max_unroll
+
+    def inliner(self):
+        count = 0
+        recursive = {}
+
+        def handler(univ, node, L, X):
+            nonlocal count
+            g = L.value
+            if g not in recursive:
+                recursive[g] = is_recursive(g)
+            if recursive[g]:
+                if count >= self.max_unroll:
+                    return False
+                count += 1
+            return inline.handler(univ, node, L, X)
+
+        return PatternOpt(inline.pattern, handler)
+
+    def __call__(self, universe, graph):
+        patterns = rules() + [self.inliner()]
+        eq = EquilibriumTransformer(universe, [graph], patterns,
+                                    follow_references=False)
+        eq.run()
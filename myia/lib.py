@@ -18,10 +18,38 @@ class ZERO(Singleton):
     ZERO serves as a generic zero: add(ZERO, y) == y, whether y is a scalar,
     a tuple, or whatever else. This is more efficient than creating a zero
     that has the same shape as y.
+
+    Grad propagates ZERO as a symbolic sensitivity, so the linear
+    operations that backpropagators apply to their sensitivity map ZERO
+    to ZERO. It is only replaced by a conformant zero where one is
+    needed (see ``fill_zeros``).
     """
+    # Make NumPy defer to the reflected operators below.
+    __array_ufunc__ = None
+
     def __add__(self, other):
         return other
 
+    def __radd__(self, other):
+        return other
+
+    def __rsub__(self, other):
+        return other
+
+    def __absorb__(self, *others):
+        return self
+
+    __mul__ = __absorb__
+    __rmul__ = __absorb__
+    __truediv__ = __absorb__
+    __matmul__ = __absorb__
+    __rmatmul__ = __absorb__
+    __neg__ = __absorb__
+
+    @property
+    def T(self):
+        return self
+
     def __map__(self, smap, *rest):
         return smap.fn(self, *rest)
 
@@ -181,6 +209,144 @@ class Closure(HReprBase, StructuralMappable):
                                  hrepr(self.args)], 'v')
 
 
+class Dual(HReprBase):
+    """
+    A value along with its tangent, that is to say its derivative
+    along some direction, for forward mode differentiation. Dual
+    numbers are propagated by the primitives of ``impl_bank['jvp']``
+    (see ``impl_tangent``). They are leaves for structural maps.
+    """
+    def __init__(self, primal, tangent) -> None:
+        self.primal = primal
+        self.tangent = tangent
+
+    def __bool__(self):
+        # Control flow only depends on the primal.
+        return bool(self.primal)
+
+    def __map__(self, smap, *others):
+        return smap.fn(self, *others)
+
+    def __str__(self):
+        return f'Dual({self.primal}, {self.tangent})'
+
+    __repr__ = __str__
+
+    def __hrepr__(self, H, hrepr):
+        return hrepr.titled_box('Dual',
+                                [hrepr(self.primal),
+                                 hrepr(self.tangent)], 'v')
+
+
+class Sparse(HReprBase):
+    """
+    Sensitivity of a tuple or Record that is zero everywhere except
+    at a few indexes or fields. ``entries`` maps them to their
+    sensitivity. The backpropagators of ``index`` and ``getattr``
+    return Sparse sensitivities, so that their cost does not depend
+    on the size of the container, and ``add`` merges them. They are
+    made dense by ``fill_zeros``.
+
+    A Sparse does not know the length of its tuple, so it cannot tell
+    whether a negative index and a positive one refer to the same
+    element: indexing it so raises an IndexError. The rules that
+    build or index Sparse sensitivities make their indexes
+    non-negative first (see ``tuple_index``), and ``normalized``
+    does it given the length.
+    """
+    def __init__(self, entries) -> None:
+        self.entries = entries
+
+    def __getitem__(self, key):
+        if key not in self.entries and isinstance(key, int) \
+                and any(isinstance(k, int) and (k < 0) != (key < 0)
+                        for k in self.entries):
+            raise IndexError(f'Cannot tell if index {key} of {self}'
+                             ' is zero without the length of the tuple.')
+        return self.entries.get(key, ZERO)
+
+    # Sparse is not a sequence, even though it has __getitem__
+    __iter__ = None
+
+    def __variant__(self, key, value):
+        return Sparse({**self.entries, key: value})
+
+    def __map__(self, smap, *others):
+        if others:
+            return smap.fn(self, *others)
+        return Sparse({k: smap(v) for k, v in self.entries.items()})
+
+    def normalized(self, smap, n):
+        """
+        Sparse sensitivity of a tuple of length n with the same
+        entries, where negative indexes are replaced by the positive
+        ones they alias, e.g. -1 by n - 1. Entries that alias are
+        added with smap.
+        """
+        entries = {}
+        for k, v in self.entries.items():
+            k %= n
+            entries[k] = smap(entries[k], v) if k in entries else v
+        return Sparse(entries)
+
+    def add_to(self, smap, other):
+        """
+        Add other, which may be dense or Sparse, to self, using smap
+        to add the values that overlap.
+        """
+        if other is ZERO:
+            return self
+        elif isinstance(other, Sparse):
+            entries = dict(other.entries)
+            for k, v in self.entries.items():
+                entries[k] = smap(entries[k], v) if k in entries else v
+            return Sparse(entries)
+        elif isinstance(other, Record):
+            return Record(other.__tag__,
+                          {k: smap(v, self.entries[k])
+                           if k in self.entries else v
+                           for k, v in other})
+        elif isinstance(other, Closure):
+            return Closure(other.fn, self.add_to(smap, other.args))
+        else:
+            entries = self.normalized(smap, len(other)).entries
+            return type(other)(smap(v, entries[i]) if i in entries else v
+                               for i, v in enumerate(other))
+
+    def __str__(self):
+        entries = ", ".join(f'{k}: {v}' for k, v in self.entries.items())
+        return f'Sparse({entries})'
+
+    __repr__ = __str__
+
+    def __hrepr__(self, H, hrepr):
+        return hrepr.titled_box('Sparse', [hrepr(self.entries)], 'v')
+
+
+class Batch(HReprBase):
+    """
+    A batch of values of the same shape, stacked along the first axis
+    of the array ``values``, e.g. the rows of an identity matrix. A
+    backpropagator that is given a Batch sensitivity computes the
+    gradients for all of its values at once. Batches are propagated
+    by the primitives of ``impl_bank['batch']`` (see ``impl_batch``).
+    They are leaves for structural maps.
+    """
+    def __init__(self, values) -> None:
+        self.values = numpy.asarray(values)
+
+    def __map__(self, smap, *others):
+        return smap.fn(self, *others)
+
+    def __str__(self):
+        return f'Batch({self.values})'
+
+    __repr__ = __str__
+
+    def __hrepr__(self, H, hrepr):
+        return hrepr.titled_box('Batch', [hrepr(self.values)], 'v')
+
+
 class Function(HReprBase, IdempotentMappable):
     pass
 
@@ -289,6 +455,26 @@ default_structural_map_dispatch = {
 }
 
 
+def ndarray_leaf_map(smap, arr):
+    """
+    Map over an array for a function that is the identity on numbers:
+    arrays of numbers are returned as they are instead of being rebuilt
+    element by element, and only arrays of objects are mapped.
+    """
+    if arr.dtype == object:
+        return ndarray_map(smap, arr)
+    else:
+        return arr
+
+
+# Dispatch used by the universes to map the values they import into
+# data structures. Every universe maps numbers to themselves.
+universe_map_dispatch = {
+    **default_structural_map_dispatch,
+    numpy.ndarray: ndarray_leaf_map
+}
+
+
 class StructuralMap:
     def __init__(self, fn, dispatch=default_structural_map_dispatch):
         self.fn = fn
@@ -377,12 +563,23 @@ class Universe:
         else:
             return self.acquire(item)
 
+    def forget(self, item):
+        """
+        Remove item from the cache, so that the value it was mapped to
+        may be freed.
+        """
+        self.cache.pop(item, None)
+
 
 class BackedUniverse(Universe):
     def __init__(self, parent):
         super().__init__()
         self.parent = parent
 
+    def forget(self, item):
+        super().forget(item)
+        self.parent.forget(item)
+
 
 class UniverseGenerator:
     def __init__(self, builder, cache=True):
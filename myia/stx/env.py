@@ -16,10 +16,12 @@ from typing import \
     cast, TypeVar, Any
 import inspect
 from types import FunctionType
+from weakref import WeakValueDictionary
 from .nodes import Symbol, LambdaNode
 from ..util import EventDispatcher
 from ..lib import \
-    Record, StructuralMap, Universe, BackedUniverse, is_struct
+    Record, StructuralMap, Universe, BackedUniverse, is_struct, \
+    universe_map_dispatch
 from uuid import uuid4 as uuid
 
 
@@ -38,6 +40,7 @@ JTAG = '↑'
 BPROP = '♦'
 BPROP_CLOS = '♢'
 SENS = '∇'
+CHECKPOINT = '⧖'
 NULLSYM = '×'
 TMP = '◯'
 ANORM = 'α'
@@ -231,6 +234,14 @@ class PythonUniverse(Universe):
     def __init__(self):
         super().__init__()
         self.sources = {}
+        self.weak = WeakValueDictionary()
+        self.lazy = {}
+
+    def __getitem__(self, item):
+        try:
+            return self.weak[item]
+        except (KeyError, TypeError):
+            return super().__getitem__(item)
 
     def add_source(self, namespace, contents):
         if namespace not in self.sources:
@@ -246,6 +257,10 @@ class PythonUniverse(Universe):
             return x
         elif is_global(x):
             sym = x
+            if sym in self.lazy:
+                node = self.lazy.pop(sym)()
+                self.associate(sym, node)
+                return node
             globs = self.sources[sym.namespace]
             try:
                 v = globs[sym.label]
@@ -269,19 +284,30 @@ class PythonUniverse(Universe):
             self.add_source(f'global:{filename}', fn.__globals__)
             return x
         elif is_struct(x):
-            return StructuralMap(self.acquire)(x)
+            return StructuralMap(self.acquire, universe_map_dispatch)(x)
         else:
             return x
 
-    def associate(self, sym, node):
+    def associate(self, sym, node, weak=False):
         """
         Associate the given symbol to the given node (typically a LambdaNode)
         in this universe. The LambdaNode's `ref` field will be set to the
-        symbol.
+        symbol. If `weak` is `True`, the association only lasts as long as
+        something else refers to the node.
         """
         if isinstance(node, LambdaNode):
             node.ref = sym
-        self.cache[sym] = node
+        if weak:
+            self.weak[sym] = node
+        else:
+            self.cache[sym] = node
+
+    def associate_lazy(self, sym, thunk):
+        """
+        Associate the given symbol to the node returned by ``thunk()``,
+        which is only called when the symbol is first requested.
+        """
+        self.lazy[sym] = thunk
 
 
 # Maps global Symbols to whatever it is they resolve to. When compiling
@@ -216,7 +216,10 @@ class ValueNode(MyiaASTNode):
         super().__init__(**kw)
 
     def __eq__(self, other):
-        return isinstance(other, ValueNode) and self.value == other.value
+        # 1 == 1.0 == True, but these literals must stay distinct.
+        return isinstance(other, ValueNode) \
+            and type(self.value) is type(other.value) \
+            and self.value == other.value
 
     def __hash__(self):
         return hash(self.value)
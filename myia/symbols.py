@@ -31,6 +31,8 @@ class builtins(metaclass=SymbolsMeta):
     exp = bsym('exp')
     dot = bsym('dot')
     transpose = bsym('transpose')
+    multi_dot = bsym('multi_dot')
+    fused = bsym('fused')
     sum = bsym('sum')
     bitwise_or = bsym('bitwise_or')
     bitwise_and = bsym('bitwise_and')
@@ -60,6 +62,8 @@ class builtins(metaclass=SymbolsMeta):
 
     # Grad-related builtins
     fill = bsym('fill')
+    fill_zeros = bsym('fill_zeros')
+    sparse = bsym('sparse')
     zeros_like = bsym('zeros_like')
     ones_like = bsym('ones_like')
     J = bsym('J')
@@ -67,6 +71,7 @@ class builtins(metaclass=SymbolsMeta):
     grad1 = bsym('grad1')
     grad2 = bsym('grad2')
     grad3 = bsym('grad3')
+    checkpoint = bsym('checkpoint')
 
     # Others
     myia_builtins = bsym('myia_builtins')
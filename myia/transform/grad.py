@@ -22,7 +22,7 @@ from ..stx import \
     Symbol, ValueNode as Value, LambdaNode as Lambda, LetNode as Let, \
     ApplyNode as Apply, TupleNode, ClosureNode, \
     maptup, About, transformer_method, bsym, nsym, GenSym, \
-    JTAG, SENS, BPROP, BPROP_CLOS, NULLSYM, \
+    JTAG, SENS, BPROP, BPROP_CLOS, NULLSYM, CHECKPOINT, \
     TMP_LET, TMP_BPROP, TMP_SENS, create_lambda, is_global, \
     python_universe
 from ..symbols import builtins, inst_builtin
@@ -43,28 +43,151 @@ ggen = GenSym('global::grad')
 ################
 
 
+class GradCache:
+    """
+    Cache of the gradients of functions, with a bounded size. Once
+    it holds maxsize entries, storing a new one evicts the least
+    recently used entry, which is then passed to on_evict.
+
+    Each pipeline owns one such cache (see ``VMUniverse``), so that
+    the gradients it computes are released along with it. The
+    gradients of Lambdas are only weakly associated to their
+    symbols in ``python_universe``: they live as long as a cache or
+    a function that refers to them.
+
+    Arguments:
+        maxsize: The maximal number of entries, or None for no limit.
+        on_evict: Called on each evicted value.
+    """
+
+    def __init__(self,
+                 maxsize: Optional[int] = 1024,
+                 on_evict: Callable[[Any], None] = None) -> None:
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.entries: Dict[Any, Any] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """
+        Return the value associated to key and mark it as the most
+        recently used, or return default if there is none.
+        """
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while self.maxsize is not None and len(self.entries) > self.maxsize:
+            _, evicted = self.entries.popitem(last=False)
+            self.evictions += 1
+            if self.on_evict:
+                self.on_evict(evicted)
+
+    def __delitem__(self, key):
+        del self.entries[key]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        """
+        Remove all entries. The statistics are kept.
+        """
+        self.entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return the numbers of hits, misses and evictions since the
+        creation of the cache, along with its size and maxsize.
+        """
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions,
+                    size=len(self.entries),
+                    maxsize=self.maxsize)
+
+
+# Functions that compute the gradient of a primitive given
+# nargs_closure, registered by impl_bprop.
 grad_computers: Dict[Symbol, Callable] = {}
-grad_cache: Dict[Symbol, Dict[int, Lambda]] = defaultdict(dict)
 
+# The gradients of the primitives. There is a bounded number of
+# them, so they are kept for the lifetime of the process.
+primitive_grads: Dict[TupleT[Symbol, int], Lambda] = {}
 
-def find_grad(ref, nargs_closure):
+# The cache used when there is no pipeline to attach gradients to,
+# e.g. when Grad is called directly.
+grad_cache = GradCache()
+
+
+def find_grad(ref, nargs_closure, memory_budget=None, cache=None):
+    """
+    Return the Grad transform of the function ref, where the first
+    nargs_closure arguments are closure arguments. The result is
+    stored in cache (``grad_cache`` if it is None).
+    """
     assert isinstance(ref, Symbol)
 
-    def default_grad(n):
+    if ref in grad_computers:
+        pkey = (ref, nargs_closure)
+        if pkey not in primitive_grads:
+            primitive_grads[pkey] = grad_computers[ref](nargs_closure)
+        return primitive_grads[pkey]
+
+    if cache is None:
+        cache = grad_cache
+    key = (ref, nargs_closure) if memory_budget is None \
+        else (ref, nargs_closure, memory_budget)
+    glbda = cache.get(key)
+    if glbda is None:
         try:
             lbda = python_universe[ref]
         except KeyError:
             raise NameError(f"No gradient defined for primitive '{ref}'.")
         normalized = a_normal(lbda)
-        return Grad(ref, normalized, n).transform()
+        glbda = Grad(ref, normalized, nargs_closure, memory_budget,
+                     cache).transform()
+        cache[key] = glbda
+    return glbda
 
-    if nargs_closure in grad_cache[ref]:
-        return grad_cache[ref][nargs_closure]
 
-    G = grad_computers.setdefault(ref, default_grad)
-    glbda = G(nargs_closure)
-    grad_cache[ref][nargs_closure] = glbda
-    return glbda
+def dependencies(value: MyiaASTNode) -> List[MyiaASTNode]:
+    """
+    Return the nodes that the value of a binding directly depends on.
+    """
+    if isinstance(value, Apply):
+        return [value.fn] + value.args
+    elif isinstance(value, Symbol):
+        return [value]
+    elif isinstance(value, TupleNode):
+        return value.values
+    elif isinstance(value, ClosureNode):
+        return [value.fn] + value.args
+    else:
+        return []
+
+
+def bound_symbols(var: LHS) -> List[Symbol]:
+    """
+    Return the Symbols that var binds.
+    """
+    if isinstance(var, TupleNode):
+        return [s for v in var.values for s in bound_symbols(v)]
+    else:
+        return [var]
 
 
 ########
@@ -76,12 +199,29 @@ class Grad:
     """
     Transform a Lambda into a Lambda that returns a backpropagator
     in addition to its normal return value.
+
+    If memory_budget is given, the backpropagator of the transformed
+    Lambda keeps the intermediate results of at most memory_budget
+    function applications at a time: the body is split in segments
+    of that size, which are evaluated through ``checkpoint`` so that
+    only their inputs are stored and the rest is recomputed during
+    the backward pass. The closures the body creates get the same
+    budget. Use ``checkpoint`` directly to choose the segments by
+    hand, e.g. in the body of a loop.
+
+    The budget is a number of nodes, not of bytes: it bounds how many
+    intermediate results are kept, whatever their size. The public
+    entry points take it as ``myia(fn, memory_budget=n)``, which
+    applies to ``grad1`` and the other uses of ``J`` in fn, and as
+    the ``memory_budget`` argument of ``hvp`` and ``jacrev``.
     """
 
     def __init__(self,
                  name: Symbol,
                  primal: Lambda,
-                 nargs_closure = 0) -> None:
+                 nargs_closure = 0,
+                 memory_budget: int = None,
+                 cache: GradCache = None) -> None:
         self.name = name
         assert isinstance(primal, Lambda)
         self.primal = primal
@@ -92,6 +232,11 @@ class Grad:
         self.zeros: Bindings = []
         self.bprop_variables: Dict[Symbol, bool] = OrderedDict()
         self.nargs_closure = nargs_closure
+        self.memory_budget = memory_budget
+        self.cache = cache
+        # The Lambdas the result refers to by symbol, which it keeps
+        # alive (see GradCache).
+        self.pinned: List[Lambda] = []
         self.relevant: Set[Symbol] = None
 
     def get_relevant(self,
@@ -104,17 +249,7 @@ class Grad:
         """
         deps: Dict[Symbol, Set[Symbol]] = {}
         for var, value in bindings:
-            if isinstance(value, Apply):
-                dependents = [value.fn] + value.args
-            elif isinstance(value, Symbol):
-                dependents = [value]
-            elif isinstance(value, TupleNode):
-                dependents = value.values
-            elif isinstance(value, ClosureNode):
-                dependents = [value.fn] + value.args
-            else:
-                dependents = []
-            for var2 in dependents:
+            for var2 in dependencies(value):
                 if isinstance(var2, Symbol):
                     d = deps.setdefault(var2, set())
                     maptup(d.add, var)
@@ -189,7 +324,9 @@ class Grad:
                 )
 
             args = [self.tagged_expr(a) for a in value.args]
-            ast = find_grad(value.fn, len(value.args))
+            ast = find_grad(value.fn, len(value.args), self.memory_budget,
+                            self.cache)
+            self.pinned.append(ast)
             expr = ClosureNode(ast.ref, args)
 
             return [(self.tagged_var(var), expr)]
@@ -223,13 +360,11 @@ class Grad:
             # to any other sensitivity variable, so we save
             # ourselves the trouble.
             return []
-        else:
-            # If ``var`` is a TupleNode, some values might be
-            # ZERO and others not, and that can be a problem
-            # because ZERO is not conformant (shape-wise).
-            # Therefore, we must backtrack and get something
-            # that we know is conformant.
-            sen = self.conformant_sensitivity_value(var)
+        # Otherwise, if ``var`` is a TupleNode, some values might
+        # still be ZERO. They are passed on as they are: the
+        # backpropagators map a ZERO sensitivity to ZERO, and
+        # ``transform`` makes the sensitivities of the arguments
+        # conformant.
 
         if isinstance(value, Symbol):
             # Original:     x = y
@@ -325,7 +460,7 @@ class Grad:
                     # variable for var.
                     app = Apply(mapadd.copy(),
                                 g,
-                                self.conformant_sensitivity_value(var))
+                                self.sensitivity_value(var))
                     lhs = self.new_sensitivity_var(var)
                     bindings.append((lhs, app))
                     # We make a dummy zero for mapadd's first argument,
@@ -400,11 +535,11 @@ class Grad:
         ``ZERO``, otherwise it will be its current sensitivity
         variable.
 
-        ``ZERO`` is not conformant with ``v``, which can be a problem.
-        Therefore, only use ``sensitivity_value`` to get a suitable
-        argument for the *first* argument to ``mapadd``. This is ok because
-        we know that the second will be conformant and has the appropriate
-        structure. Use ``conformant_sensitivity_value`` anywhere else.
+        ``ZERO`` is not conformant with ``v``, but ``mapadd`` and the
+        backpropagators accept it in place of any sensitivity. Use
+        ``conformant_sensitivity_value`` where a conformant value is
+        really required, that is to say for the gradients ``♦f``
+        returns.
         """
         if isinstance(v, Symbol):
             try:
@@ -448,18 +583,23 @@ class Grad:
     @transformer_method('g:sens')
     def conformant_sensitivity_value(self, v: LHS) -> MyiaASTNode:
         """
-        Return ``∇v`` if it already exists. If it does not, create it
-        and initialize it with ``zero_init``. This differs from
-        ``sensitivity_value`` in one important way, which is that
-        ``sensitivity_value`` returns the ``ZERO`` placeholder if it
-        does not find ``∇v``, whereas this creates a zero that has the
-        same shape as ``v``.
+        Return ``∇v`` if it already exists, with the ``ZERO``
+        placeholders it may contain replaced by zeros (see
+        ``fill_zeros``). If it does not, create it and initialize it
+        with ``zero_init``. This differs from ``sensitivity_value`` in
+        one important way, which is that ``sensitivity_value`` returns
+        the ``ZERO`` placeholder if it does not find ``∇v``, whereas
+        this creates a zero that has the same shape as ``v``.
         """
         if isinstance(v, Symbol):
             try:
-                return copy(self.sensitivity_map[v])
+                sen = copy(self.sensitivity_map[v])
             except KeyError:
                 return self.zero_init(v)
+            tagged = self.tagged_var(v)
+            self.bprop_variables[tagged] = True
+            return Apply(inst_builtin.fill_zeros, sen,
+                         Apply(inst_builtin.Jinv, copy(tagged)))
         else:
             return maptup(self.conformant_sensitivity_value, v)
 
@@ -493,6 +633,65 @@ class Grad:
             sym = self.gensym(v, BPROP_CLOS)
         return copy(self.backpropagator_map.setdefault(v, sym))
 
+    def checkpoint_segments(self, let: Let) -> Let:
+        """
+        Split the bindings of let in segments that contain at most
+        self.memory_budget applications. Each segment is moved to its
+        own Lambda, which takes a tuple of the variables the segment
+        uses and returns a tuple of the variables it defines that are
+        used afterwards. The segment is replaced by a call to that
+        Lambda through ``checkpoint``.
+        """
+        budget = self.memory_budget
+        napps = sum(isinstance(v, Apply) for _, v in let.bindings)
+        if budget is None or napps <= budget:
+            return let
+
+        segments: List[Bindings] = [[]]
+        count = 0
+        for var, value in let.bindings:
+            if isinstance(value, Apply):
+                if count == budget:
+                    segments.append([])
+                    count = 0
+                count += 1
+            segments[-1].append((var, value))
+
+        bindings: Bindings = []
+        for i, segment in enumerate(segments):
+            bound = [s for var, _ in segment for s in bound_symbols(var)]
+            used_after = {let.body} | {
+                s for segment2 in segments[i + 1:]
+                for _, value in segment2
+                for s in dependencies(value)
+            }
+            outputs = [s for s in bound if s in used_after]
+            inputs = list(OrderedDict.fromkeys(
+                s for _, value in segment for s in dependencies(value)
+                if isinstance(s, Symbol) and not is_global(s)
+                and s not in bound
+            ))
+            if not outputs or not any(isinstance(v, Apply)
+                                      for _, v in segment):
+                bindings += segment
+                continue
+
+            seg_sym = ggen(self.name, CHECKPOINT)
+            seg_arg = self.gensym(TMP_LET)
+            seg_body = Let([(TupleNode(inputs), seg_arg), *segment],
+                           TupleNode(outputs))
+            seg_fn = create_lambda(seg_sym, [seg_arg], seg_body,
+                                   self.gensym, commit=False)
+            python_universe.associate(seg_sym, seg_fn, weak=True)
+            self.pinned.append(seg_fn)
+            tmp = self.gensym(TMP_LET)
+            bindings += [
+                (tmp, TupleNode(inputs)),
+                (TupleNode(outputs),
+                 Apply(inst_builtin.checkpoint, seg_sym, tmp))
+            ]
+        return Let(bindings, let.body)
+
     def transform(self) -> Symbol:
         """
         Perform the code transform on self.primal.
@@ -510,6 +709,7 @@ class Grad:
             tmp = self.gensym(TMP_LET)
             let = Let([(tmp, let)], tmp)
         assert isinstance(let, Let)
+        let = self.checkpoint_segments(let)
 
         self.relevant = self.get_relevant(let.bindings, args)
 
@@ -555,7 +755,9 @@ class Grad:
         backp_sym = ggen(self.name, BPROP)
         backp_fn = create_lambda(backp_sym, [*backp_args_copy, out_sen],
                                  Let(self.zeros + backward, backp_ret),
-                                 self.gensym, commit=True)
+                                 self.gensym, commit=False)
+        python_universe.associate(backp_sym, backp_fn, weak=True)
+        self.pinned.append(backp_fn)
 
         ########################
         # Build the closure ♢f #
@@ -580,9 +782,11 @@ class Grad:
         # ↑f
         assert all(isinstance(arg, Symbol) for arg in augm_args)
         augm_fn = create_lambda(augm_sym, cast(List[Symbol], augm_args),
-                                augm_body, self.gensym, commit=True)
+                                augm_body, self.gensym, commit=False)
+        python_universe.associate(augm_sym, augm_fn, weak=True)
 
         # Set the primal field to the original function's symbol
         augm_fn.primal = self.name
+        augm_fn.pinned = self.pinned
 
         return augm_fn
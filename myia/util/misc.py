@@ -82,3 +82,7 @@ class Singleton:
         return self.__class__.__name__
 
     __repr__ = __str__
+
+    def __reduce__(self):
+        # The instance replaces its class in its module, under its name.
+        return self.__class__.__name__
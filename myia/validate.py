@@ -12,6 +12,8 @@ from typing import Iterable, Set, Tuple as TupleT, \
     Callable, Dict, List, Any, Union
 import numpy
 import itertools
+import pickle
+from concurrent.futures import ProcessPoolExecutor
 from .stx import MyiaASTNode, Symbol, LambdaNode, LetNode, \
     maptup, create_lambda, is_global
 from .transform import a_normal, Grad, ggen
@@ -67,6 +69,11 @@ def unbound(node: MyiaASTNode,
 # the gradient.
 eps = 1e-10
 
+# The variation applied on the inputs in either direction to estimate
+# a directional derivative. The directions have one unit of variance
+# per element, so it is larger than eps to avoid round-off errors.
+directional_eps = 1e-6
+
 # The tolerance for the difference between the estimation and the
 # computed gradient.
 rel_error = 1e-03
@@ -144,6 +151,67 @@ def gen_variants(obj, gen, path):
         pass
 
 
+def random_direction(obj, rng):
+    """
+    Return a direction with the structure of obj, with a random
+    normal value for each scalar element, and None in place of the
+    elements that are not tested (NoTestGrad, booleans, etc.).
+    """
+    if isinstance(obj, NoTestGrad):
+        return None
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(random_direction(x, rng) for x in obj)
+    elif isinstance(obj, Record):
+        return Record(obj.__tag__, {k: random_direction(v, rng)
+                                    for k, v in obj})
+    elif isinstance(obj, numpy.ndarray):
+        return rng.randn(*obj.shape)
+    elif isinstance(obj, (int, float)) and not isinstance(obj, bool):
+        return rng.randn()
+    else:
+        return None
+
+
+def step(obj, direction, h):
+    """
+    Return obj + h * direction.
+    """
+    if direction is None:
+        return obj
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(step(x, d, h) for x, d in zip(obj, direction))
+    elif isinstance(obj, Record):
+        return Record(obj.__tag__, {k: step(v, direction[k], h)
+                                    for k, v in obj})
+    else:
+        return obj + h * direction
+
+
+def inner(grads, direction):
+    """
+    Return the inner product of grads and direction, which have the
+    same structure.
+    """
+    if direction is None:
+        return 0
+    elif isinstance(direction, (list, tuple)):
+        return sum(inner(g, d) for g, d in zip(grads, direction))
+    elif isinstance(direction, Record):
+        return sum(inner(grads[k], d) for k, d in direction)
+    else:
+        return float(numpy.sum(grads * direction))
+
+
+def directional_diff(fn, args, direction, h):
+    """
+    Estimate the derivative of fn at args in the given direction,
+    (fn(args + h * direction) - fn(args - h * direction)) / 2h.
+    """
+    under = fn(*clean_args(step(args, direction, -h)))
+    over = fn(*clean_args(step(args, direction, h)))
+    return structural_map(lambda a, b: (b - a) / (2 * h), under, over)
+
+
 class GradTester:
     """
     Test a computed gradient against a finite differences estimate
@@ -156,17 +224,33 @@ class GradTester:
             to estimate the gradient.
         argnames: The names of the arguments.
         outnames: The names of the outputs.
+        directions: If given, instead of estimating the derivative
+            wrt each scalar element of the arguments, which requires
+            two calls to fn per element, estimate the derivatives in
+            that many random directions of the whole domain and
+            compare them to the inner products of the gradient with
+            the directions. The results are then named
+            d<outname>/dv<i> for the ith direction.
+        processes: The number of processes to estimate the
+            directional derivatives in, if fn can be pickled.
+        seed: The seed of the random directions.
     """
     def __init__(self,
                  fn: Callable,
                  gfn: Callable,
                  args: List[Any],
                  argnames: List[str],
-                 outnames: List[str] = None) -> None:
+                 outnames: List[str] = None,
+                 directions: int = None,
+                 processes: int = None,
+                 seed: int = 0) -> None:
         self.fn = fn
         self.gfn = gfn
         self.args = args
         self.argnames = argnames
+        self.directions = directions
+        self.processes = processes
+        self.seed = seed
         out = fn(*clean_args(args))
         outname = fn.__name__
         if isinstance(out, tuple):
@@ -242,16 +326,86 @@ class GradTester:
         self.finite_diff = results
         return results
 
+    def gen_directions(self) -> List[Any]:
+        rng = numpy.random.RandomState(self.seed)
+        return [random_direction(self.args, rng)
+                for _ in range(self.directions)]
+
+    def set_directional_result(self, results, opath, i, value):
+        opath = (self.outnames[opath[0]],) + opath[1:]
+        outname = '.'.join(map(str, opath))
+        results[f'd{outname}/dv{i}'] = value
+
+    def compute_exact_directional(self) -> Dict[str, float]:
+        """
+        Compute the inner products of the exact gradient with the
+        directions.
+
+        Returns:
+            A dictionary that maps d<outname>/dv<i> to the inner
+            product of the gradient computed by gfn on args with the
+            ith direction.
+        """
+        results: Dict[str, float] = {}
+        directions = self.gen_directions()
+        z = M.zeros_like(self.out)
+        for (out_sen,), opath in gen_variants(z, lambda x: [1], ()):
+            grads = self.gfn(self.unwrap(out_sen))[1:]
+            for i, direction in enumerate(directions):
+                self.set_directional_result(results, opath, i,
+                                            inner(grads, direction))
+        self.exact = results
+        return results
+
+    def compute_finite_diff_directional(self) -> Dict[str, float]:
+        """
+        Compute the directional derivatives by finite differences,
+        in a pool of processes if self.processes is set.
+
+        Returns:
+            A dictionary that maps d<outname>/dv<i> to the derivative
+            in the ith direction computed by finite difference with
+            fn on args.
+        """
+        directions = self.gen_directions()
+        n = len(directions)
+        call_args = ([self.fn] * n, [self.args] * n, directions,
+                     [directional_eps] * n)
+        try:
+            pickle.dumps((self.fn, self.args))
+            parallel = bool(self.processes)
+        except Exception:
+            parallel = False
+        if parallel:
+            with ProcessPoolExecutor(self.processes) as pool:
+                diffs = list(pool.map(directional_diff, *call_args))
+        else:
+            diffs = list(map(directional_diff, *call_args))
+
+        results: Dict[str, float] = {}
+        for i, diff in enumerate(diffs):
+            diff = self.wrap(diff)
+            for opath in gen_paths(diff, ()):
+                self.set_directional_result(results, opath, i,
+                                            resolve_path(diff, opath))
+        self.finite_diff = results
+        return results
+
     def compare(self) -> Dict[str, Dict]:
         """
         Compare the exact gradients to the estimated ones.
 
         Returns:
-            A dictionary that maps d<outname>/d<argname> to a dictionary
+            A dictionary that maps d<outname>/d<argname> (or
+            d<outname>/dv<i> if self.directions is set) to a dictionary
             that contains both gradients and a boolean 'match' field.
         """
-        exact = self.compute_exact()
-        fin = self.compute_finite_diff()
+        if self.directions:
+            exact = self.compute_exact_directional()
+            fin = self.compute_finite_diff_directional()
+        else:
+            exact = self.compute_exact()
+            fin = self.compute_finite_diff()
         results = {}
         for k in exact:
             e = exact[k]
@@ -288,7 +442,7 @@ def get_functions(data) -> TupleT[Callable, LambdaNode]:
     return pyfn, lbda
 
 
-def analysis(mode: str, spec, args=None) -> Union[Callable, Dict]:
+def analysis(mode: str, spec, args=None, **options) -> Union[Callable, Dict]:
     """
     Arguments:
         mode:
@@ -301,6 +455,8 @@ def analysis(mode: str, spec, args=None) -> Union[Callable, Dict]:
         args (optional):
             List of arguments to analyze the function at,
             or None.
+        options: Options for the analysis, e.g. ``directions`` and
+            ``processes`` for 'grad' (see ``GradTester``).
 
     Returns:
         The results of the test on the provided arguments,
@@ -309,7 +465,7 @@ def analysis(mode: str, spec, args=None) -> Union[Callable, Dict]:
     """
     pyfn, lbda = get_functions(spec)
     method = globals()[f'analysis_{mode}']
-    rval = method(pyfn, lbda) | results_record(lbda=lbda)
+    rval = method(pyfn, lbda, **options) | results_record(lbda=lbda)
     if args:
         rval = rval | results_record(result = rval.test(args))
     return rval
@@ -374,7 +530,9 @@ def analysis_eval(pyfn: Callable, lbda: LambdaNode) -> Record:
     return results_record(test=test, lbdas=[lbda], called_lbdas=[lbda])
 
 
-def analysis_grad(pyfn: Callable, lbda: LambdaNode) -> Record:
+def analysis_grad(pyfn: Callable, lbda: LambdaNode,
+                  directions: int = None,
+                  processes: int = None) -> Record:
     """
     Return a function that takes a list of arguments ``args`` and
     compares:
@@ -382,7 +540,9 @@ def analysis_grad(pyfn: Callable, lbda: LambdaNode) -> Record:
     * The results of the pure Python function ``pyfn`` to its Myia
       implementation and to the Grad-transformed Myia function.
     * The finite-differences estimation of the derivative of
-      ``pyfn`` and the Myia-computed gradient.
+      ``pyfn`` and the Myia-computed gradient, in the given number
+      of random directions if ``directions`` is set (see
+      ``GradTester``).
     """
     func = compile(lbda)
     albda = a_normal(lbda)
@@ -400,7 +560,8 @@ def analysis_grad(pyfn: Callable, lbda: LambdaNode) -> Record:
             myia = func,
             myiag = lambda *args: myiag
         ), args2)
-        gt = GradTester(pyfn, bprop, args, func.argnames, None)
+        gt = GradTester(pyfn, bprop, args, func.argnames, None,
+                        directions=directions, processes=processes)
         comparison.update(dict(
             derivatives = gt.compare()
         ))
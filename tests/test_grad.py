@@ -2,12 +2,24 @@
 Test gradients generated by Myia (first order and second order).
 """
 
-from myia.validate import analysis, NoTestGrad
-from pytest import mark, fail
-from myia.impl.impl_interp import fit, shape, sum, exp, log, setattr
-from myia.front import myia
-from myia.lib import record
+from myia.validate import analysis, NoTestGrad, GradTester
+from pytest import mark, fail, raises
+from myia.impl.impl_interp import fit, shape, sum, exp, log, setattr, \
+    checkpoint, add, sparse, fill_zeros, J, add_inplace, grad1
+from myia.front import myia, compile, jvp, hvp, jacrev
+from myia.parse import parse_function
+from myia.transform import a_normal, Grad
+from myia.ir import graph_grad
+from myia.lib import record, ZERO, Sparse
+from myia.stx import python_universe
+from myia.symbols import builtins
+from myia.transform.grad import find_grad
+from myia.impl.impl_bprop import bprop_lambdas, bprop_lambda, save_bprops, \
+    load_bprops
 import numpy
+import gc
+import io
+import pickle
 
 
 rng = numpy.random.RandomState(138)
@@ -36,7 +48,7 @@ def o(*dims):
     return numpy.ones(dims)
 
 
-def grad_test(*tests):
+def grad_test(*tests, **options):
     """
     Test the gradient of a function. This performs the following
     tests:
@@ -54,11 +66,14 @@ def grad_test(*tests):
         * computed_dx = J(f)(..., x, ...)[1](1)
         * error_dx = abs(diff_dx - computed_dx) > eps_2
 
+    The options are given to ``analysis``, e.g. ``directions=4`` to
+    compare the derivatives in 4 random directions instead.
+
     TODO: allow specifying the gradient values explicitly.
     """
     def decorate(fn):
         def test(test_data):
-            testfn = analysis('grad', fn).test
+            testfn = analysis('grad', fn, **options).test
             results = testfn(test_data)
             print(results)
             if not results['match']:
@@ -314,6 +329,38 @@ def test_setattr(r):
     return r
 
 
+###########################
+# Directional derivatives #
+###########################
+
+
+@grad_test((M33, N32), (M23, N33), directions=4)
+def test_directional(x, y):
+    return sum(exp(x @ y) * (x @ y))
+
+
+def wide(w, x):
+    return sum(exp(w @ x) * (w @ x))
+
+
+def test_directional_processes():
+    rng = numpy.random.RandomState(0)
+    w, x = rng.randn(100, 100) * 0.1, rng.randn(100, 2) * 0.1
+    results = analysis('grad', wide, directions=3, processes=2) \
+        .test((w, x))['derivatives']
+    assert sorted(results) == ['dwide/dv0', 'dwide/dv1', 'dwide/dv2']
+    assert all(d['match'] for d in results.values())
+
+
+def test_directional_mismatch():
+    def bprop(dz):
+        return ((), 2 * dz, 3 * dz)
+
+    gt = GradTester(lambda x, y: x * y, bprop, [2.0, 3.0], ['x', 'y'],
+                    directions=2)
+    assert not any(d['match'] for d in gt.compare().values())
+
+
 ##########################
 # Second-order gradients #
 ##########################
@@ -377,3 +424,464 @@ def logistic_regression_record(params, x):
 def test_square_cost_record(params, x, y):
     y_hat = logistic_regression_record(params, x)
     return sum((y_hat - y) ** 2)
+
+
+#################
+# Checkpointing #
+#################
+
+
+def cell(state):
+    h, w = state
+    a = h * w
+    return exp(-a) * h + a
+
+
+@grad_test((0.1, 0.2), (M1, N1))
+def test_checkpoint(h, w):
+    return checkpoint(cell, (h, w)) * 2
+
+
+@grad_test((0.1, 0.2))
+def test_checkpoint_loop(h, w):
+    i = 0
+    while i < 4:
+        h = checkpoint(cell, (h, w))
+        i = i + 1
+    return h
+
+
+def cells(h, w):
+    h = cell((h, w))
+    h = cell((h, w)) * h
+    h = cell((h, w))
+    return h + w
+
+
+@mark.parametrize('budget', [1, 2, 3, 5])
+def test_memory_budget(budget):
+    lbda = parse_function(cells)
+    expected = compile(Grad(lbda.ref, a_normal(lbda)).transform())
+    glbda = Grad(lbda.ref, a_normal(lbda), memory_budget=budget).transform()
+    v1, bprop1 = expected(0.3, 0.7)
+    v2, bprop2 = compile(glbda)(0.3, 0.7)
+    assert v1 == v2
+    assert bprop1(1.0) == bprop2(1.0)
+
+
+def cells_h(h):
+    return cells(h, 0.7)
+
+
+def cells_grad(h):
+    return grad1(cells_h)(h)
+
+
+@mark.parametrize('budget', [1, 2])
+def test_memory_budget_myia(budget):
+    expected = myia(cells_grad)(0.3)
+    mf = myia(cells_grad, memory_budget=budget)
+    assert mf(0.3) == expected
+    # The gradients were computed with the budget.
+    keys = list(mf.universe.universes['vm'].grad_cache.entries)
+    assert keys and all(k[2:] == (budget,) for k in keys)
+
+
+def test_memory_budget_hvp_jacrev():
+    args = (0.3, 0.7)
+    assert hvp(cells, memory_budget=2)(args, (1.0, 0.0)) \
+        == hvp(cells)(args, (1.0, 0.0))
+    assert jacrev(cells, memory_budget=2)(*args) == jacrev(cells)(*args)
+
+
+##################
+# Symbolic zeros #
+##################
+
+
+def two_outputs(x, y):
+    return x * y, (exp(x), y)
+
+
+@grad_test((M3, N3))
+def test_unused_outputs(x, y):
+    a, _ = two_outputs(x, y)
+    return sum(a)
+
+
+def test_symbolic_zeros():
+    lbda = parse_function(two_outputs)
+    _, bprop = compile(Grad(lbda.ref, a_normal(lbda)).transform())(M3, N3)
+    # ZERO stands for the sensitivity of the outputs that are not
+    # used, but the gradients are still conformant with the inputs.
+    _, dx, dy = bprop((ZERO, ZERO))
+    assert numpy.array_equal(dx, numpy.zeros(M3.shape))
+    assert numpy.array_equal(dy, numpy.zeros(N3.shape))
+    _, dx, dy = bprop((ZERO, (ZERO, P3)))
+    assert numpy.array_equal(dx, numpy.zeros(M3.shape))
+    assert numpy.array_equal(dy, P3)
+
+
+def pick(t):
+    return t[3] * t[7] + t[3]
+
+
+@grad_test((tuple(range(20)),))
+def test_sparse_index(t):
+    return pick(t)
+
+
+@grad_test(((1.0, 2.0, 3.0, 4.0, 5.0),))
+def test_sparse_negative_index(t):
+    return t[4] * 2.0 + t[-1]
+
+
+def switch_last(x):
+    if x > 0:
+        t = (x, 2.0 * x, 3.0 * x)
+    else:
+        t = (x, x, x)
+    return t[-1]
+
+
+def switch_last_grad(x):
+    return grad1(switch_last)(x)
+
+
+@grad_test((1.0,), (-1.0,))
+def test_sparse_negative_index_switch(x):
+    return switch_last(x)
+
+
+def test_sparse_negative_index_switch_graph():
+    mf = myia(switch_last_grad)
+    assert mf(1.0) == 3.0
+    assert mf(-1.0) == 1.0
+
+
+def setslice_last(t, y):
+    t[-1] = y * t[-1]
+    return t[2] * t[0]
+
+
+def test_sparse_negative_setslice():
+    lbda = parse_function(setslice_last)
+    gfn = compile(Grad(lbda.ref, a_normal(lbda)).transform())
+    v, bprop = gfn((2.0, 3.0, 4.0), 5.0)
+    assert v == 40.0
+    assert bprop(1.0) == ((), (20.0, 0, 10.0), 8.0)
+
+
+def test_sparse_sensitivities():
+    s = add(add(sparse(1, 2.0), sparse(3, 4.0)), sparse(1, 1.0))
+    assert isinstance(s, Sparse)
+    assert fill_zeros(s, (0.0,) * 5) == (0, 3.0, 0, 4.0, 0)
+    assert add((1.0, 2.0), sparse(0, 1.0)) == (2.0, 2.0)
+    assert add(sparse(-1, 1.0), (1.0, 2.0)) == (1.0, 3.0)
+    # Indexes that alias are added
+    s = add(sparse(4, 2.0), sparse(-1, 1.0))
+    assert fill_zeros(s, (0.0,) * 5) == (0, 0, 0, 0, 3.0)
+    assert add(s, (1.0,) * 5) == (1.0, 1.0, 1.0, 1.0, 4.0)
+    # Without the length of the tuple, -1 may be any index
+    assert sparse(-1, 1.0)[-2] is ZERO
+    with raises(IndexError):
+        sparse(-1, 1.0)[2]
+    r = record(a=1, b=2, c=3)
+    assert dict(fill_zeros(sparse('b', 5), r)) == dict(a=0, b=5, c=0)
+
+    # The gradient is only made dense at the boundary
+    t = tuple(range(1000))
+    lbda = parse_function(pick)
+    _, bprop = compile(Grad(lbda.ref, a_normal(lbda)).transform())(t)
+    _, dt = bprop(1.0)
+    assert len(dt) == 1000
+    assert dt[3] == 8 and dt[7] == 3
+    assert sum(dt) == 11
+
+
+#######################
+# Gradients of graphs #
+#######################
+
+
+def fused_cell(x, y):
+    return exp(-x * y) * x + y
+
+
+def product(a, b, c):
+    return a @ b @ c
+
+
+# The helpers are optimized (fused, multi_dot) before they are
+# differentiated.
+@grad_test((M33, N33), (M1, N1))
+def test_graph_fused(x, y):
+    return sum(fused_cell(x, y))
+
+
+@grad_test((M23, N33, P32))
+def test_graph_multi_dot(a, b, c):
+    return sum(product(a, b, c))
+
+
+def test_graph_grad_cache():
+    fn = myia(cell)
+    fn((0.1, 0.2))
+    graph = fn.mfn.vmf.graph
+    jgraph = graph_grad(graph)
+    assert graph_grad(graph) is jgraph
+    assert graph_grad(graph, 1) is not jgraph
+    assert jgraph.primal is graph
+
+
+def cube(x):
+    return x * x * x
+
+
+def quad(x):
+    return x * x * x * x
+
+
+def grad_sum(x):
+    _, bprop1 = J(quad)(x)
+    _, bprop2 = J(cube)(x)
+    _, bprop3 = J(cell)((x, x))
+    _, d1 = bprop1(1.0)
+    _, d2 = bprop2(1.0)
+    _, (d3, d4) = bprop3(1.0)
+    return d1 + d2 + d3 + d4
+
+
+def test_grad_cache():
+    fn = myia(grad_sum, vm_grad_cache_size=2)
+    expected = fn(0.5)
+    cache = fn.compile().vm_universe.grad_cache
+    assert cache.stats() == dict(hits=0, misses=3, evictions=1,
+                                 size=2, maxsize=2)
+    # The evicted gradients are computed again.
+    assert fn(0.5) == expected
+    assert cache.stats()['evictions'] == 4
+    assert len(cache) == 2
+
+    fn = myia(grad_sum, vm_grad_cache_size=None)
+    assert fn(0.5) == expected
+    assert fn(0.5) == expected
+    cache = fn.compile().vm_universe.grad_cache
+    assert cache.stats() == dict(hits=3, misses=3, evictions=0,
+                                 size=3, maxsize=None)
+
+
+def test_lazy_bprop():
+    augm = find_grad(builtins.log, 3)
+    bprop_sym = augm.body.values[1].fn
+    assert (builtins.log, 3) not in bprop_lambdas
+    bprop = python_universe[bprop_sym]
+    assert bprop_lambdas[builtins.log, 3] is bprop
+
+    f = io.BytesIO()
+    save_bprops(f, (3,))
+    f.seek(0)
+    saved = pickle.load(f)
+    assert str(saved[builtins.log, 3]) == str(bprop)
+    assert str(saved[builtins.exp, 3]) == str(bprop_lambda(builtins.exp, 3))
+
+    # Loading only adds the backpropagators that were not compiled yet
+    del bprop_lambdas[builtins.exp, 3]
+    f.seek(0)
+    load_bprops(f)
+    assert bprop_lambdas[builtins.log, 3] is bprop
+    assert str(bprop_lambdas[builtins.exp, 3]) == str(saved[builtins.exp, 3])
+
+
+def test_grad_release():
+    lbda = parse_function(cube)
+    glbda = Grad(lbda.ref, a_normal(lbda)).transform()
+    ref = glbda.ref
+    assert python_universe[ref] is glbda
+    del glbda
+    gc.collect()
+    assert ref not in python_universe.weak
+
+
+def reuse(x, w):
+    a = x @ w
+    return x @ a + a
+
+
+@grad_test((M33, N33))
+def test_inplace_accumulation(x, w):
+    return sum(reuse(x, w) * x)
+
+
+def test_inplace_purity():
+    buf, y = numpy.ones(3), numpy.ones(3)
+    assert add_inplace({0}, buf, y) is buf
+    assert numpy.array_equal(buf, 2 * y)
+    # The buffer must have the shape and dtype of the result
+    assert add_inplace({0}, buf, O23).shape == (2, 3)
+    ibuf = numpy.ones(3, dtype=int)
+    assert add_inplace({0}, ibuf, 0.5) is not ibuf
+    assert numpy.array_equal(ibuf, y)
+
+    # The sensitivities are accumulated in place, but the arrays the
+    # user can see are left intact.
+    x, w, dout = M33.copy(), N33.copy(), O33.copy()
+    lbda = parse_function(reuse)
+    _, bprop = compile(Grad(lbda.ref, a_normal(lbda)).transform())(x, w)
+    _, dx1, dw1 = bprop(dout)
+    _, dx2, dw2 = bprop(dout)
+    assert numpy.array_equal(dx1, dx2)
+    assert numpy.array_equal(dw1, dw2)
+    assert numpy.array_equal(x, M33)
+    assert numpy.array_equal(w, N33)
+    assert numpy.array_equal(dout, O33)
+
+
+################
+# Forward mode #
+################
+
+
+def recurrence(v, w):
+    h = M33 @ v
+    i = 0
+    while i < 2:
+        h = h * w + v
+        i = i + 1
+    return sum(h * exp(v))
+
+
+def test_jvp():
+    def f(x, y):
+        return x * y + exp(x) / y
+
+    value, tangent = jvp(f)((2.0, 3.0), (1.0, None))
+    assert value == f(2.0, 3.0)
+    assert numpy.isclose(tangent, 3.0 + numpy.exp(2.0) / 3.0)
+
+    value, tangent = jvp(recurrence)((M3, N3), (P3, None))
+    eps = 1e-6
+    expected = (recurrence(M3 + eps * P3, N3) -
+                recurrence(M3 - eps * P3, N3)) / (2 * eps)
+    assert numpy.isclose(value, recurrence(M3, N3))
+    assert numpy.isclose(tangent, expected)
+
+
+def jvp_index(x, t):
+    return x[1] * 2.5 + t[0] * t[2]
+
+
+def jvp_getattr(r):
+    return r.a * r.b
+
+
+def jvp_setattr(r):
+    r = setattr(r, 'a', r.a * 3)
+    r = setattr(r, 'b', r.b / r.a)
+    return r.b + r.c
+
+
+def jvp_setslice(t, y):
+    t[1] = y * y
+    return t[0] * t[1]
+
+
+def jvp_setslice_last(t, y):
+    return setslice_last(t, y)
+
+
+def jvp_setslice_out(t, y):
+    t[1] = y
+    return t
+
+
+def jvp_map(xs, y):
+    def scale(x):
+        return x * y
+    a, b = map(scale, xs)
+    return a + b
+
+
+def jvp_enumerate(xs):
+    (i, a), (j, b) = enumerate(xs)
+    return a * b + j
+
+
+def jvp_closure(x, y):
+    def f(z):
+        return z * x + y
+    return f(f(y))
+
+
+@mark.parametrize('fn,args,tangents,expected', [
+    (jvp_index, (numpy.ones(3), (1.0, 2.0, 3.0)),
+     (numpy.arange(3.0), (1.0, 0.0, 1.0)), (5.5, 6.5)),
+    (jvp_getattr, (record(a=2.0, b=3.0),), (record(a=1.0, b=0.0),),
+     (6.0, 3.0)),
+    (jvp_setattr, (record(a=2.0, b=3.0, c=1.0),),
+     (record(a=1.0, b=0.0, c=1.0),), (1.5, 0.75)),
+    (jvp_setslice, ((2.0, 3.0), 5.0), ((1.0, 1.0), 1.0), (50.0, 45.0)),
+    # The tangent of the result is Sparse
+    (jvp_setslice_last, ((2.0, 3.0, 4.0), 5.0), ((1.0, 0.0, 1.0), 0.0),
+     (40.0, 30.0)),
+    (jvp_setslice_out, ((1.0, 2.0), 3.0), (None, 1.0),
+     ((1.0, 3.0), (0, 1.0))),
+    (jvp_map, ((2.0, 3.0), 5.0), ((1.0, 0.0), 1.0), (25.0, 10.0)),
+    (jvp_enumerate, ((2.0, 3.0),), ((1.0, 0.0),), (7.0, 3.0)),
+    (jvp_closure, (2.0, 3.0), (1.0, 0.0), (21.0, 15.0)),
+])
+def test_jvp_structures(fn, args, tangents, expected):
+    assert jvp(fn)(args, tangents) == expected
+
+
+def test_hvp():
+    lbda = parse_function(recurrence)
+    gfn = compile(Grad(lbda.ref, a_normal(lbda)).transform())
+
+    def grad(v, w):
+        return gfn(v, w)[1](1.0)[1:]
+
+    hv, hw = hvp(recurrence)((M3, N3), (P3, Q3))
+    eps = 1e-6
+    dv1, dw1 = grad(M3 + eps * P3, N3 + eps * Q3)
+    dv0, dw0 = grad(M3 - eps * P3, N3 - eps * Q3)
+    assert numpy.allclose(hv, (dv1 - dv0) / (2 * eps), rtol=1e-4)
+    assert numpy.allclose(hw, (dw1 - dw0) / (2 * eps), rtol=1e-4)
+
+
+#############
+# Jacobians #
+#############
+
+
+def layer(w, x, b):
+    return exp(w @ x) * 2 - w @ x / b
+
+
+def test_jacrev():
+    jw, jx, jb = jacrev(layer)(M33, N32, 3.0)
+    assert jw.shape == (3, 2, 3, 3)
+    assert jx.shape == (3, 2, 3, 2)
+    assert jb.shape == (3, 2)
+    eps = 1e-6
+    for arg, jac in ((0, jw), (1, jx), (2, jb)):
+        args = [M33, N32, 3.0]
+        for idx in numpy.ndindex(*numpy.shape(args[arg])):
+            d = numpy.zeros(numpy.shape(args[arg]))
+            d[idx] = eps
+            plus, minus = list(args), list(args)
+            plus[arg] = args[arg] + d
+            minus[arg] = args[arg] - d
+            diff = (layer(*plus) - layer(*minus)) / (2 * eps)
+            assert numpy.allclose(jac[(Ellipsis, *idx)], diff, rtol=1e-4)
+
+
+def test_jacrev_tuple():
+    def f(t, y):
+        a, b = t
+        return sum(a * y) + b
+
+    (ja, jb), jy = jacrev(f)((M3, 2.0), N3)
+    assert numpy.allclose(ja, N3)
+    assert jb == 1.0
+    assert numpy.allclose(jy, M3)
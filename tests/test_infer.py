@@ -1,8 +1,19 @@
 from myia.parse import MyiaSyntaxError, parse_function
 from myia.inference.avm import \
-    aroot_globals, abstract_evaluate, AbstractValue, ERROR, ANY
+    aroot_globals, abstract_evaluate, AbstractValue, ERROR, ANY, \
+    default_widening, DepthWidening, JoinWidening, IntervalWidening, \
+    Budget, Interval, fork_map
 from myia.inference.types import *
+from myia.inference.irinfer import GraphInferrer, InferencePass
+from myia.inference.dfa import DFA, ValueTrack, NeedsTrack
+from myia.stx import ClosureNode, python_universe
 from myia.symbols import builtins
+from myia.lib import VALUE
+from myia.front import myia
+from myia.impl.impl_interp import transpose
+import math
+import numpy
+import pickle
 import pytest
 
 
@@ -27,7 +38,7 @@ def getproj(av, proj):
     return av
 
 
-def infer(**tests):
+def infer(widening=default_widening, budget=None, **tests):
 
     tests = [(builtins[proj], t[:-1], t[-1])
              for proj, ts in tests.items()
@@ -45,7 +56,8 @@ def infer(**tests):
             inputs = tuple(i if isinstance(i, AbstractValue)
                            else AbstractValue({proj: i})
                            for i in inputs)
-            afn = abstract_evaluate(node, proj=proj)
+            afn = abstract_evaluate(node, proj=proj,
+                                    widening=widening, budget=budget)
             results = set(getproj(r, proj) for r in afn(*inputs))
             assert results == expected
 
@@ -56,6 +68,26 @@ def infer(**tests):
     return decorate
 
 
+def test_interned_values():
+    assert val(1) is val(1)
+    assert AbstractValue({builtins.type: Array[Int64]}) \
+        is AbstractValue({builtins.type: Array[Int64]})
+    # Equal, but they must not be confused
+    assert val(1) == val(1.0)
+    assert type(val(1.0)[VALUE]) is float
+    assert pickle.loads(pickle.dumps(val((1, 2)))) is val((1, 2))
+
+
+def test_interned_types():
+    x = var('x')
+    assert Array[Int64] is Array[Int64]
+    assert Tuple[Int64, Float32] is not Tuple[Float32, Int64]
+    assert unify(Array[x], Array[Float32]) == {x: Float32}
+    assert not unify(Array[x], List[Float32])
+    assert reify(Tuple[x, x], {x: Int8}) is Tuple[Int8, Int8]
+    assert pickle.loads(pickle.dumps(Array[Int8])) is Array[Int8]
+
+
 #################
 # Trivial cases #
 #################
@@ -146,6 +178,117 @@ def test_precise_loop(n, x, y):
     return x
 
 
+def test_interval():
+    i = Interval(0, math.inf)
+    assert (i < 0) is False
+    assert (i >= 0) is True
+    assert (i > 5) is ANY
+    assert i - 1 == Interval(-1, math.inf)
+    assert Interval.hull(3, Interval(-2, 1)) == Interval(-2, 3)
+
+
+@infer(widening=[IntervalWidening()],
+       shape=[(val(2), (5, 6), (6, 8), False),
+              # Terminates without losing the shape
+              (val(1_000_000), (5, 6), (6, 6), (5, 6))])
+def test_interval_widening(n, x, y):
+    while n > 0:
+        x = x @ y
+        n = n - 1
+    return x
+
+
+def abstract_values(fn, *args, **options):
+    afn = abstract_evaluate(parse_function(fn), **options)
+    return {r[VALUE] for r in afn(*map(val, args))}
+
+
+def count(n):
+    i = 0
+    while i < n:
+        i = i + 1
+    return i
+
+
+def doubling(n, x):
+    while n > 0:
+        x = x + x
+        n = n - 1
+    return x
+
+
+def test_interval_counter():
+    assert abstract_values(count, 3) == {3}
+    assert abstract_values(count, 100, widening=[IntervalWidening()]) \
+        == {Interval(1, math.inf)}
+
+
+def test_join_widening():
+    assert abstract_values(doubling, 1_000_000, 1.0,
+                           widening=[JoinWidening(2)]) == {ANY}
+
+
+@infer(widening=[], budget=Budget(steps=100),
+       shape=[(val(1_000_000), (5, 6), (6, 6), (5, 6))])
+def test_budget(n, x, y):
+    while n > 0:
+        x = x @ y
+        n = n - 1
+    return x
+
+
+@infer(shape=[(val(ANY), (5, 5), (5, 5), (5, 5)),
+              (val(ANY), (5, 6), (6, 5), {(5, 6), (5, 5), False}),
+              (val(ANY), (5, 6), (5, 6), {(5, 6), False})])
+def test_branches(c, x, y):
+    # Each if forks the evaluation. The rest of the function must only
+    # be evaluated once for each distinct state, not once per path.
+    if c < 0:
+        x = x @ y
+    else:
+        x = x
+    if c < 1:
+        x = x @ y
+    else:
+        x = x
+    if c < 2:
+        x = x @ y
+    else:
+        x = x
+    if c < 3:
+        x = x @ y
+    else:
+        x = x
+    if c < 4:
+        x = x @ y
+    else:
+        x = x
+    if c < 5:
+        x = x @ y
+    else:
+        x = x
+    return x
+
+
+@mark.parametrize('processes', [2, 4])
+def test_parallel_branches(processes):
+    node = parse_function(test_branches.__orig__)
+    proj = builtins.shape
+    for shapes in [((5, 5), (5, 5)), ((5, 6), (6, 5)), ((5, 6), (5, 6))]:
+        inputs = (val(ANY), *(AbstractValue({proj: s}) for s in shapes))
+        results = [set(getproj(r, proj) for r in afn(*inputs))
+                   for afn in (abstract_evaluate(node, proj=proj),
+                               abstract_evaluate(node, proj=proj,
+                                                 processes=processes))]
+        assert results[0] == results[1]
+
+
+def test_fork_map():
+    assert fork_map(lambda i: i * 2, range(3)) == [0, 2, 4]
+    # Functions cannot be sent back
+    assert fork_map(lambda i: lambda: i, range(2)) is None
+
+
 @xfail
 @infer(shape=[(val(ANY), (5, 6), (10, 12), {(5, 6), (10, 12)})])
 def test_precise_tracking(n, x, y):
@@ -158,3 +301,129 @@ def test_precise_tracking(n, x, y):
         else:
             return y
     return f(x, y) + f(x, y)
+
+
+############################
+# Inference on the IRGraph #
+############################
+
+
+def ir_loop(x, w, n):
+    i = 0
+    while i < n:
+        x = x * w + 1.0
+        i = i + 1
+    if n > 3:
+        y = x @ transpose(x)
+    else:
+        y = x @ w
+    return x, y
+
+
+def ir_infer(fn, *args):
+    mf = myia(fn)
+    mf(*args)
+    spec, = mf.specializations.values()
+    return spec.__myia_graph__
+
+
+def test_ir_infer():
+    x = numpy.ones((4, 5), dtype='float32')
+    w = numpy.ones(5, dtype='float32')
+    graph = ir_infer(ir_loop, x, w, 2)
+    tx, ty = graph.output.inferred['type'].elem_types
+    assert tx == ty == Array[Float32]
+    xnode, ynode = graph.output.inputs
+    assert xnode.inferred['shape'] == (4, 5)
+    # The branches return a (4, 4) matrix or a vector
+    assert ynode.inferred['shape'] is None
+
+
+def test_ir_infer_incremental():
+    evaluated = []
+
+    class CountingInferrer(GraphInferrer):
+        def evaluate(self, graph, args):
+            evaluated.append(graph)
+            return super().evaluate(graph, args)
+
+    x = numpy.ones((4, 5), dtype='float32')
+    w = numpy.ones(5, dtype='float32')
+    graph = ir_infer(ir_loop, x, w, 2)
+    passs = InferencePass(CountingInferrer())
+    passs(None, graph)
+    assert len(evaluated) > 2
+    evaluated.clear()
+    passs(None, graph)
+    assert evaluated == [graph]
+
+
+def grow(t, n):
+    if n < 1:
+        return t
+    else:
+        return grow((t, t), n - 1)
+
+
+def test_ir_infer_growing_recursion():
+    evaluated = []
+
+    class CountingInferrer(GraphInferrer):
+        def evaluate(self, graph, args):
+            evaluated.append(graph)
+            return super().evaluate(graph, args)
+
+    graph = ir_infer(grow, 1, 3)
+    assert myia(grow)(1, 3) == grow(1, 3)
+    InferencePass(CountingInferrer())(None, graph)
+    # The tuple argument is widened instead of growing at each call
+    assert len(evaluated) < 20
+
+
+#####################
+# Dataflow analysis #
+#####################
+
+
+def dfa_closures(x, y):
+    def add(z):
+        return z + y
+
+    def mul(z):
+        return z * y
+
+    if x < 0:
+        f = add
+    else:
+        f = mul
+    return f(x)
+
+
+def test_dfa():
+    lbda = parse_function(dfa_closures)
+    dfa = DFA([ValueTrack, lambda dfa: NeedsTrack(dfa, [builtins.type])],
+              python_universe)
+    dfa.visit(lbda)
+    dfa.propagate(lbda.body, 'needs', builtins.type)
+    # Both closures flow to f
+    values = dfa.values[dfa.value_track]
+    fs = [node for node in values
+          if len(values[node]) == 2
+          and all(isinstance(v, ClosureNode) for v in values[node])]
+    assert fs
+    assert all(VALUE in dfa.values[dfa.tracks['needs']][f] for f in fs)
+    stats = dfa.stats()
+    assert stats['iterations'] > 0
+    assert stats['values'] == len(dfa.id_values)
+
+
+def test_dfa_values_without_listeners():
+    lbda = parse_function(dfa_closures)
+    dfa = DFA([ValueTrack], python_universe)
+    dfa.visit(lbda)
+    values = dfa.values[dfa.value_track]
+    # Nothing listens to the root lambda, which still has its value.
+    assert not dfa.flow_events[lbda]
+    assert lbda in values[lbda]
+    # Every node with values on the track reports them.
+    assert all(len(values[node]) > 0 for node in values)
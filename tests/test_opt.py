@@ -0,0 +1,475 @@
+"""
+Test the optimizations of the standard pipeline.
+"""
+
+from myia.front import myia
+from .test_front import myia_test
+import numpy
+from myia.impl.impl_interp import \
+    exp, log, transpose, matrix_chain_order, J, Jinv, dot
+from myia.ir.graph import IRNode
+from myia.ir.pattern import is_recursive, builtin_node, pattern_bank
+from myia.inference.types import Array, Bool, Float32, Float64, Int64
+from myia.lib import ZERO
+from myia.symbols import builtins
+from myia.stx import GenSym
+import pytest
+
+
+def used_ops(graph):
+    """
+    List the names of the builtins applied in graph, including the
+    ones inside ``fused`` expressions.
+    """
+    def tree_ops(tree):
+        if isinstance(tree, int):
+            return []
+        op, *args = tree
+        return [op] + [o for arg in args for o in tree_ops(arg)]
+
+    rval = []
+    for node in graph.iternodes():
+        if node.fn and node.fn.is_builtin():
+            if node.fn.value.label == 'fused':
+                rval += tree_ops(node.inputs[0].value)
+            else:
+                rval.append(node.fn.value.label)
+    return rval
+
+
+def opt_test(*tests, ops):
+    """
+    Decorate a test function that is meant to be compiled by myia.
+
+    The function is checked against `tests`, like `myia_test`, and the
+    optimized graph must only contain operations in `ops`.
+
+    Arguments:
+        tests: One or more (inputs, output) pair(s).
+        ops: The names of the only operations allowed in the
+             optimized graph.
+    """
+
+    def decorate(fn):
+        def test(inputs, output):
+            if not isinstance(inputs, tuple):
+                inputs = inputs,
+
+            mf = myia(fn)
+            assert mf(*inputs) == output
+            assert set(used_ops(mf.mfn.__myia_graph__)) <= set(ops)
+
+        m = pytest.mark.parametrize('inputs,output', list(tests))(test)
+        m.__orig__ = fn
+        return m
+
+    return decorate
+
+
+@opt_test(((3, 4), 13), ops=['add', 'multiply'])
+def test_arithmetic(x, y):
+    return (x * 1 + 0) ** 2 + y - 0
+
+
+@opt_test(((3, 4), 7), ops=['add'])
+def test_tuples(x, y):
+    a, b = (x, 0) + (y, 1)
+    return a * 1
+
+
+@opt_test((3.0, 3.0), ops=[])
+def test_inverses(x):
+    return log(exp(-(-x)))
+
+
+def test_transpose_transpose():
+    def f(A):
+        return transpose(transpose(A))
+
+    A = numpy.ones((2, 3))
+    mf = myia(f)
+    assert (mf(A) == A).all()
+    assert used_ops(mf.mfn.__myia_graph__) == []
+
+
+@opt_test((3.0, 3.0), ops=[])
+def test_J_Jinv(x):
+    return Jinv(J(x))
+
+
+@opt_test((3.0, 3.0), ops=[])
+def test_ZERO(x):
+    return x + transpose(-J(ZERO)) * x + Jinv(ZERO) / x
+
+
+@opt_test((3.0, 3.0), ops=[])
+def test_ZERO_structures(x):
+    z = dot(ZERO, x)
+    return x + (z, dot(x, ZERO))[1]
+
+
+def test_multiply_zero_float():
+    def f(x):
+        return 0 * x
+
+    assert numpy.isnan(myia(f)(float('inf')))
+
+
+def test_add_zero_float():
+    def f(x):
+        return x + 0.0
+
+    mf = myia(f)
+    assert type(mf(3)) is float
+    assert used_ops(mf.mfn.__myia_graph__) == ['add']
+
+
+def applies_to(rule, fn, *inputs):
+    """
+    Whether the pattern named rule rewrites an application of the
+    builtin fn to the given input nodes.
+    """
+    node = IRNode(None, GenSym('tests::opt')('node'))
+    node.set_sexp(builtin_node(fn), list(inputs))
+    user = IRNode(None, 'user')
+    user.set_sexp(builtin_node(builtins.identity), [node])
+    _, changes = pattern_bank[rule](None, node)
+    return bool(changes)
+
+
+@pytest.mark.parametrize('rule,fn,const,typ,applies', [
+    ('add_zero_l', builtins.add, 0, None, True),
+    ('add_zero_l', builtins.add, 0, Float64, True),
+    ('add_zero_l', builtins.add, 0.0, Float64, True),
+    ('add_zero_l', builtins.add, 0.0, Int64, False),
+    ('add_zero_l', builtins.add, 0.0, None, False),
+    ('add_zero_l', builtins.add, 0, Bool, False),
+    ('add_zero_l', builtins.add, False, Int64, False),
+    ('multiply_by_one_l', builtins.multiply, 1.0, Array[Float32], True),
+    ('multiply_by_one_l', builtins.multiply, 1.0, Array[Int64], False),
+    ('multiply_by_zero_l', builtins.multiply, 0, Int64, True),
+    ('multiply_by_zero_l', builtins.multiply, 0, Array[Int64], True),
+    ('multiply_by_zero_l', builtins.multiply, 0, Float64, False),
+    ('multiply_by_zero_l', builtins.multiply, 0, None, False),
+    ('multiply_by_zero_l', builtins.multiply, 0.0, Int64, False),
+])
+def test_arithmetic_types(rule, fn, const, typ, applies):
+    """
+    The arithmetic identities only apply if they keep the type of the
+    result, given the type inferred for the other operand.
+    """
+    x = IRNode(None, 'x')
+    x.inferred.update(type=typ, shape=None)
+    assert applies_to(rule, fn, IRNode(None, 'c', const), x) == applies
+
+
+@pytest.mark.parametrize('i,j,applies', [
+    (1, 1, True), (1, 2, True), (-1, -2, True), (-1, 2, False), (2, -1, False)
+])
+def test_index_sparse_signs(i, j, applies):
+    """
+    sparse(i, x)[j] is only simplified if i and j have the same sign,
+    since -1 may be the index 2 of a tuple.
+    """
+    s = IRNode(None, 's')
+    s.set_sexp(builtin_node(builtins.sparse),
+               [IRNode(None, 'i', i), IRNode(None, 'x')])
+    assert applies_to('index_sparse', builtins.index,
+                      s, IRNode(None, 'j', j)) == applies
+
+
+@pytest.mark.parametrize('typ,applies', [
+    (Float64, True), (Int64, False), (None, False)
+])
+def test_divide_by_one_types(typ, applies):
+    x = IRNode(None, 'x')
+    x.inferred.update(type=typ, shape=None)
+    c = IRNode(None, 'c', 1)
+    assert applies_to('divide_by_one', builtins.divide, x, c) == applies
+
+
+def test_matrix_chain_order():
+    # Classic example: 30x35, 35x15, 15x5, 5x10, 10x20, 20x25
+    # is best computed as ((A1 (A2 A3)) ((A4 A5) A6))
+    split = matrix_chain_order([30, 35, 15, 5, 10, 20, 25])
+    assert split[0][5] == 2
+    assert split[0][2] == 0
+    assert split[3][5] == 4
+
+
+def random_arrays_test(*shapes, check):
+    """
+    Decorate a test function of arrays, to be run on random arrays of
+    the given shapes. The result must match the Python function's,
+    and ``check`` is called on the optimized graph.
+    """
+
+    def decorate(fn):
+        def test():
+            r = numpy.random.RandomState(1234)
+            args = [r.rand(*shp) for shp in shapes]
+            mf = myia(fn)
+            assert numpy.allclose(mf(*args), fn(*args))
+            check(mf.mfn.__myia_graph__)
+
+        test.__orig__ = fn
+        return test
+
+    return decorate
+
+
+def dot_chain_test(*shapes):
+    """
+    Test of matrix products (see ``random_arrays_test``). The
+    optimized graph must compute the products with a single
+    ``multi_dot``.
+    """
+
+    def check(graph):
+        assert used_ops(graph) == ['multi_dot']
+
+    return random_arrays_test(*shapes, check=check)
+
+
+@dot_chain_test((20, 30), (30, 40), (40,))
+def test_dot_chain_vector(A, B, v):
+    return (A @ B) @ v
+
+
+@dot_chain_test((30,), (30, 40), (40, 5), (5, 10))
+def test_dot_chain_long(u, A, B, C):
+    return u @ (A @ (B @ C))
+
+
+@dot_chain_test((20, 30), (30, 40), (50, 20))
+def test_dot_chain_transpose(A, B, C):
+    return transpose(transpose(A @ B) @ transpose(C))
+
+
+@dot_chain_test((3, 4, 5), (3, 5, 2), (3, 2, 6))
+def test_dot_chain_batched(A, B, C):
+    return (A @ B) @ transpose(transpose(C))
+
+
+def fusion_test(*shapes, ops):
+    """
+    Test of elementwise operations (see ``random_arrays_test``). The
+    optimized graph must compute the result with a single ``fused``
+    call, of the given ops.
+    """
+
+    def check(graph):
+        assert [node.fn.value.label for node in graph.iternodes()
+                if node.fn] == ['fused']
+        assert sorted(used_ops(graph)) == sorted(ops)
+
+    return random_arrays_test(*shapes, check=check)
+
+
+@fusion_test((10, 20), (20,), ops=['add', 'multiply', 'exp', 'log'])
+def test_fusion_broadcast(x, y):
+    return log(exp(x) + 1) * y
+
+
+@fusion_test((10, 20), (10, 20),
+             ops=['divide', 'add', 'exp', 'unary_subtract', 'subtract'])
+def test_fusion_sigmoid(x, y):
+    return 1 / (1 + exp(-x)) - y
+
+
+def int_divide(x, y):
+    return (x + y) / y
+
+
+def int_exp(x, y):
+    return exp(x + y)
+
+
+def int_arith(x, y):
+    return (x + y) * 2 - y
+
+
+@pytest.mark.parametrize('fn', [int_divide, int_exp, int_arith])
+def test_fusion_int_arrays(fn):
+    # The intermediate int arrays cannot hold the float results of
+    # divide and exp
+    x = numpy.arange(6).reshape(2, 3)
+    y = numpy.arange(1, 7).reshape(2, 3)
+    mf = myia(fn)
+    res = mf(x, y)
+    assert res.dtype == fn(x, y).dtype
+    assert numpy.allclose(res, fn(x, y))
+    assert 'fused' in [node.fn.value.label
+                       for node in mf.mfn.__myia_graph__.iternodes()
+                       if node.fn]
+
+
+@myia_test(((3.0, 2.0), 0.625), ((1, 2), 0.125))
+def test_fusion_scalars(x, y):
+    return (x - 0.5) / (y * y)
+
+
+def chain(A, B, v):
+    return (A @ B) @ v
+
+
+def test_specialize_dot_chain():
+    r = numpy.random.RandomState(1234)
+    A, B, v = r.rand(20, 30), r.rand(30, 40), r.rand(40)
+    mf = myia(chain)
+    assert numpy.allclose(mf(A, B, v), chain(A, B, v))
+    spec, = mf.specializations.values()
+    graph = spec.__myia_graph__
+    assert used_ops(graph) == ['dot', 'dot']
+    # A @ (B @ v) is the cheapest order
+    assert graph.output.inputs[0] is graph.inputs[0]
+
+
+def test_specialization_limit():
+    r = numpy.random.RandomState(1234)
+    mf = myia(chain, max_specializations=2)
+    for n in (10, 11, 12):
+        A, B, v = r.rand(n, 30), r.rand(30, 40), r.rand(40)
+        assert numpy.allclose(mf(A, B, v), chain(A, B, v))
+    assert len(mf.specializations) == 2
+
+
+def test_specialization_buckets():
+    r = numpy.random.RandomState(1234)
+    mf = myia(chain, shape_buckets=lambda n: 1 << (n - 1).bit_length())
+    for n in (10, 11, 12):
+        A, B, v = r.rand(n, 30), r.rand(30, 40), r.rand(40)
+        assert numpy.allclose(mf(A, B, v), chain(A, B, v))
+    spec, = mf.specializations.values()
+    assert used_ops(spec.__myia_graph__) == ['multi_dot']
+
+
+def loop(x, n, flag):
+    if flag:
+        x = x * 2
+    else:
+        x = x - 1
+    i = 0
+    while i < n:
+        x = x + i
+        i = i + 1
+    return x
+
+
+def test_specialize_unroll():
+    f = myia(loop).specialize(n=3, flag=True)
+    assert f(1) == loop(1, 3, True)
+    graph = f.__myia_graph__
+    assert not any(node.is_graph() for node in graph.iterboundary())
+    assert sorted(used_ops(graph)) == ['add', 'add', 'multiply']
+
+
+def test_specialize_unknown_trip_count():
+    f = myia(loop).specialize(flag=False)
+    for n in range(4):
+        assert f(1, n) == loop(1, n, False)
+    assert 'multiply' not in used_ops(f.__myia_graph__)
+
+
+def test_specialize_max_unroll():
+    f = myia(loop).specialize(n=100, flag=True, max_unroll=5)
+    assert f(1) == loop(1, 100, True)
+
+
+def test_specialize_bad_argument():
+    with pytest.raises(TypeError):
+        myia(loop).specialize(m=3)
+
+
+@opt_test((3, 6), ops=[])
+def test_constant_branch(x):
+    if 1 < 2:
+        return x * 2
+    else:
+        return x - 1
+
+
+def rotate(s, k):
+    a, b = s
+    return (a + b * k, b)
+
+
+def applied_op(node):
+    if node.fn and node.fn.is_builtin():
+        return node.fn.value.label
+
+
+def tuple_loop(x, y, n):
+    s = (x, y)
+    i = 0
+    while i < n:
+        s = rotate(s, i)
+        i = i + 1
+    return s[0]
+
+
+def test_tuple_flattening():
+    mf = myia(tuple_loop)
+    assert mf(1, 2, 4) == tuple_loop(1, 2, 4)
+    root = mf.mfn.__myia_graph__
+    loop_graphs = [g for g in root.itergraphs() if g is not root]
+    assert loop_graphs
+    for g in loop_graphs:
+        # The state is carried in separate parameters, and tuples are
+        # only built to be returned when the loop exits.
+        assert len(g.inputs) == 4
+        for node in g.iternodes():
+            if applied_op(node) == 'mktuple':
+                while applied_op(node) == 'mktuple':
+                    (_, node), = node.users
+                assert applied_op(node) == 'partial'
+                assert node.inputs[0].value.label == 'identity'
+
+
+big_tuple = tuple(range(300))
+
+
+def first(t):
+    return t[0]
+
+
+def big_tuple_first(x):
+    return first(big_tuple) + x
+
+
+def test_tuple_flattening_large():
+    # Arities above 256 must still converge
+    mf = myia(big_tuple_first)
+    assert mf(1) == 1
+
+
+def invariant_loop(x, A, n):
+    i = 0
+    while i < n:
+        x = x + exp(A) * 2
+        i = i + 1
+    return x
+
+
+def test_loop_invariant():
+    mf = myia(invariant_loop)
+    x, A = numpy.zeros(3), numpy.ones(3)
+    assert numpy.allclose(mf(x, A, 4), invariant_loop(x, A, 4))
+    root = mf.mfn.__myia_graph__
+    # exp is computed in the first iteration, which is peeled, and
+    # the recursive graphs take its result as a parameter.
+    graphs = list(root.itergraphs())
+    assert sum(used_ops(g).count('exp') for g in graphs) == 1
+    for g in graphs:
+        if is_recursive(g):
+            assert not {'exp', 'multiply'} & set(used_ops(g))
+
+
+@myia_test(((1, 0, 0), 1), ((1, 2, 2), 2))
+def test_loop_invariant_no_iteration(x, d, n):
+    # 1 / d must not be computed if the loop does not iterate
+    i = 0
+    while i < n:
+        x = x + 1 / d
+        i = i + 1
+    return x
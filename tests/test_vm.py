@@ -0,0 +1,93 @@
+"""
+Test the memory planning of the VM.
+"""
+
+from myia.front import myia
+from myia.impl.impl_interp import exp
+import numpy
+
+
+def commands(mf):
+    return [(i.command, *i.args) for i in mf.mfn.vmf.code.instructions]
+
+
+def test_drop_after_last_use():
+    def f(x, y):
+        z = x * y
+        return (z, z)
+
+    mf = myia(f)
+    assert mf(2, 3) == (6, 6)
+    cmds = commands(mf)
+    # x and y are dropped once they are read
+    assert cmds.index(('drop', 0)) == cmds.index(('dup', 0)) + 1
+    assert cmds.index(('drop', 1)) == cmds.index(('dup', 1)) + 1
+    # z is dropped after its second read only, and the tuple can
+    # take over the second reference
+    assert cmds.count(('dup', 2)) == 2
+    assert cmds[-3:] == [('dup', 2), ('drop', 2), ('reduce', 2, (1,))]
+
+
+def test_reuse_dead_buffer():
+    def f(x, w):
+        return exp(x @ w) + 1
+
+    x = numpy.random.rand(10, 20)
+    w = numpy.random.rand(20, 30)
+    x0, w0 = x.copy(), w.copy()
+    mf = myia(f)
+    assert numpy.allclose(mf(x, w), numpy.exp(x0 @ w0) + 1)
+    # The product is dead when the fused expression runs
+    assert ('reduce', 3, (1,)) in commands(mf)
+    # The arguments must never be overwritten
+    assert (x == x0).all() and (w == w0).all()
+
+
+def test_no_reuse_of_shared_operand():
+    def f(x, w):
+        h = x @ w
+        return (exp(h) + 1) * h
+
+    x = numpy.random.rand(10, 20)
+    w = numpy.random.rand(20, 30)
+    h = x @ w
+    mf = myia(f)
+    assert numpy.allclose(mf(x, w), (numpy.exp(h) + 1) * h)
+
+
+def test_no_reuse_of_input():
+    def f(x):
+        return exp(x) + 1
+
+    x = numpy.random.rand(10, 20)
+    x0 = x.copy()
+    mf = myia(f)
+    assert numpy.allclose(mf(x), numpy.exp(x0) + 1)
+    assert (x == x0).all()
+
+
+def test_switch_lowering():
+    def f(x, y):
+        if x < y:
+            return x * y
+        else:
+            return x - y
+
+    mf = myia(f)
+    assert mf(2, 3) == 6
+    assert mf(3, 2) == 1
+    cmds = [c for c, *_ in commands(mf)]
+    assert 'jump_if' in cmds and 'jump' in cmds
+    # No closure is made for the branches
+    assert ('fetch', 'partial') not in \
+        [(c, str(a[0]) if a else None) for c, *a in commands(mf)]
+
+
+def test_loop():
+    def f(n):
+        i = 0
+        while i < n:
+            i = i + 1
+        return i
+
+    assert myia(f)(1000) == 1000